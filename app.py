@@ -1,43 +1,238 @@
+import gzip
+import hashlib
+import json
+import mimetypes
 import os
-import io
-from datetime import datetime
-import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, send_file
+import re
+import secrets
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from urllib.parse import quote
+import click
+from flask import Blueprint, Flask, Request, render_template, request, redirect, url_for, flash, send_from_directory, send_file
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
-from wtforms import StringField, FloatField, SubmitField, SelectField, PasswordField
+from wtforms import StringField, FloatField, SubmitField, SelectField, PasswordField, BooleanField
 from wtforms.validators import DataRequired, Length, Optional
 from flask_wtf.file import FileField, FileRequired, FileAllowed
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from PIL import Image
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from flask import current_app, send_file, abort
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from flask import current_app, send_file, abort, g, make_response, has_request_context, stream_with_context
+from sqlalchemy import func, or_, and_, event
+from sqlalchemy.exc import IntegrityError
 
 
 
 # --- CONFIGURAÇÃO INICIAL ---
 load_dotenv()
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY') or 'camara_secret_123'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'uploads'
 
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+def carregar_config(app):
+    """Configuração lida do ambiente (.env); create_app pode sobrescrever valores depois."""
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY') or 'camara_secret_123'
+    # Banco: SQLite local por padrão; DATABASE_URL aponta para outro (ex.: PostgreSQL)
+    app.config['SQLALCHEMY_DATABASE_URI'] = (os.getenv('DATABASE_URL') or 'sqlite:///database.db').replace('postgres://', 'postgresql://', 1)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Perfil de produção do SQLite (WAL + pragmas a cada conexão); SQLITE_PRAGMAS=0 desliga
+    app.config['SQLITE_PRAGMAS'] = os.getenv('SQLITE_PRAGMAS', '1') == '1'
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 15000))
+    app.config['SQLITE_MMAP_MB'] = int(os.getenv('SQLITE_MMAP_MB', 256))
+    app.config['SQLITE_CACHE_MB'] = int(os.getenv('SQLITE_CACHE_MB', 64))
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # Arquivo SQLite: QueuePool (padrão do SQLAlchemy); a espera por lock fica com o busy_timeout
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+            'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000},
+        }
+    else:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+            'pool_pre_ping': True,
+            'pool_recycle': 1800,
+        }
+    app.config['UPLOAD_FOLDER'] = 'uploads'
+    app.config['HISTORICO_POR_PAGINA'] = int(os.getenv('HISTORICO_POR_PAGINA', 50))
+    app.config['OCORRENCIAS_POR_PAGINA'] = int(os.getenv('OCORRENCIAS_POR_PAGINA', 30))
+    # Fotos: compactação em segundo plano num pool de processos
+    app.config['FOTOS_EM_SEGUNDO_PLANO'] = os.getenv('FOTOS_EM_SEGUNDO_PLANO', '1') == '1'
+    app.config['FOTOS_PROCESSOS'] = int(os.getenv('FOTOS_PROCESSOS', min(4, os.cpu_count() or 1)))
+    # Foto pendente de um worker de outro host (sem como conferir o pid) só é retomada depois disso
+    app.config['FOTOS_RETOMAR_APOS'] = int(os.getenv('FOTOS_RETOMAR_APOS', 900))
+    # Limites por foto, conferidos antes de decodificar (tamanho durante o upload, pixels pelo cabeçalho)
+    app.config['FOTOS_MAX_MB'] = int(os.getenv('FOTOS_MAX_MB', 20))
+    app.config['FOTOS_MAX_PIXELS'] = int(float(os.getenv('FOTOS_MAX_MEGAPIXELS', 50)) * 1_000_000)
+    app.config['FOTOS_POR_ENVIO'] = int(os.getenv('FOTOS_POR_ENVIO', 20))
+    # Miniaturas da galeria: cache em disco limitado por tamanho
+    app.config['MINIATURAS_PASTA'] = os.path.join(app.config['UPLOAD_FOLDER'], 'cache', 'miniaturas')
+    app.config['MINIATURAS_LADO'] = 160
+    app.config['MINIATURAS_CACHE_MB'] = int(os.getenv('MINIATURAS_CACHE_MB', 200))
+    # Entrega de arquivos pelo proxy: '' (o próprio Flask), 'x-sendfile' ou 'x-accel'
+    app.config['ARQUIVOS_VIA_PROXY'] = os.getenv('ARQUIVOS_VIA_PROXY', '').lower()
+    app.config['USE_X_SENDFILE'] = app.config['ARQUIVOS_VIA_PROXY'] == 'x-sendfile'
+    app.config['X_ACCEL_PREFIXO'] = os.getenv('X_ACCEL_PREFIXO', '/_uploads/')
+    # Onde ficam as fotos processadas: 'local' (UPLOAD_FOLDER/objetos) ou 's3' (S3, MinIO...)
+    app.config['ARMAZENAMENTO'] = os.getenv('ARMAZENAMENTO', 'local').lower()
+    app.config['S3_BUCKET'] = os.getenv('S3_BUCKET', '')
+    app.config['S3_PREFIXO'] = os.getenv('S3_PREFIXO', 'objetos/')
+    app.config['S3_ENDPOINT_URL'] = os.getenv('S3_ENDPOINT_URL', '')
+    app.config['S3_REGIAO'] = os.getenv('S3_REGIAO', '')
+    app.config['S3_URL_EXPIRA'] = int(os.getenv('S3_URL_EXPIRA', 300))
+    app.config['S3_MULTIPART_MB'] = int(os.getenv('S3_MULTIPART_MB', 8))
+    # Relatórios pesados (planilha oficial): pedidos vão para uma fila no banco. Por
+    # padrão são gerados numa thread do próprio servidor web; com o worker
+    # `flask processar-relatorios` rodando (deploy/relatorios-worker.service),
+    # defina RELATORIOS_NO_PROCESSO=0 para a geração sair dos processos web.
+    # Os arquivos ficam fora de UPLOAD_FOLDER (que /download serve a qualquer usuário
+    # logado) e num caminho absoluto: worker e servidor podem ter cwd diferentes
+    app.config['RELATORIOS_PASTA'] = os.path.join(app.root_path, os.getenv('RELATORIOS_PASTA') or os.path.join(app.instance_path, 'relatorios'))
+    app.config['RELATORIOS_VALIDADE_HORAS'] = float(os.getenv('RELATORIOS_VALIDADE_HORAS', 24))
+    app.config['RELATORIOS_INTERVALO'] = float(os.getenv('RELATORIOS_INTERVALO', 2))
+    # O worker renova atualizado_em da tarefa a cada RELATORIOS_BATIMENTO s enquanto gera;
+    # tarefa executando sem batimento há RELATORIOS_SEM_BATIMENTO s é de um worker que morreu
+    app.config['RELATORIOS_BATIMENTO'] = int(os.getenv('RELATORIOS_BATIMENTO', 30))
+    app.config['RELATORIOS_SEM_BATIMENTO'] = int(os.getenv('RELATORIOS_SEM_BATIMENTO', 300))
+    app.config['RELATORIOS_TENTATIVAS'] = int(os.getenv('RELATORIOS_TENTATIVAS', 3))
+    app.config['RELATORIOS_NO_PROCESSO'] = os.getenv('RELATORIOS_NO_PROCESSO', '1') == '1'
+    # Segundos na fila até a página da tarefa avisar que nenhum worker a pegou
+    app.config['RELATORIOS_AVISO_FILA'] = int(os.getenv('RELATORIOS_AVISO_FILA', 60))
+    # Métricas por rota (/admin/metrics e /metrics); desligadas por padrão
+    app.config['METRICAS_ATIVAS'] = os.getenv('METRICAS_ATIVAS', '0') == '1'
+    app.config['METRICAS_JANELA'] = int(os.getenv('METRICAS_JANELA', 1000))
+    app.config['METRICAS_SQL_LENTA_MS'] = float(os.getenv('METRICAS_SQL_LENTA_MS', 200))
+    app.config['METRICAS_TOKEN'] = os.getenv('METRICAS_TOKEN', '')
+    # Segundos que a identidade do usuário logado fica em cache no processo
+    app.config['USUARIOS_CACHE_TTL'] = int(os.getenv('USUARIOS_CACHE_TTL', 300))
+    # Agregados dos gráficos do histórico (API JSON): cache curto por combinação de filtros
+    app.config['AGREGADOS_CACHE_TTL'] = int(os.getenv('AGREGADOS_CACHE_TTL', 60))
+    # Odômetro: KM que pode "sumir" entre duas viagens do mesmo veículo e KM de uma
+    # viagem só; acima disso a leitura é aceita, mas com alerta (ver validar_odometro)
+    app.config['KM_SALTO_MAXIMO'] = float(os.getenv('KM_SALTO_MAXIMO', 500))
+    app.config['KM_VIAGEM_MAXIMA'] = float(os.getenv('KM_VIAGEM_MAXIMA', 1000))
+    # Status da frota nas telas: por padrão o navegador consulta /api/frota a cada
+    # FROTA_POLLING segundos. FROTA_SSE=1 troca por Server-Sent Events, mas cada
+    # conexão ocupa uma thread do worker até FROTA_SSE_DURACAO segundos (o navegador
+    # reconecta sozinho): só ligue com gunicorn --threads ou gevent, senão poucos
+    # motoristas na página inicial ocupam todos os workers sync
+    app.config['FROTA_POLLING'] = int(os.getenv('FROTA_POLLING', 15))
+    app.config['FROTA_SSE'] = os.getenv('FROTA_SSE', '0') == '1'
+    app.config['FROTA_SSE_DURACAO'] = int(os.getenv('FROTA_SSE_DURACAO', 300))
+    app.config['FROTA_SSE_PING'] = int(os.getenv('FROTA_SSE_PING', 15))
+    # Login: método de hash do werkzeug (ex.: 'scrypt:16384:8:1', 'pbkdf2:sha256:600000'),
+    # verificações simultâneas por processo e limite de falhas por CPF/IP
+    app.config['SENHA_METODO'] = os.getenv('SENHA_METODO', 'scrypt')
+    app.config['LOGIN_HASH_CONCORRENCIA'] = int(os.getenv('LOGIN_HASH_CONCORRENCIA', os.cpu_count() or 1))
+    app.config['LOGIN_HASH_ESPERA'] = float(os.getenv('LOGIN_HASH_ESPERA', 5))
+    app.config['LOGIN_JANELA'] = int(os.getenv('LOGIN_JANELA', 300))
+    app.config['LOGIN_FALHAS_CPF'] = int(os.getenv('LOGIN_FALHAS_CPF', 5))
+    app.config['LOGIN_FALHAS_IP'] = int(os.getenv('LOGIN_FALHAS_IP', 30))
+    # Proxies reversos na frente do app (Render, nginx). Com N > 0, o IP do cliente
+    # (request.remote_addr, usado no limite por IP do login) vem de X-Forwarded-For,
+    # confiando nos N últimos saltos; use 0 quando o app recebe as conexões direto
+    app.config['PROXY_SALTOS'] = int(os.getenv('PROXY_SALTOS', 1))
 
 # --- BANCO DE DADOS E LOGIN ---
-db = SQLAlchemy(app)
+db = SQLAlchemy()
+
+def configurar_sqlite(config, conexao, _registro):
+    """
+    Pragmas aplicados a cada conexão nova do SQLite:
+    - WAL: leitores não bloqueiam o escritor (e vice-versa) entre workers;
+    - busy_timeout: espera o lock em vez de falhar com 'database is locked';
+    - synchronous=NORMAL: seguro em WAL e bem mais rápido que FULL;
+    - mmap_size/cache_size: leituras direto da memória.
+    """
+    cursor = conexao.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={config['SQLITE_MMAP_MB'] * 1024 * 1024}")
+    cursor.execute(f"PRAGMA cache_size=-{config['SQLITE_CACHE_MB'] * 1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'principal.login'
+
+# Rotas do dia a dia (motoristas) e comandos de manutenção. Administração,
+# relatórios e arquivos ficam nos blueprints de rotas/, registrados por create_app.
+principal = Blueprint('principal', __name__, cli_group=None)
+
+class UsuarioSessao(UserMixin):
+    """
+    Identidade do usuário logado (o que as rotas e templates usam de
+    current_user), desligada da sessão do banco para poder ficar em cache.
+    """
+    def __init__(self, id, nome, cargo, gabinete, ativo):
+        self.id = id
+        self.nome = nome
+        self.cargo = cargo
+        self.gabinete = gabinete
+        self.ativo = ativo
+
+_cache_usuarios = {'itens': {}, 'versao': None, 'lock': threading.Lock()}
+
+def _marcador(nome):
+    return os.path.join(current_app.instance_path, f'{nome}.versao')
+
+def versao_marcador(nome):
+    """mtime do arquivo marcador: muda quando algum processo chama tocar_marcador."""
+    try:
+        return os.stat(_marcador(nome)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def tocar_marcador(nome):
+    """
+    Atualiza o mtime do marcador. Assim a mudança avisa também os outros
+    workers do gunicorn, e os caches deles valem só até a próxima requisição.
+    """
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    marcador = _marcador(nome)
+    with open(marcador, 'a'):
+        pass
+    agora = time.time_ns()
+    os.utime(marcador, ns=(agora, agora))
+
+def invalidar_cache_usuarios():
+    """Chamado quando um usuário é editado, ativado/inativado ou excluído."""
+    tocar_marcador('usuarios')
+    with _cache_usuarios['lock']:
+        _cache_usuarios['itens'].clear()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(Usuario, int(user_id))
+    # Cache com TTL: evita um SELECT de usuário a cada requisição (inclusive fotos)
+    cache = _cache_usuarios
+    versao = versao_marcador('usuarios')
+    agora = time.monotonic()
+    with cache['lock']:
+        if cache['versao'] != versao:
+            cache['itens'].clear()
+            cache['versao'] = versao
+        item = cache['itens'].get(user_id)
+
+    if item and item[0] > agora:
+        identidade = item[1]
+    else:
+        u = db.session.get(Usuario, int(user_id))
+        identidade = UsuarioSessao(u.id, u.nome, u.cargo, u.gabinete, u.ativo) if u else None
+        with cache['lock']:
+            cache['itens'][user_id] = (agora + current_app.config['USUARIOS_CACHE_TTL'], identidade)
+
+    # Usuário inativado perde o acesso na hora, mesmo com sessão aberta
+    if identidade is None or not identidade.ativo:
+        return None
+    return identidade
 
 LISTA_GABINETES = [
     ('Presidência - Charles do Oceano', 'Presidência - Charles do Oceano'),
@@ -93,6 +288,50 @@ class RegistroUso(db.Model):
     veiculo = db.relationship('Veiculo', backref='registros', lazy=True)
     usuario = db.relationship('Usuario', backref='viagens', lazy=True)
 
+    # Índices dos filtros mais usados (bancos antigos recebem via migrar_banco)
+    __table_args__ = (
+        # Viagens em aberto (km_chegada IS NULL): índices parciais, só com as poucas viagens abertas.
+        # O de veículo é único: no máximo uma viagem aberta por carro (checkout atômico).
+        db.Index('ux_registro_uso_aberto_veiculo', 'veiculo_id', unique=True,
+                 sqlite_where=db.text('km_chegada IS NULL'), postgresql_where=db.text('km_chegada IS NULL')),
+        db.Index('ix_registro_uso_aberto_saida', 'data_hora_saida',
+                 sqlite_where=db.text('km_chegada IS NULL'), postgresql_where=db.text('km_chegada IS NULL')),
+        # Viagem aberta do motorista logado (index)
+        db.Index('ix_registro_uso_usuario_chegada', 'usuario_id', 'km_chegada'),
+        # Histórico/exportação: período + ordenação do keyset, com ou sem gabinete/veículo
+        db.Index('ix_registro_uso_saida_id', 'data_hora_saida', 'id'),
+        db.Index('ix_registro_uso_gabinete_saida', 'gabinete_vereador', 'data_hora_saida'),
+        # Linha do tempo de cada veículo, com os KMs: histórico por veículo e conferência do odômetro
+        db.Index('ix_registro_uso_odometro', 'veiculo_id', 'data_hora_saida', 'id', 'km_saida', 'km_chegada'),
+        # Maior KM por veículo (painel e atualizar_km_veiculo)
+        db.Index('ix_registro_uso_veiculo_km_chegada', 'veiculo_id', 'km_chegada'),
+    )
+
+# Fim da viagem: a chegada, ou a saída quando a viagem foi fechada pela edição
+# sem hora de chegada. Chave do keyset do relatório de ocorrências, com índice
+# de expressão (a consulta usa a mesma expressão para o banco aproveitá-lo).
+FIM_VIAGEM = func.coalesce(RegistroUso.data_hora_chegada, RegistroUso.data_hora_saida)
+db.Index('ix_registro_uso_fim', FIM_VIAGEM, RegistroUso.id)
+
+class ResumoDiario(db.Model):
+    """
+    Totais das viagens finalizadas por dia de saída, veículo e gabinete.
+    Mantido em registrar_chegada/editar_viagem (atualizar_resumo_viagem) e
+    reconstruído por `flask reconstruir-resumo`; gráficos e ranking leem daqui.
+    """
+    dia = db.Column(db.Date, primary_key=True)
+    veiculo_id = db.Column(db.Integer, db.ForeignKey('veiculo.id'), primary_key=True)
+    gabinete_vereador = db.Column(db.String(100), primary_key=True)
+    viagens = db.Column(db.Integer, nullable=False, default=0)
+    km_total = db.Column(db.Float, nullable=False, default=0)
+    horas_total = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        # Cobrem os agrupamentos por veículo (gráfico) e por gabinete (ranking)
+        db.Index('ix_resumo_diario_veiculo_dia', 'veiculo_id', 'dia', 'km_total'),
+        db.Index('ix_resumo_diario_gabinete_dia', 'gabinete_vereador', 'dia', 'km_total'),
+    )
+
 # --- FORMULÁRIOS ---
 class CadastroUsuarioForm(FlaskForm):
     nome = StringField('Nome Completo', validators=[DataRequired()])
@@ -121,9 +360,15 @@ class VeiculoForm(FlaskForm):
     placa = StringField('Placa', validators=[DataRequired(), Length(min=7, max=8)])
     submit = SubmitField('Salvar Veículo')
 
+class ImportacaoForm(FlaskForm):
+    tipo = SelectField('Conteúdo', choices=[('viagens', 'Viagens'), ('veiculos', 'Veículos')], validators=[DataRequired()])
+    arquivo = FileField('Planilha', validators=[FileRequired(), FileAllowed(['csv', 'xlsx'])])
+    simular = BooleanField('Só validar (não grava)')
+    submit = SubmitField('Importar')
+
 class FotoOcorrencia(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    registro_id = db.Column(db.Integer, db.ForeignKey('registro_uso.id'), nullable=False)
+    registro_id = db.Column(db.Integer, db.ForeignKey('registro_uso.id'), nullable=False, index=True)
     caminho_foto = db.Column(db.String(255), nullable=False)
     
     # Relacionamento para facilitar a busca
@@ -131,194 +376,1494 @@ class FotoOcorrencia(db.Model):
 
 
 
+class FotoPendente(db.Model):
+    """Foto recebida cujo JPEG de 800px ainda está sendo gerado em segundo plano."""
+    nome_arquivo = db.Column(db.String(255), primary_key=True)
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+    erro = db.Column(db.String(255), nullable=True)
+    # Worker ('host:pid') cujo pool está gerando o JPEG; outro worker só retoma a foto se ele morreu
+    dono = db.Column(db.String(100), nullable=True)
+
+class ConteudoFoto(db.Model):
+    """
+    Arquivo físico de uma foto, guardado pelo SHA-256 do conteúdo na chave
+    <aa>/<bb>/<sha256><extensao> do armazenamento (uploads/objetos/ ou o
+    bucket S3, ver armazenamento()). Fotos iguais (a mesma
+    imagem enviada várias vezes) ocupam um único arquivo; 'referencias'
+    conta quantos nomes (ArquivoFoto) apontam para ele.
+    """
+    sha256 = db.Column(db.String(64), primary_key=True)
+    extensao = db.Column(db.String(10), nullable=False, default='.jpg')
+    tamanho = db.Column(db.Integer, nullable=False)
+    referencias = db.Column(db.Integer, nullable=False, default=0)
+
+class ArquivoFoto(db.Model):
+    """
+    Nome gravado em RegistroUso/FotoOcorrencia -> conteúdo. Os nomes (inclusive
+    os antigos, de antes do armazenamento por conteúdo) continuam valendo nas URLs.
+    """
+    nome = db.Column(db.String(255), primary_key=True)
+    sha256 = db.Column(db.String(64), db.ForeignKey('conteudo_foto.sha256'), nullable=False, index=True)
+
+class TarefaRelatorio(db.Model):
+    """
+    Pedido de relatório na fila (ver enfileirar_relatorio). O worker gera o
+    arquivo em RELATORIOS_PASTA, que fica disponível para download até
+    expira_em. status: pendente -> executando -> concluido/erro -> expirado.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), nullable=False)
+    filtros = db.Column(db.String(500), nullable=False, default='{}')
+    # SHA-256 de tipo + filtros: pedidos iguais têm a mesma chave
+    chave = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pendente')
+    solicitante_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    iniciado_em = db.Column(db.DateTime, nullable=True)
+    # Batimento do worker enquanto gera o arquivo (ver executar_tarefa_relatorio)
+    atualizado_em = db.Column(db.DateTime, nullable=True)
+    concluido_em = db.Column(db.DateTime, nullable=True)
+    expira_em = db.Column(db.DateTime, nullable=True)
+    # Também identifica a execução: só quem reservou a tentativa atual grava o resultado
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    arquivo = db.Column(db.String(255), nullable=True)
+    tamanho = db.Column(db.Integer, nullable=True)
+    erro = db.Column(db.String(255), nullable=True)
+
+    solicitante = db.relationship('Usuario', lazy=True)
+
+    __table_args__ = (
+        # Deduplicação: no máximo uma tarefa na fila ou rodando por pedido (tipo + filtros)
+        db.Index('ux_tarefa_relatorio_ativa', 'chave', unique=True,
+                 sqlite_where=db.text("status IN ('pendente', 'executando')"),
+                 postgresql_where=db.text("status IN ('pendente', 'executando')")),
+        # Próxima da fila e limpeza dos resultados vencidos
+        db.Index('ix_tarefa_relatorio_status', 'status', 'expira_em'),
+    )
+
+
+
 # --- FUNÇÕES AUXILIARES ---
-def salvar_foto_compacta(foto_campo, prefixo):
+# Orientação EXIF -> transposição (Image.Transpose) que deixa a foto em pé.
+# Pelo nome: o Pillow só é importado quando há foto para processar.
+ROTACOES_EXIF = {
+    2: 'FLIP_LEFT_RIGHT',
+    3: 'ROTATE_180',
+    4: 'FLIP_TOP_BOTTOM',
+    5: 'TRANSPOSE',
+    6: 'ROTATE_270',
+    7: 'TRANSVERSE',
+    8: 'ROTATE_90',
+}
+
+def compactar_imagem(origem, destino, lado=800):
+    """
+    Gera o JPEG reduzido (800px, qualidade 50) a partir da imagem original.
+
+    Fotos de celular têm 12-50 MP; decodificá-las inteiras só para reduzir a
+    800px desperdiça CPU e memória. Por isso a redução acontece antes de
+    qualquer conversão de modo:
+    - JPEG: draft() faz o decoder entregar a imagem já em 1/2, 1/4 ou 1/8,
+      na menor escala que ainda fica acima de 800px;
+    - demais formatos (PNG de print de tela): thumbnail() usa reduce() antes
+      do filtro final, e a conversão para RGB é feita já em 800px.
+    """
+    from PIL import Image, ExifTags
+    img = Image.open(origem)
+    # Também vale para fotos que não passaram por inspecionar_foto (pool, CLI)
+    if img.width * img.height > current_app.config['FOTOS_MAX_PIXELS']:
+        raise ValueError(f"imagem com pixels demais ({img.width}x{img.height})")
+
+    # Orientação EXIF lida antes da redução (a foto do odômetro não fica deitada)
+    orientacao = img.getexif().get(ExifTags.Base.Orientation, 1)
+
+    if img.format == 'JPEG':
+        img.draft('RGB', (lado, lado))
+    elif img.mode == 'P':
+        # Paleta não pode ser reamostrada com filtro; converte mantendo a transparência
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+
+    # REDUÇÃO: 800px é perfeito para ler odômetro e o arquivo fica levíssimo
+    img.thumbnail((lado, lado), reducing_gap=2.0)
+
+    if orientacao in ROTACOES_EXIF:
+        img = img.transpose(getattr(Image.Transpose, ROTACOES_EXIF[orientacao]))
+
+    # Converte para RGB (necessário para JPEG), com fundo branco onde havia transparência
+    if img.mode in ('RGBA', 'LA'):
+        fundo = Image.new('RGB', img.size, 'white')
+        fundo.paste(img, mask=img.getchannel('A'))
+        img = fundo
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    # VELOCIDADE: Removi o optimize=True e baixei a qualidade para 50.
+    # Isso faz o salvamento ser quase instantâneo no Render.
+    img.save(destino, "JPEG", quality=50)
+
+def processar_foto_bruta(caminho_bruto):
+    """
+    Executado no pool de processos: compacta o arquivo bruto, guarda o JPEG
+    pelo conteúdo e remove o bruto. Devolve (sha256, tamanho, duração), ou
+    None se outro worker já processou. O registro no banco fica com quem
+    chamou (registrar_foto), já que o pool não tem sessão.
+    """
+    if not os.path.exists(caminho_bruto):
+        return None  # outro worker já processou
+    temporario = f"{caminho_bruto}.{os.getpid()}.tmp"
+    inicio = time.perf_counter()
+    compactar_imagem(caminho_bruto, temporario)
+    duracao = time.perf_counter() - inicio
+    digest, tamanho = guardar_conteudo(temporario)
     try:
-        if not foto_campo:
-            return None
-            
-        filename = secure_filename(foto_campo.filename)
-        nome_final = f"{prefixo}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-        caminho_completo = os.path.join(app.config['UPLOAD_FOLDER'], nome_final)
-        
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        
-        # Abre a imagem
-        img = Image.open(foto_campo)
-        
-        # Converte para RGB (necessário para JPEG)
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-        
-        # REDUÇÃO: 800px é perfeito para ler odômetro e o arquivo fica levíssimo
-        img.thumbnail((800, 800))
-        
-        # VELOCIDADE: Removi o optimize=True e baixei a qualidade para 50.
-        # Isso faz o salvamento ser quase instantâneo no Render.
-        img.save(caminho_completo, "JPEG", quality=50)
-        
-        return nome_final
-    except Exception as e:
-        print(f"[ERRO]: {e}")
+        os.remove(caminho_bruto)
+    except FileNotFoundError:
+        pass
+    return digest, tamanho, duracao
+
+def sha256_arquivo(caminho):
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1 << 16), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+# Formato das chaves criadas por chave_objeto (a limpeza só apaga o que casa com ele)
+CHAVE_OBJETO_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$')
+
+def chave_objeto(digest, extensao='.jpg'):
+    # Dois níveis de subpasta (256 x 256): nenhuma pasta cresce sem limite
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{extensao}"
+
+class ArmazenamentoLocal:
+    """Objetos em pastas do disco local (UPLOAD_FOLDER/objetos)."""
+    def __init__(self, pasta):
+        self.pasta = pasta
+
+    def caminho(self, chave):
+        return os.path.join(self.pasta, *chave.split('/'))
+
+    def existe(self, chave):
+        return os.path.isfile(self.caminho(chave))
+
+    def guardar(self, origem, chave, mover=True):
+        """Com mover=False o original fica onde está (hard link, ou cópia se o link não for possível)."""
+        destino = self.caminho(chave)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        if mover:
+            os.replace(origem, destino)
+            return
+        temporario = f"{destino}.{os.getpid()}.tmp"
+        try:
+            os.link(origem, temporario)
+        except OSError:
+            shutil.copy2(origem, temporario)
+        os.replace(temporario, destino)
+
+    def remover(self, chave):
+        try:
+            os.remove(self.caminho(chave))
+        except FileNotFoundError:
+            pass
+
+    def listar(self):
+        """(chave, tamanho, modificado em - timestamp) de cada objeto."""
+        for raiz, _, arquivos in os.walk(self.pasta):
+            for nome in arquivos:
+                if not nome.endswith('.tmp'):
+                    caminho = os.path.join(raiz, nome)
+                    info = os.stat(caminho)
+                    yield os.path.relpath(caminho, self.pasta).replace(os.sep, '/'), info.st_size, info.st_mtime
+
+    def resposta(self, chave, **kwargs):
+        if not self.existe(chave):
+            abort(404)
+        return enviar_arquivo(self.caminho(chave), **kwargs)
+
+    @contextmanager
+    def arquivo_local(self, chave):
+        yield self.caminho(chave)
+
+class ArmazenamentoS3:
+    """
+    Objetos num bucket S3 ou compatível (MinIO, moto: S3_ENDPOINT_URL).
+    Envio em partes (multipart) a partir de S3_MULTIPART_MB; leitura por
+    redirecionamento para uma URL pré-assinada, sem os bytes passarem pelo Flask.
+    As credenciais vêm do ambiente padrão da AWS (AWS_ACCESS_KEY_ID etc.).
+    """
+    def __init__(self, bucket, prefixo='', endpoint_url=None, regiao=None, expira=300, multipart_mb=8):
+        import boto3  # só é necessário com ARMAZENAMENTO=s3
+        from boto3.s3.transfer import TransferConfig
+        self.bucket = bucket
+        self.prefixo = prefixo
+        self.expira = expira
+        self.cliente = boto3.client('s3', endpoint_url=endpoint_url or None, region_name=regiao or None)
+        self.transferencia = TransferConfig(multipart_threshold=multipart_mb * 1024 * 1024,
+                                            multipart_chunksize=multipart_mb * 1024 * 1024)
+
+    def existe(self, chave):
+        from botocore.exceptions import ClientError
+        try:
+            self.cliente.head_object(Bucket=self.bucket, Key=self.prefixo + chave)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def guardar(self, origem, chave, mover=True):
+        # upload_file lê o arquivo em blocos e usa multipart acima do limite
+        self.cliente.upload_file(origem, self.bucket, self.prefixo + chave, Config=self.transferencia, ExtraArgs={
+            'ContentType': mimetypes.guess_type(chave)[0] or 'application/octet-stream',
+            # A chave é o hash do conteúdo: o objeto nunca muda
+            'CacheControl': 'private, max-age=31536000, immutable',
+        })
+        if mover:
+            os.remove(origem)
+
+    def remover(self, chave):
+        self.cliente.delete_object(Bucket=self.bucket, Key=self.prefixo + chave)
+
+    def listar(self):
+        paginas = self.cliente.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefixo)
+        for pagina in paginas:
+            for objeto in pagina.get('Contents', []):
+                yield objeto['Key'][len(self.prefixo):], objeto['Size'], objeto['LastModified'].timestamp()
+
+    def resposta(self, chave, as_attachment=False, download_name=None, **kwargs):
+        parametros = {'Bucket': self.bucket, 'Key': self.prefixo + chave}
+        if as_attachment:
+            parametros['ResponseContentDisposition'] = f'attachment; filename="{download_name or chave.rsplit("/", 1)[-1]}"'
+        url = self.cliente.generate_presigned_url('get_object', Params=parametros, ExpiresIn=self.expira)
+        resposta = redirect(url)
+        # O redirecionamento pode ser reaproveitado pelo navegador enquanto a URL vale
+        resposta.cache_control.private = True
+        resposta.cache_control.max_age = self.expira // 2
+        return resposta
+
+    @contextmanager
+    def arquivo_local(self, chave):
+        """Baixa o objeto para um temporário (usado para gerar miniaturas)."""
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(chave)[1]) as temporario:
+            self.cliente.download_fileobj(self.bucket, self.prefixo + chave, temporario)
+            temporario.flush()
+            yield temporario.name
+
+_armazenamento = {'pid': None, 'backend': None}
+
+def armazenamento():
+    """
+    Backend de ARMAZENAMENTO ('local' ou 's3'), um por processo: o pool de
+    fotos usa processos filhos, e o cliente do boto3 não pode ser herdado no fork.
+    """
+    if _armazenamento['pid'] != os.getpid():
+        if current_app.config['ARMAZENAMENTO'] == 's3':
+            backend = ArmazenamentoS3(current_app.config['S3_BUCKET'], current_app.config['S3_PREFIXO'], current_app.config['S3_ENDPOINT_URL'],
+                                      current_app.config['S3_REGIAO'], current_app.config['S3_URL_EXPIRA'], current_app.config['S3_MULTIPART_MB'])
+        else:
+            backend = ArmazenamentoLocal(os.path.join(current_app.config['UPLOAD_FOLDER'], 'objetos'))
+        _armazenamento.update(pid=os.getpid(), backend=backend)
+    return _armazenamento['backend']
+
+def guardar_conteudo(caminho, extensao='.jpg', mover=True):
+    """
+    Coloca o arquivo no armazenamento por conteúdo e devolve (sha256, tamanho).
+    Se o conteúdo já existe, a cópia nova é descartada (mover=True) ou
+    deixada onde está (mover=False).
+    """
+    digest = sha256_arquivo(caminho)
+    tamanho = os.path.getsize(caminho)
+    chave = chave_objeto(digest, extensao)
+    if armazenamento().existe(chave):
+        if mover:
+            os.remove(caminho)
+    else:
+        armazenamento().guardar(caminho, chave, mover=mover)
+    return digest, tamanho
+
+def insert_dialeto():
+    """insert() do dialeto do banco: o ON CONFLICT é específico de cada um."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+def registrar_foto(nome, digest, tamanho, extensao='.jpg'):
+    registrar_fotos([(nome, digest, tamanho)], extensao)
+
+def registrar_fotos(fotos, extensao='.jpg'):
+    """
+    Liga cada nome ao seu conteúdo e soma as referências, na transação atual
+    (antes do commit). fotos = [(nome, sha256, tamanho)]. Um upsert em lote
+    para os conteúdos (o ON CONFLICT evita a corrida de dois processos
+    guardando a mesma foto nova ao mesmo tempo) e os nomes num insert só.
+    """
+    if not fotos:
+        return
+    insert = insert_dialeto()
+    conteudos = {}
+    for _, digest, tamanho in fotos:
+        linha = conteudos.setdefault(digest, {'sha256': digest, 'extensao': extensao, 'tamanho': tamanho, 'referencias': 0})
+        linha['referencias'] += 1
+    tabela = ConteudoFoto.__table__
+    comando = insert(tabela)
+    db.session.execute(
+        comando.on_conflict_do_update(index_elements=['sha256'],
+                                      set_={'referencias': tabela.c.referencias + comando.excluded.referencias}),
+        list(conteudos.values()),
+    )
+    db.session.add_all([ArquivoFoto(nome=nome, sha256=digest) for nome, digest, _ in fotos])
+    # Se a transação for desfeita, os objetos que acabaram de ser guardados ficariam órfãos
+    db.session.info.setdefault('conteudos_registrados', set()).update((digest, extensao) for digest in conteudos)
+
+def remover_objetos_sem_uso(conteudos):
+    """
+    Apaga do armazenamento os objetos [(sha256, extensao)] que não têm linha em
+    ConteudoFoto. Chamado depois do commit/rollback, numa conexão própria: se
+    um envio da mesma foto religou o conteúdo nesse meio tempo, o objeto fica.
+    """
+    if not conteudos:
+        return
+    with db.engine.connect() as conn:
+        em_uso = {digest for (digest,) in conn.execute(
+            db.select(ConteudoFoto.sha256).where(ConteudoFoto.sha256.in_([digest for digest, _ in conteudos])))}
+    for digest, extensao in conteudos:
+        if digest not in em_uso:
+            armazenamento().remover(chave_objeto(digest, extensao))
+
+def pasta_brutos():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'brutos')
+
+_fila_fotos = {'pool': None, 'threads': None, 'em_execucao': 0, 'aguardando': deque(), 'lock': threading.Lock(), 'retomada': False}
+
+def _iniciar_processo_fotos(config):
+    """
+    Initializer do pool de processos: compactar_imagem e armazenamento() leem
+    current_app.config, então cada processo filho ganha um app só com a configuração.
+    """
+    app = Flask(__name__)
+    app.config.update(config)
+    app.app_context().push()
+
+def _pool_fotos():
+    """Pool de processos criado sob demanda (um por worker do gunicorn)."""
+    if _fila_fotos['pool'] is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _fila_fotos['pool'] = ProcessPoolExecutor(max_workers=current_app.config['FOTOS_PROCESSOS'],
+                                                  initializer=_iniciar_processo_fotos,
+                                                  initargs=(dict(current_app.config),))
+    return _fila_fotos['pool']
+
+def enfileirar_fotos(nomes):
+    """
+    Manda fotos brutas para o pool. No máximo FOTOS_PROCESSOS * 2 ficam em
+    execução; o restante espera numa fila local (só os nomes, não os bytes).
+    """
+    fila = _fila_fotos
+    with fila['lock']:
+        fila['aguardando'].extend(nomes)
+        while fila['aguardando'] and fila['em_execucao'] < current_app.config['FOTOS_PROCESSOS'] * 2:
+            nome = fila['aguardando'].popleft()
+            futuro = _pool_fotos().submit(processar_foto_bruta, os.path.join(pasta_brutos(), nome))
+            fila['em_execucao'] += 1
+            futuro.add_done_callback(partial(_foto_processada, current_app._get_current_object(), nome))
+
+def _foto_processada(app, nome, futuro):
+    """Callback do pool: registra o conteúdo e tira a foto da lista de pendentes (ou registra o erro)."""
+    erro = futuro.exception()
+    resultado = None if erro else futuro.result()
+    with _fila_fotos['lock']:
+        _fila_fotos['em_execucao'] -= 1
+    # Roda numa thread do pool, fora de qualquer requisição
+    with app.app_context():
+        concluir_foto_pendente(nome, resultado, erro)
+        if resultado:
+            registrar_tempo_fora_de_requisicao('fotos_segundo_plano', resultado[2])
+        enfileirar_fotos([])
+
+def concluir_foto_pendente(nome, resultado, erro=None):
+    """
+    Registra o conteúdo gerado e tira a foto das pendentes (ou grava o erro).
+    O registro não depende da linha pendente: se outra execução da mesma foto
+    já a removeu, o resultado desta ainda é gravado. Resultado None (o bruto
+    sumiu: outra execução está com a foto) não mexe na pendência, que fica
+    para essa outra execução concluir.
+    """
+    pendente = db.session.get(FotoPendente, nome)
+    if erro:
+        print(f"[ERRO] processamento da foto {nome}: {erro}")
+        if pendente:
+            pendente.erro = str(erro)[:255]
+    elif resultado or db.session.get(ArquivoFoto, nome):
+        if resultado and not db.session.get(ArquivoFoto, nome):
+            registrar_foto(nome, *resultado[:2])
+        if pendente:
+            db.session.delete(pendente)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Outro worker processou e registrou a mesma foto primeiro
+        db.session.rollback()
+
+def identificador_worker():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _dono_ativo(pendente):
+    """O worker dono da foto pendente ainda pode estar processando?"""
+    if not pendente.dono or pendente.dono == identificador_worker():
+        # Sem dono, ou com o pid deste processo herdado de uma execução anterior
+        return False
+    host, _, pid = pendente.dono.rpartition(':')
+    # No Windows, os.kill(pid, 0) encerraria o processo: lá vale só o tempo
+    if host == socket.gethostname() and os.name != 'nt':
+        try:
+            os.kill(int(pid), 0)
+        except (ProcessLookupError, ValueError):
+            return False
+        except PermissionError:
+            pass  # existe, mas é de outro usuário
+        return True
+    return pendente.criado_em > datetime.now() - timedelta(seconds=current_app.config['FOTOS_RETOMAR_APOS'])
+
+def assumir_fotos_pendentes():
+    """
+    Passa para este processo as fotos pendentes cujo dono morreu (ex.: reinício
+    do servidor) e devolve os nomes. Fotos de um worker vivo ficam com ele. A
+    troca de dono é condicional (UPDATE ... WHERE dono = o lido): dois workers
+    retomando ao mesmo tempo não pegam a mesma foto.
+    """
+    eu = identificador_worker()
+    nomes = []
+    for pendente in FotoPendente.query.filter_by(erro=None).all():
+        if _dono_ativo(pendente) or not os.path.exists(os.path.join(pasta_brutos(), pendente.nome_arquivo)):
+            continue
+        assumiu = db.session.execute(
+            db.update(FotoPendente)
+            .where(FotoPendente.nome_arquivo == pendente.nome_arquivo,
+                   FotoPendente.dono.is_not_distinct_from(pendente.dono))
+            .values(dono=eu)
+        ).rowcount
+        if assumiu:
+            nomes.append(pendente.nome_arquivo)
+    db.session.commit()
+    return nomes
+
+def reenfileirar_fotos_pendentes():
+    """Retoma fotos que ficaram pendentes (ex.: reinício do servidor)."""
+    nomes = assumir_fotos_pendentes()
+    if nomes:
+        enfileirar_fotos(nomes)
+
+@principal.before_app_request
+def _retomar_fotos_pendentes():
+    # Uma vez por processo: fotos pendentes de uma execução anterior voltam ao pool
+    if current_app.config['FOTOS_EM_SEGUNDO_PLANO'] and not _fila_fotos['retomada']:
+        _fila_fotos['retomada'] = True
+        reenfileirar_fotos_pendentes()
+
+@event.listens_for(db.session, 'after_commit')
+def _despachar_fotos_novas(session):
+    # Só envia ao pool depois do commit, quando a linha FotoPendente já existe
+    session.info.pop('conteudos_registrados', None)
+    nomes = session.info.pop('fotos_novas', None)
+    if nomes:
+        enfileirar_fotos(nomes)
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_fotos_novas(session):
+    session.info.pop('fotos_novas', None)
+    session.info.pop('resumo_alterado', None)
+    # Fotos compactadas nesta transação (modo síncrono) cujo conteúdo não chegou
+    # ao banco; a remoção espera a sessão devolver a conexão ao pool
+    descartados = session.info.pop('conteudos_registrados', None)
+    if descartados:
+        session.info.setdefault('conteudos_descartados', set()).update(descartados)
+
+@event.listens_for(db.session, 'after_transaction_end')
+def _remover_conteudos_descartados(session, transacao):
+    # Aqui a conexão da sessão já voltou ao pool: a consulta de
+    # remover_objetos_sem_uso não disputa o pool com ela mesma
+    if transacao.parent is None:
+        remover_objetos_sem_uso(session.info.pop('conteudos_descartados', None))
+
+class _UploadLimitado:
+    """
+    Destino de um arquivo do multipart enquanto o Werkzeug lê o corpo. Passou
+    de 'limite' bytes, para de gravar e descarta o resto do campo: a foto
+    grande demais não chega a ocupar memória nem disco, e a rota recusa só ela.
+    """
+    def __init__(self, limite):
+        self.limite = limite
+        self.recebidos = 0
+        self.excedeu = False
+        # Até 1 MB em memória; acima disso o Python passa para um temporário
+        self.arquivo = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
+    def write(self, dados):
+        self.recebidos += len(dados)
+        if self.recebidos > self.limite:
+            if not self.excedeu:
+                self.excedeu = True
+                self.arquivo.seek(0)
+                self.arquivo.truncate()
+            return len(dados)
+        return self.arquivo.write(dados)
+
+    def __getattr__(self, nome):
+        return getattr(self.arquivo, nome)
+
+class RequisicaoFrota(Request):
+    """Nas rotas com fotos, cada arquivo do multipart é limitado a FOTOS_MAX_MB enquanto chega."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in ROTAS_COM_FOTOS:
+            return _UploadLimitado(current_app.config['FOTOS_MAX_MB'] * 1024 * 1024)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+ROTAS_COM_FOTOS = {'principal.registrar_saida', 'principal.registrar_chegada'}
+
+def inspecionar_foto(arquivo):
+    """
+    Confere a foto antes de qualquer decodificação: tamanho (medido durante o
+    upload) e pixels (lidos só do cabeçalho). Devolve o motivo da recusa, ou
+    None se a foto pode ser processada.
+    """
+    if getattr(arquivo.stream, 'excedeu', False):
+        return f"maior que {current_app.config['FOTOS_MAX_MB']} MB"
+    from PIL import Image
+    try:
+        # Image.open só lê o cabeçalho; os pixels ficam para compactar_imagem
+        largura, altura = Image.open(arquivo.stream).size
+    except Image.DecompressionBombError:
+        return "imagem com pixels demais"
+    except Exception:
+        return "arquivo não é uma imagem reconhecida"
+    finally:
+        arquivo.stream.seek(0)
+    if largura * altura > current_app.config['FOTOS_MAX_PIXELS']:
+        return f"imagem com pixels demais ({largura}x{altura})"
+    return None
+
+def _entrar_no_app(app):
+    # Initializer do pool de threads: cada thread fica com um contexto do app
+    app.app_context().push()
+
+def _pool_threads_fotos():
+    """Threads para compactar as fotos de um envio em paralelo (o Pillow libera o GIL ao decodificar e reduzir)."""
+    if _fila_fotos['threads'] is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _fila_fotos['threads'] = ThreadPoolExecutor(max_workers=current_app.config['FOTOS_PROCESSOS'], thread_name_prefix='fotos',
+                                                    initializer=_entrar_no_app,
+                                                    initargs=(current_app._get_current_object(),))
+    return _fila_fotos['threads']
+
+def _compactar_e_guardar(arquivo, nome):
+    temporario = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{nome}.tmp")
+    try:
+        compactar_imagem(arquivo.stream, temporario)
+    except Exception:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+    return guardar_conteudo(temporario)
+
+def salvar_fotos(envios):
+    """
+    Salva todas as fotos de um envio de uma vez. envios = [(FileStorage,
+    prefixo)]; devolve, na mesma ordem, (nome gravado, None) ou (None, motivo)
+    para avisar o motorista do que não foi aceito.
+
+    Tamanho e pixels são conferidos antes de decodificar (inspecionar_foto).
+    Em segundo plano, os brutos vão juntos para o pool de processos depois do
+    commit; sem ele, as fotos são compactadas em paralelo por threads. As
+    linhas de FotoPendente/ArquivoFoto entram no mesmo insert em lote.
+    """
+    resultados = [None] * len(envios)
+    aceitas = []
+    for i, (arquivo, prefixo) in enumerate(envios):
+        if not arquivo or not arquivo.filename:
+            resultados[i] = (None, "nenhum arquivo enviado")
+            continue
+        if len(aceitas) >= current_app.config['FOTOS_POR_ENVIO']:
+            resultados[i] = (None, f"limite de {current_app.config['FOTOS_POR_ENVIO']} fotos por envio")
+            continue
+        motivo = inspecionar_foto(arquivo)
+        if motivo:
+            resultados[i] = (None, motivo)
+            continue
+        # O sufixo aleatório evita que dois envios no mesmo segundo com o mesmo
+        # nome de arquivo (ex.: image.jpg do celular) sobrescrevam um ao outro
+        nome = f"{prefixo}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{secrets.token_hex(3)}_{secure_filename(arquivo.filename)}"
+        aceitas.append((i, arquivo, nome))
+    if not aceitas:
+        return resultados
+
+    if current_app.config['FOTOS_EM_SEGUNDO_PLANO']:
+        # Grava só os bytes brutos e marca as fotos como pendentes; os JPEGs de
+        # 800px são gerados pelo pool de processos após o commit
+        os.makedirs(pasta_brutos(), exist_ok=True)
+        nomes = []
+        for i, arquivo, nome in aceitas:
+            try:
+                arquivo.save(os.path.join(pasta_brutos(), nome))
+            except OSError as e:
+                print(f"[ERRO] gravação da foto {arquivo.filename}: {e}")
+                resultados[i] = (None, "erro ao gravar o arquivo")
+                continue
+            resultados[i] = (nome, None)
+            nomes.append(nome)
+        db.session.add_all([FotoPendente(nome_arquivo=nome, dono=identificador_worker()) for nome in nomes])
+        db.session.info.setdefault('fotos_novas', []).extend(nomes)
+        return resultados
+
+    os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    registros = []
+    with medir_pillow():
+        if len(aceitas) == 1:
+            _, arquivo, nome = aceitas[0]
+            futuros = [(aceitas[0], partial(_compactar_e_guardar, arquivo, nome))]
+        else:
+            pool = _pool_threads_fotos()
+            futuros = [(item, pool.submit(_compactar_e_guardar, item[1], item[2]).result) for item in aceitas]
+        for (i, arquivo, nome), resultado in futuros:
+            try:
+                digest, tamanho = resultado()
+            except Exception as e:
+                print(f"[ERRO] processamento da foto {arquivo.filename}: {e}")
+                resultados[i] = (None, "não foi possível processar a imagem")
+                continue
+            resultados[i] = (nome, None)
+            registros.append((nome, digest, tamanho))
+    registrar_fotos(registros)
+    return resultados
+
+def resumo_falhas(falhas):
+    """'a.jpg (maior que 15 MB); b.heic (...)' para a mensagem ao motorista."""
+    return '; '.join(f"{nome} ({motivo})" for nome, motivo in falhas)
+
+def enviar_arquivo(caminho, imutavel=True, **kwargs):
+    """
+    Envia um arquivo de UPLOAD_FOLDER com cache HTTP.
+
+    Os nomes das fotos levam data/hora e nunca são reaproveitados, então a
+    resposta pode ficar no navegador por um ano (immutable). O send_file já
+    cuida do ETag forte (mtime + tamanho), de If-None-Match/If-Modified-Since
+    (304) e de Range (206). Com ARQUIVOS_VIA_PROXY o Python não envia os
+    bytes: 'x-sendfile' (Apache/lighttpd) ou 'x-accel' (nginx, location
+    interna em X_ACCEL_PREFIXO apontando para UPLOAD_FOLDER).
+    """
+    if current_app.config['ARQUIVOS_VIA_PROXY'] == 'x-accel':
+        relativo = os.path.relpath(caminho, current_app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        resposta = make_response('')
+        resposta.headers['X-Accel-Redirect'] = current_app.config['X_ACCEL_PREFIXO'] + quote(relativo)
+        resposta.mimetype = kwargs.get('mimetype') or mimetypes.guess_type(caminho)[0] or 'application/octet-stream'
+        if kwargs.get('as_attachment'):
+            resposta.headers['Content-Disposition'] = f"attachment; filename=\"{kwargs.get('download_name') or os.path.basename(caminho)}\""
+    else:
+        resposta = send_file(caminho, conditional=True, etag=True, **kwargs)
+
+    if imutavel:
+        resposta.cache_control.no_cache = None
+        resposta.cache_control.private = True
+        resposta.cache_control.max_age = 365 * 24 * 3600
+        resposta.cache_control.immutable = True
+    else:
+        resposta.cache_control.no_cache = True
+    return resposta
+
+@lru_cache(maxsize=8192)
+def _conteudo_da_foto(nome):
+    """(sha256, extensão) do nome; KeyError se não houver (o lru_cache não guarda exceções)."""
+    conteudo = (db.session.query(ConteudoFoto.sha256, ConteudoFoto.extensao)
+                .join(ArquivoFoto, ArquivoFoto.sha256 == ConteudoFoto.sha256)
+                .filter(ArquivoFoto.nome == nome).first())
+    if conteudo is None:
+        raise KeyError(nome)
+    return tuple(conteudo)
+
+def chave_da_foto(filename):
+    """Chave da foto no armazenamento por conteúdo, ou None (solta/pendente)."""
+    try:
+        return chave_objeto(*_conteudo_da_foto(filename))
+    except KeyError:
         return None
 
+def caminho_da_foto(filename):
+    """
+    Foto ainda fora do armazenamento por conteúdo: arquivo solto em uploads/
+    (não migrado) ou, se ainda pendente, o bruto. Sempre no disco local.
+    """
+    for pasta in (current_app.config['UPLOAD_FOLDER'], pasta_brutos()):
+        caminho = safe_join(pasta, filename)
+        if caminho and os.path.isfile(caminho):
+            return caminho
+    return None
+
+def descartar_foto(nome):
+    """
+    Apaga uma foto cuja viagem não chegou a ser gravada (chamado depois do
+    rollback). Se o nome já estava ligado a um conteúdo, tira a referência
+    e apaga o arquivo quando ninguém mais usa.
+    """
+    if not nome:
+        return
+    ligacao = db.session.get(ArquivoFoto, nome)
+    if ligacao:
+        digest = ligacao.sha256
+        extensao = db.session.query(ConteudoFoto.extensao).filter_by(sha256=digest).scalar()
+        db.session.delete(ligacao)
+        db.session.flush()
+        # Decremento e exclusão no próprio banco, na mesma transação: um envio
+        # simultâneo da mesma foto (upsert em registrar_fotos) não se perde e
+        # a linha só sai se a contagem ainda for zero
+        tabela = ConteudoFoto.__table__
+        db.session.execute(tabela.update().where(tabela.c.sha256 == digest)
+                           .values(referencias=tabela.c.referencias - 1))
+        sem_uso = db.session.execute(tabela.delete().where(tabela.c.sha256 == digest,
+                                                           tabela.c.referencias <= 0)).rowcount
+        db.session.commit()
+        _conteudo_da_foto.cache_clear()
+        if sem_uso:
+            remover_objetos_sem_uso([(digest, extensao)])
+    for pasta in (current_app.config['UPLOAD_FOLDER'], pasta_brutos()):
+        try:
+            os.remove(os.path.join(pasta, nome))
+        except FileNotFoundError:
+            pass
+
+def fotos_em_processamento():
+    """Nomes das fotos ainda pendentes (uma consulta por requisição, usada nos templates)."""
+    if 'fotos_em_processamento' not in g:
+        g.fotos_em_processamento = {nome for (nome,) in db.session.query(FotoPendente.nome_arquivo).filter_by(erro=None)}
+    return g.fotos_em_processamento
+
+def filtros_registros(args):
+    """Monta as condições SQL dos filtros de período, gabinete e veículo."""
+    condicoes = []
+    f_inicio = args.get('data_inicio')
+    f_fim = args.get('data_fim')
+    f_gabinete = args.get('gabinete')
+    f_veiculo = args.get('veiculo')
+
+    if f_inicio:
+        dt_ini = datetime.strptime(f_inicio, '%Y-%m-%d')
+        condicoes.append(RegistroUso.data_hora_saida >= dt_ini)
+    if f_fim:
+        dt_fim = datetime.strptime(f_fim, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+        condicoes.append(RegistroUso.data_hora_saida <= dt_fim)
+    if f_gabinete:
+        condicoes.append(RegistroUso.gabinete_vereador == f_gabinete)
+    if f_veiculo:
+        condicoes.append(RegistroUso.veiculo_id == int(f_veiculo))
+    return condicoes
+
+def ler_cursor(valor):
+    """Converte o cursor 'data_iso_id' da URL em (data, id)."""
+    if not valor:
+        return None
+    try:
+        data_txt, id_txt = valor.rsplit('_', 1)
+        return datetime.fromisoformat(data_txt), int(id_txt)
+    except ValueError:
+        return None
+
+def montar_cursor(data, id):
+    return f"{data.isoformat()}_{id}"
+
+def paginar_keyset(query, coluna_data, valor_cursor, por_pagina, valor_data=None):
+    """
+    Página de registros em ordem decrescente de (coluna_data, id), começando
+    depois do cursor. Devolve (registros, proximo_cursor, tinha_cursor).
+    coluna_data pode ser uma expressão (ex.: FIM_VIAGEM); valor_data(registro)
+    dá o valor dela no último registro da página, para montar o cursor.
+    """
+    cursor = ler_cursor(valor_cursor)
+    if cursor:
+        data_cursor, id_cursor = cursor
+        query = query.filter(or_(
+            coluna_data < data_cursor,
+            and_(coluna_data == data_cursor, RegistroUso.id < id_cursor)
+        ))
+    registros = query.order_by(coluna_data.desc(), RegistroUso.id.desc()).limit(por_pagina + 1).all()
+
+    proximo_cursor = None
+    if len(registros) > por_pagina:
+        registros = registros[:por_pagina]
+        ultimo = registros[-1]
+        data = valor_data(ultimo) if valor_data else getattr(ultimo, coluna_data.key)
+        proximo_cursor = montar_cursor(data, ultimo.id)
+    return registros, proximo_cursor, cursor is not None
+
+def atualizar_km_veiculo(veiculo_id):
+    """
+    Grava em Veiculo.km_atual o maior KM de chegada do veículo. Chamado nas
+    rotas que fecham ou editam viagens, antes do commit.
+    """
+    v = db.session.get(Veiculo, veiculo_id)
+    if not v:
+        return
+    maior_km = (
+        db.session.query(func.max(RegistroUso.km_chegada))
+        .filter(RegistroUso.veiculo_id == veiculo_id)
+        .scalar()
+    )
+    if maior_km is not None:
+        v.km_atual = int(maior_km)
+
+def _somar_viagem(totais, km_saida, km_chegada, saida, chegada):
+    """Acumula uma viagem finalizada em totais = [viagens, km, horas]."""
+    totais[0] += 1
+    totais[1] += km_chegada - km_saida
+    if chegada:
+        totais[2] += (chegada - saida).total_seconds() / 3600
+
+def atualizar_resumo(dia, veiculo_id, gabinete):
+    """
+    Recalcula uma linha de ResumoDiario a partir das viagens daquele dia,
+    veículo e gabinete (poucas linhas, via ix_registro_uso_odometro).
+    Recalcular em vez de somar diferenças mantém o resumo certo quando uma
+    viagem é editada ou reaberta. Chamado antes do commit, como atualizar_km_veiculo.
+
+    A linha é criada (se faltar) e travada antes da leitura das viagens: duas
+    chegadas no mesmo dia/veículo/gabinete se enfileiram na trava, e a segunda
+    relê as viagens já com a da primeira. No PostgreSQL é o FOR UPDATE; no
+    SQLite a escrita já é serializada pelo banco.
+    """
+    chave = {'dia': dia, 'veiculo_id': veiculo_id, 'gabinete_vereador': gabinete}
+    db.session.execute(
+        insert_dialeto()(ResumoDiario.__table__)
+        .values(**chave, viagens=0, km_total=0, horas_total=0)
+        .on_conflict_do_nothing(index_elements=list(chave))
+    )
+    resumo = ResumoDiario.query.filter_by(**chave).with_for_update().populate_existing().one()
+    inicio = datetime.combine(dia, datetime.min.time())
+    viagens = (
+        db.session.query(RegistroUso.km_saida, RegistroUso.km_chegada,
+                         RegistroUso.data_hora_saida, RegistroUso.data_hora_chegada)
+        .filter(RegistroUso.veiculo_id == veiculo_id,
+                RegistroUso.gabinete_vereador == gabinete,
+                RegistroUso.data_hora_saida >= inicio,
+                RegistroUso.data_hora_saida < inicio + timedelta(days=1),
+                RegistroUso.km_chegada != None)
+        .all()
+    )
+    db.session.info['resumo_alterado'] = True
+    if not viagens:
+        db.session.delete(resumo)
+        return
+    totais = [0, 0.0, 0.0]
+    for viagem in viagens:
+        _somar_viagem(totais, *viagem)
+    resumo.viagens, resumo.km_total, resumo.horas_total = totais
+
+def atualizar_resumo_viagem(viagem):
+    atualizar_resumo(viagem.data_hora_saida.date(), viagem.veiculo_id, viagem.gabinete_vereador)
+
+def reconstruir_resumo(lote=1000):
+    """Apaga e recalcula todo o ResumoDiario numa única transação. Devolve o número de linhas."""
+    totais = {}
+    viagens = (
+        db.session.query(RegistroUso.data_hora_saida, RegistroUso.veiculo_id, RegistroUso.gabinete_vereador,
+                         RegistroUso.km_saida, RegistroUso.km_chegada, RegistroUso.data_hora_chegada)
+        .filter(RegistroUso.km_chegada != None)
+        .execution_options(yield_per=lote)
+    )
+    for saida, veiculo_id, gabinete, km_saida, km_chegada, chegada in viagens:
+        chave = (saida.date(), veiculo_id, gabinete)
+        _somar_viagem(totais.setdefault(chave, [0, 0.0, 0.0]), km_saida, km_chegada, saida, chegada)
+
+    db.session.query(ResumoDiario).delete()
+    db.session.info['resumo_alterado'] = True
+    linhas = [{'dia': dia, 'veiculo_id': veiculo_id, 'gabinete_vereador': gabinete,
+               'viagens': n, 'km_total': km, 'horas_total': horas}
+              for (dia, veiculo_id, gabinete), (n, km, horas) in totais.items()]
+    for i in range(0, len(linhas), lote):
+        db.session.execute(ResumoDiario.__table__.insert(), linhas[i:i + lote])
+    db.session.commit()
+    return len(linhas)
+
+_cache_agregados = {'itens': {}, 'versao': None, 'lock': threading.Lock()}
+FILTROS_HISTORICO = ('data_inicio', 'data_fim', 'gabinete', 'veiculo')
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidar_agregados(session):
+    # Só depois do commit: antes disso outra requisição recalcularia com os dados antigos
+    if session.info.pop('resumo_alterado', None):
+        tocar_marcador('viagens')
+        with _cache_agregados['lock']:
+            _cache_agregados['itens'].clear()
+
+def calcular_agregados(args):
+    """Totais dos gráficos do histórico (KM por veículo e gabinete, viagens por dia, duração média)."""
+    condicoes = filtros_resumo(args)
+    km = func.sum(ResumoDiario.km_total)
+    por_veiculo = (
+        db.session.query(Veiculo.modelo, km)
+        .join(ResumoDiario, ResumoDiario.veiculo_id == Veiculo.id)
+        .filter(*condicoes)
+        .group_by(ResumoDiario.veiculo_id, Veiculo.modelo)
+        .order_by(km.desc())
+        .all()
+    )
+    por_gabinete = (
+        db.session.query(ResumoDiario.gabinete_vereador, km)
+        .filter(*condicoes)
+        .group_by(ResumoDiario.gabinete_vereador)
+        .order_by(km.desc())
+        .all()
+    )
+    por_dia = (
+        db.session.query(ResumoDiario.dia, func.sum(ResumoDiario.viagens))
+        .filter(*condicoes)
+        .group_by(ResumoDiario.dia)
+        .order_by(ResumoDiario.dia)
+        .all()
+    )
+    viagens, horas = db.session.query(func.sum(ResumoDiario.viagens), func.sum(ResumoDiario.horas_total)) \
+        .filter(*condicoes).one()
+    return {
+        'km_por_veiculo': {'rotulos': [m for m, _ in por_veiculo], 'valores': [round(v, 1) for _, v in por_veiculo]},
+        'km_por_gabinete': {'rotulos': [g for g, _ in por_gabinete], 'valores': [round(v, 1) for _, v in por_gabinete]},
+        'viagens_por_dia': {'rotulos': [d.isoformat() for d, _ in por_dia], 'valores': [n for _, n in por_dia]},
+        'viagens': viagens or 0,
+        'duracao_media_min': round(horas * 60 / viagens, 1) if viagens else 0,
+    }
+
+def agregados_em_cache(args):
+    """
+    JSON (compacto e já comprimido em gzip) dos agregados para os filtros
+    de args, com cache de AGREGADOS_CACHE_TTL segundos por combinação de
+    filtros. Qualquer commit que altere o resumo diário limpa o cache de
+    todos os processos (marcador 'viagens').
+    """
+    chave = tuple(args.get(f, '') for f in FILTROS_HISTORICO)
+    cache = _cache_agregados
+    versao = versao_marcador('viagens')
+    agora = time.monotonic()
+    with cache['lock']:
+        if cache['versao'] != versao:
+            cache['itens'].clear()
+            cache['versao'] = versao
+        item = cache['itens'].get(chave)
+    if item and item[0] > agora:
+        return item[1]
+
+    corpo = json.dumps(calcular_agregados(args), separators=(',', ':'), ensure_ascii=False).encode()
+    item = (corpo, gzip.compress(corpo), hashlib.md5(corpo).hexdigest())
+    with cache['lock']:
+        if cache['versao'] == versao:
+            cache['itens'][chave] = (agora + current_app.config['AGREGADOS_CACHE_TTL'], item)
+    return item
+
+def filtros_resumo(args):
+    """Mesmos filtros de filtros_registros, aplicados ao ResumoDiario."""
+    condicoes = []
+    if args.get('data_inicio'):
+        condicoes.append(ResumoDiario.dia >= datetime.strptime(args['data_inicio'], '%Y-%m-%d').date())
+    if args.get('data_fim'):
+        condicoes.append(ResumoDiario.dia <= datetime.strptime(args['data_fim'], '%Y-%m-%d').date())
+    if args.get('gabinete'):
+        condicoes.append(ResumoDiario.gabinete_vereador == args['gabinete'])
+    if args.get('veiculo'):
+        condicoes.append(ResumoDiario.veiculo_id == int(args['veiculo']))
+    return condicoes
+
+# --- ODÔMETRO ---
+# Cada viagem tem duas leituras do painel: km_saida e, depois de fechada,
+# km_chegada. Na linha do tempo do veículo, em ordem de (data_hora_saida, id),
+# cada leitura tem de ser >= a anterior. O índice ix_registro_uso_odometro
+# cobre essa ordem e os KMs: achar a viagem vizinha é uma busca na árvore do
+# índice, sem ler a tabela, qualquer que seja o tamanho do histórico.
+
+def formatar_km(valor):
+    return f"{valor:.1f}".rstrip('0').rstrip('.')
+
+def anomalias_odometro(km_anterior, km_saida, km_chegada):
+    """
+    Confere as leituras de uma viagem contra a última leitura do veículo antes
+    dela (None se não houver). Devolve [(nivel, mensagem)], com nivel 'erro'
+    (leitura fora de ordem) ou 'alerta' (salto acima dos limites configurados).
+    """
+    problemas = []
+    if km_anterior is not None:
+        if km_saida < km_anterior:
+            problemas.append(('erro', f"KM de saída {formatar_km(km_saida)} menor que a leitura anterior "
+                                      f"do veículo ({formatar_km(km_anterior)})"))
+        elif km_saida - km_anterior > current_app.config['KM_SALTO_MAXIMO']:
+            problemas.append(('alerta', f"KM de saída {formatar_km(km_saida)} está {formatar_km(km_saida - km_anterior)} km "
+                                        f"acima da leitura anterior do veículo ({formatar_km(km_anterior)})"))
+    if km_chegada is not None:
+        if km_chegada < km_saida:
+            problemas.append(('erro', f"KM de chegada {formatar_km(km_chegada)} menor que o de saída ({formatar_km(km_saida)})"))
+        elif km_chegada - km_saida > current_app.config['KM_VIAGEM_MAXIMA']:
+            problemas.append(('alerta', f"Viagem de {formatar_km(km_chegada - km_saida)} km "
+                                        f"(KM {formatar_km(km_saida)} a {formatar_km(km_chegada)})"))
+    return problemas
+
+def ultima_leitura(viagem):
+    """Leitura mais recente de uma viagem: a de chegada ou, se ainda aberta, a de saída."""
+    return viagem.km_chegada if viagem.km_chegada is not None else viagem.km_saida
+
+def viagem_vizinha(veiculo_id, data_saida=None, viagem_id=None, anterior=True):
+    """
+    Viagem do veículo logo antes (ou logo depois) de (data_saida, viagem_id) na
+    linha do tempo, como (id, km_saida, km_chegada); sem data_saida, a última
+    viagem do veículo. None se não houver.
+    """
+    consulta = (db.session.query(RegistroUso.id, RegistroUso.km_saida, RegistroUso.km_chegada)
+                .filter(RegistroUso.veiculo_id == veiculo_id))
+    if data_saida is not None:
+        # A comparação simples de data limita a faixa do índice; o or_ desempata pelo id
+        if anterior:
+            consulta = consulta.filter(RegistroUso.data_hora_saida <= data_saida, or_(
+                RegistroUso.data_hora_saida < data_saida,
+                and_(RegistroUso.data_hora_saida == data_saida, RegistroUso.id < viagem_id)))
+        else:
+            consulta = consulta.filter(RegistroUso.data_hora_saida >= data_saida, or_(
+                RegistroUso.data_hora_saida > data_saida,
+                and_(RegistroUso.data_hora_saida == data_saida, RegistroUso.id > viagem_id)))
+    if anterior:
+        ordem = (RegistroUso.data_hora_saida.desc(), RegistroUso.id.desc())
+    else:
+        ordem = (RegistroUso.data_hora_saida, RegistroUso.id)
+    return consulta.order_by(*ordem).first()
+
+def validar_odometro(veiculo_id, km_saida, km_chegada=None, viagem=None):
+    """
+    Confere as leituras de uma viagem nova (viagem=None) ou de uma já gravada
+    contra as viagens vizinhas do mesmo veículo. Chamado nas rotas antes de
+    alterar qualquer coisa. Devolve (erros, alertas), listas de mensagens:
+    erros recusam a gravação, alertas só são avisados.
+    """
+    anterior = seguinte = None
+    if viagem is None:
+        # Viagem nova: vem depois de todas; km_atual cobre veículo cadastrado já rodado
+        ultima = viagem_vizinha(veiculo_id)
+        veiculo = db.session.get(Veiculo, veiculo_id)
+        leituras = [k for k in (ultima_leitura(ultima) if ultima else None, veiculo.km_atual if veiculo else None)
+                    if k is not None]
+        anterior = max(leituras) if leituras else None
+    else:
+        # A leitura de saída já gravada e não alterada não é conferida de novo
+        if km_saida != viagem.km_saida:
+            vizinha = viagem_vizinha(veiculo_id, viagem.data_hora_saida, viagem.id)
+            anterior = ultima_leitura(vizinha) if vizinha else None
+        seguinte = viagem_vizinha(veiculo_id, viagem.data_hora_saida, viagem.id, anterior=False)
+
+    problemas = anomalias_odometro(anterior, km_saida, km_chegada)
+    fim = km_chegada if km_chegada is not None else km_saida
+    if seguinte is not None and seguinte.km_saida < fim:
+        problemas.append(('erro', f"KM {formatar_km(fim)} maior que o de saída da viagem seguinte "
+                                  f"do veículo (#{seguinte.id}, KM {formatar_km(seguinte.km_saida)})"))
+    return ([m for nivel, m in problemas if nivel == 'erro'],
+            [m for nivel, m in problemas if nivel == 'alerta'])
+
+# --- STATUS DA FROTA (em memória) ---
+# Estado de cada veículo (livre/em uso, motorista, saída, último KM), mantido
+# no processo: montado do banco na primeira requisição e atualizado a cada
+# commit que mexe em viagens ou veículos. Os outros workers percebem a
+# mudança pelo marcador 'frota' e remontam o índice (uma consulta).
+_frota = {'veiculos': {}, 'versao': None, 'sequencia': 0, 'mudou': threading.Condition()}
+
+def _estado_veiculo(veiculo_id, modelo, placa, km_atual):
+    return {'id': veiculo_id, 'modelo': modelo, 'placa': placa, 'km_atual': km_atual or 0, 'km': km_atual or 0,
+            'disponivel': True, 'viagem_id': None, 'usuario_id': None, 'motorista': None, 'saida': None, 'km_saida': None}
+
+def _ocupar(estado, viagem_id, usuario_id, motorista, saida, km_saida):
+    estado.update(disponivel=False, viagem_id=viagem_id, usuario_id=usuario_id, motorista=motorista or '',
+                  saida=saida.isoformat(timespec='seconds') if saida else None, km_saida=km_saida)
+
+def _liberar(estado):
+    estado.update(disponivel=True, viagem_id=None, usuario_id=None, motorista=None, saida=None, km_saida=None)
+
+def _publicar_frota():
+    # Chamado com _frota['mudou'] adquirido
+    for estado in _frota['veiculos'].values():
+        estado['km'] = max(estado['km_atual'] or 0, estado['km_saida'] or 0)
+    _frota['sequencia'] += 1
+    _frota['mudou'].notify_all()
+
+def reconstruir_frota():
+    """Monta o índice do zero: veículos + viagens abertas, numa consulta só."""
+    # Lê a versão antes da consulta: uma mudança durante a leitura força outra reconstrução
+    versao = versao_marcador('frota')
+    consulta = (
+        db.select(Veiculo.id, Veiculo.modelo, Veiculo.placa, Veiculo.km_atual, RegistroUso.id, RegistroUso.usuario_id,
+                  RegistroUso.motorista_nome, RegistroUso.data_hora_saida, RegistroUso.km_saida)
+        .outerjoin(RegistroUso, and_(RegistroUso.veiculo_id == Veiculo.id, RegistroUso.km_chegada == None))
+    )
+    # Conexão própria (fora da sessão): serve também para o stream de eventos
+    with db.engine.connect() as conexao:
+        linhas = conexao.execute(consulta).all()
+    veiculos = {}
+    for vid, modelo, placa, km_atual, viagem_id, usuario_id, motorista, saida, km_saida in linhas:
+        estado = veiculos.setdefault(vid, _estado_veiculo(vid, modelo, placa, km_atual))
+        if viagem_id is not None:
+            _ocupar(estado, viagem_id, usuario_id, motorista, saida, km_saida)
+    with _frota['mudou']:
+        _frota['veiculos'] = veiculos
+        _frota['versao'] = versao
+        _publicar_frota()
+
+def status_frota():
+    """(sequência, lista de estados por modelo); remonta se outro processo mudou a frota."""
+    if _frota['versao'] != versao_marcador('frota'):
+        reconstruir_frota()
+    with _frota['mudou']:
+        estados = sorted((dict(e) for e in _frota['veiculos'].values()), key=lambda e: (e['modelo'] or '', e['id']))
+        return _frota['sequencia'], estados
+
+def aguardar_frota(sequencia, timeout):
+    """Bloqueia até o índice deste processo mudar de sequência (ou o timeout)."""
+    with _frota['mudou']:
+        return _frota['mudou'].wait_for(lambda: _frota['sequencia'] != sequencia, timeout)
+
+def invalidar_frota():
+    """Para escritas que não passam pelo ORM (importação em lote): todos os processos remontam."""
+    tocar_marcador('frota')
+
+@event.listens_for(db.session, 'after_flush')
+def _registrar_mudancas_frota(session, contexto):
+    # Guarda os valores agora (depois do commit os objetos expiram) e só aplica no after_commit
+    mudancas = []
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Veiculo):
+            mudancas.append(('veiculo', obj.id, obj.modelo, obj.placa, obj.km_atual))
+        elif isinstance(obj, RegistroUso):
+            mudancas.append(('viagem', obj.id, obj.veiculo_id, obj.km_chegada is None, obj.usuario_id,
+                             obj.motorista_nome, obj.data_hora_saida, obj.km_saida))
+    for obj in session.deleted:
+        if isinstance(obj, Veiculo):
+            mudancas.append(('veiculo_excluido', obj.id))
+        elif isinstance(obj, RegistroUso):
+            mudancas.append(('viagem', obj.id, obj.veiculo_id, False, None, None, None, None))
+    if mudancas:
+        session.info.setdefault('frota_alterada', []).extend(mudancas)
+
+@event.listens_for(db.session, 'after_commit')
+def _aplicar_mudancas_frota(session):
+    mudancas = session.info.pop('frota_alterada', None)
+    if not mudancas:
+        return
+    with _frota['mudou']:
+        # Índice ainda não montado, ou já desatualizado por outro processo: a próxima leitura remonta
+        atualizado = _frota['versao'] is not None and _frota['versao'] == versao_marcador('frota')
+        tocar_marcador('frota')
+        if not atualizado:
+            _frota['versao'] = None
+            return
+        veiculos = _frota['veiculos']
+        for mudanca in mudancas:
+            if mudanca[0] == 'veiculo':
+                _, vid, modelo, placa, km_atual = mudanca
+                estado = veiculos.setdefault(vid, _estado_veiculo(vid, modelo, placa, km_atual))
+                estado.update(modelo=modelo, placa=placa, km_atual=km_atual or 0)
+            elif mudanca[0] == 'veiculo_excluido':
+                veiculos.pop(mudanca[1], None)
+            else:
+                _, viagem_id, vid, aberta, usuario_id, motorista, saida, km_saida = mudanca
+                estado = veiculos.get(vid)
+                if estado is None:
+                    continue
+                if aberta:
+                    _ocupar(estado, viagem_id, usuario_id, motorista, saida, km_saida)
+                elif estado['viagem_id'] == viagem_id:
+                    # Só libera se era a viagem aberta (editar uma viagem antiga não mexe no status)
+                    _liberar(estado)
+        _frota['versao'] = versao_marcador('frota')
+        _publicar_frota()
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_mudancas_frota(session):
+    session.info.pop('frota_alterada', None)
+
+@principal.before_app_request
+def _carregar_frota():
+    # Uma vez por processo, na primeira requisição (como a retomada das fotos pendentes)
+    if _frota['versao'] is None:
+        reconstruir_frota()
+
+# --- SENHAS E LOGIN ---
+class LoginOcupado(Exception):
+    """Todas as vagas de verificação de senha estão ocupadas."""
+
+_tentativas_login = {'cpf': {}, 'ip': {}, 'lock': threading.Lock()}
+
+def gerar_hash_senha(senha):
+    return generate_password_hash(senha, method=current_app.config['SENHA_METODO'])
+
+@lru_cache(maxsize=None)
+def _prefixo_hash_atual(metodo):
+    # O werkzeug completa os parâmetros omitidos (ex.: 'scrypt' -> 'scrypt:32768:8:1')
+    return generate_password_hash('', method=metodo).split('$', 1)[0]
+
+def senha_precisa_rehash(hash_salvo):
+    return hash_salvo.split('$', 1)[0] != _prefixo_hash_atual(current_app.config['SENHA_METODO'])
+
+def verificar_senha(hash_salvo, senha):
+    """
+    check_password_hash com no máximo LOGIN_HASH_CONCORRENCIA verificações
+    simultâneas por processo. No início do expediente, quando todos logam de
+    uma vez, o excesso espera até LOGIN_HASH_ESPERA segundos e depois recebe
+    LoginOcupado, em vez de disputar CPU com o resto do app.
+    """
+    vagas = current_app.extensions['vagas_hash']
+    if not vagas.acquire(timeout=current_app.config['LOGIN_HASH_ESPERA']):
+        raise LoginOcupado()
+    try:
+        return check_password_hash(hash_salvo, senha)
+    finally:
+        vagas.release()
+
+def _falhas_recentes(tipo, chave, agora):
+    janela = current_app.config['LOGIN_JANELA']
+    fila = _tentativas_login[tipo].get(chave)
+    if not fila:
+        return 0
+    while fila and fila[0] <= agora - janela:
+        fila.popleft()
+    if not fila:
+        del _tentativas_login[tipo][chave]
+        return 0
+    return len(fila)
+
+def login_bloqueado(cpf, ip):
+    """Janela deslizante de falhas por CPF e por IP (em memória, por processo)."""
+    agora = time.monotonic()
+    with _tentativas_login['lock']:
+        return (_falhas_recentes('cpf', cpf, agora) >= current_app.config['LOGIN_FALHAS_CPF']
+                or _falhas_recentes('ip', ip, agora) >= current_app.config['LOGIN_FALHAS_IP'])
+
+def registrar_falha_login(cpf, ip):
+    agora = time.monotonic()
+    with _tentativas_login['lock']:
+        for tipo, chave in (('cpf', cpf), ('ip', ip)):
+            _tentativas_login[tipo].setdefault(chave, deque()).append(agora)
+
+# --- MÉTRICAS (opcional, METRICAS_ATIVAS=1) ---
+# Por requisição: endpoint, tempo total, nº de SQLs, tempo em SQL e tempo no
+# Pillow. Guarda as últimas METRICAS_JANELA amostras de cada endpoint para
+# p50/p95/p99. Desligado, nenhum hook é registrado (custo zero).
+_metricas = {'endpoints': {}, 'lock': threading.Lock()}
+SERIES_METRICAS = ('tempo', 'sql', 'sql_tempo', 'pillow')
+
+def _serie_endpoint(endpoint):
+    serie = _metricas['endpoints'].get(endpoint)
+    if serie is None:
+        janela = current_app.config['METRICAS_JANELA']
+        serie = {'total': 0, **{nome: deque(maxlen=janela) for nome in SERIES_METRICAS}}
+        _metricas['endpoints'][endpoint] = serie
+    return serie
+
+def registrar_amostra(endpoint, tempo, sql=0, sql_tempo=0.0, pillow=0.0):
+    with _metricas['lock']:
+        serie = _serie_endpoint(endpoint)
+        serie['total'] += 1
+        for nome, valor in zip(SERIES_METRICAS, (tempo, sql, sql_tempo, pillow)):
+            serie[nome].append(valor)
+
+def registrar_tempo_fora_de_requisicao(nome, segundos):
+    """Trabalho fora do ciclo da requisição (ex.: pool de fotos), contado como Pillow."""
+    if current_app.config['METRICAS_ATIVAS']:
+        registrar_amostra(nome, segundos, pillow=segundos)
+
+@contextmanager
+def medir_pillow():
+    """Soma ao g.metricas o tempo gasto no Pillow dentro da requisição."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        if current_app.config['METRICAS_ATIVAS'] and has_request_context() and 'metricas' in g:
+            g.metricas['pillow'] += time.perf_counter() - inicio
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def resumo_metricas():
+    """{endpoint: {total, p50/p95/p99 do tempo, médias de SQL e Pillow}} das amostras atuais."""
+    with _metricas['lock']:
+        copia = {e: {k: list(v) if k != 'total' else v for k, v in serie.items()}
+                 for e, serie in _metricas['endpoints'].items()}
+    resumo = {}
+    for endpoint, serie in sorted(copia.items()):
+        n = len(serie['tempo']) or 1
+        resumo[endpoint] = {
+            'total': serie['total'],
+            'p50': percentil(serie['tempo'], 50),
+            'p95': percentil(serie['tempo'], 95),
+            'p99': percentil(serie['tempo'], 99),
+            'sql_p95': percentil(serie['sql'], 95),
+            'sql_media': sum(serie['sql']) / n,
+            'sql_tempo_medio': sum(serie['sql_tempo']) / n,
+            'pillow_medio': sum(serie['pillow']) / n,
+        }
+    return resumo
+
+def _inicio_requisicao():
+    g.metricas = {'inicio': time.perf_counter(), 'sql': 0, 'sql_tempo': 0.0, 'pillow': 0.0}
+
+def _fim_requisicao(resposta):
+    m = g.pop('metricas', None)
+    if m is not None:
+        registrar_amostra(request.endpoint or 'sem_rota', time.perf_counter() - m['inicio'],
+                          m['sql'], m['sql_tempo'], m['pillow'])
+    return resposta
+
+def _antes_do_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metricas_inicio', []).append(time.perf_counter())
+
+def _depois_do_sql(app, conn, cursor, statement, parameters, context, executemany):
+    duracao = time.perf_counter() - conn.info['metricas_inicio'].pop()
+    if has_request_context() and 'metricas' in g:
+        g.metricas['sql'] += 1
+        g.metricas['sql_tempo'] += duracao
+    if duracao * 1000 >= app.config['METRICAS_SQL_LENTA_MS']:
+        app.logger.warning("SQL lenta (%.1f ms): %s | parâmetros: %r", duracao * 1000, statement, parameters)
+
+def ativar_metricas(app):
+    app.before_request(_inicio_requisicao)
+    app.after_request(_fim_requisicao)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _antes_do_sql)
+        # O app vai junto: o SQL pode rodar fora de contexto (ex.: batimento dos relatórios)
+        event.listen(db.engine, 'after_cursor_execute', partial(_depois_do_sql, app))
+
 # --- ROTAS PRINCIPAIS ---
-@app.route('/')
+@principal.route('/')
 def index():
     if not current_user.is_authenticated:
-        return redirect(url_for('login'))
-    viagem_em_aberto = RegistroUso.query.filter_by(usuario_id=current_user.id, km_chegada=None).first()
-    return render_template('index.html', tem_viagem_aberta=(viagem_em_aberto is not None))
+        return redirect(url_for('principal.login'))
+    # Tudo vem do índice em memória da frota: a página inicial não consulta o banco
+    _, frota = status_frota()
+    tem_viagem_aberta = any(e['usuario_id'] == current_user.id for e in frota)
+    return render_template('index.html', tem_viagem_aberta=tem_viagem_aberta, status_frota=frota)
 
-@app.route('/login', methods=['GET', 'POST'])
+@principal.route('/api/frota')
+@login_required
+def api_frota():
+    """Status da frota em JSON, para as telas consultarem (sem mudança, 304 vazio)."""
+    _, frota = status_frota()
+    corpo = json.dumps(frota, separators=(',', ':'), ensure_ascii=False)
+    resposta = make_response(corpo)
+    resposta.mimetype = 'application/json'
+    resposta.set_etag(hashlib.sha256(corpo.encode()).hexdigest()[:16])
+    resposta.cache_control.private = True
+    resposta.cache_control.no_cache = True
+    return resposta.make_conditional(request)
+
+@principal.route('/api/frota/eventos')
+@login_required
+def eventos_frota():
+    """
+    Server-Sent Events com o status da frota (só com FROTA_SSE=1): um evento
+    'frota' (lista completa, poucos veículos) a cada mudança, e um comentário
+    de ping para manter a conexão viva em proxies.
+    """
+    if not current_app.config['FROTA_SSE']:
+        abort(404)
+    duracao, ping = current_app.config['FROTA_SSE_DURACAO'], current_app.config['FROTA_SSE_PING']
+
+    def gerar():
+        enviada = None
+        fim = time.monotonic() + duracao
+        ultimo_envio = time.monotonic()
+        yield "retry: 3000\n\n"
+        while time.monotonic() < fim:
+            sequencia, frota = status_frota()
+            if sequencia != enviada:
+                enviada = sequencia
+                ultimo_envio = time.monotonic()
+                yield f"event: frota\ndata: {json.dumps(frota, separators=(',', ':'), ensure_ascii=False)}\n\n"
+            elif time.monotonic() - ultimo_envio >= ping:
+                ultimo_envio = time.monotonic()
+                yield ": ping\n\n"
+            # Mudança neste processo acorda na hora; de outros workers, é vista pelo marcador em até 1 s
+            aguardar_frota(sequencia, 1)
+
+    resposta = current_app.response_class(stream_with_context(gerar()), mimetype='text/event-stream')
+    resposta.headers['Cache-Control'] = 'no-cache'
+    resposta.headers['X-Accel-Buffering'] = 'no'  # nginx não pode segurar os eventos no buffer
+    return resposta
+
+@principal.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         cpf = request.form.get('cpf', '').replace('.', '').replace('-', '').strip()
-        senha = request.form.get('senha')
+        senha = request.form.get('senha') or ''
+        ip = request.remote_addr or '-'
+
+        # Barra rajadas de tentativas antes de calcular qualquer hash
+        if login_bloqueado(cpf, ip):
+            flash('Muitas tentativas. Aguarde alguns minutos e tente de novo.', 'danger')
+            return render_template('login.html'), 429
+
         usuario = Usuario.query.filter_by(cpf=cpf).first()
-        if usuario and check_password_hash(usuario.senha, senha):
+        try:
+            senha_ok = usuario is not None and verificar_senha(usuario.senha, senha)
+        except LoginOcupado:
+            flash('Servidor ocupado. Tente novamente em instantes.', 'warning')
+            return render_template('login.html'), 503
+
+        if senha_ok:
             if not usuario.ativo:
                 flash('Conta inativada.', 'danger')
-                return redirect(url_for('login'))
+                return redirect(url_for('principal.login'))
+            # Hash gerado com parâmetros antigos: regrava com os atuais
+            if senha_precisa_rehash(usuario.senha):
+                usuario.senha = gerar_hash_senha(senha)
+                db.session.commit()
             login_user(usuario)
-            return redirect(url_for('index'))
+            return redirect(url_for('principal.index'))
         else:
+            registrar_falha_login(cpf, ip)
             flash('CPF ou Senha incorretos!', 'danger')
     return render_template('login.html')
 
-@app.route('/logout')
+@principal.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
-
-# --- GESTÃO DE USUÁRIOS ---
-@app.route('/gestao-usuarios', methods=['GET', 'POST'])
-@login_required
-def gestao_usuarios():
-    if current_user.cargo != 'Admin':
-        flash('Acesso negado!', 'danger')
-        return redirect(url_for('index'))
-    form = CadastroUsuarioForm()
-    if form.validate_on_submit():
-        cpf_limpo = form.cpf.data.replace('.', '').replace('-', '').strip()
-        existente = Usuario.query.filter_by(cpf=cpf_limpo).first()
-        if existente:
-            flash('CPF já cadastrado!', 'danger')
-        else:
-            novo_u = Usuario(
-                nome=form.nome.data, cpf=cpf_limpo,
-                senha=generate_password_hash(form.senha.data),
-                cargo=form.cargo.data, gabinete=form.gabinete.data, ativo=True
-            )
-            db.session.add(novo_u); db.session.commit()
-            flash('Usuário cadastrado!', 'success')
-            return redirect(url_for('gestao_usuarios'))
-    usuarios = Usuario.query.all()
-    return render_template('gestao_usuarios.html', form=form, usuarios=usuarios)
-
-@app.route('/editar-usuario/<int:id>', methods=['GET', 'POST'])
-@login_required
-def editar_usuario(id):
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    usuario = db.session.get(Usuario, id)
-    if request.method == 'POST':
-        usuario.nome = request.form.get('nome')
-        usuario.cpf = request.form.get('cpf').replace('.', '').replace('-', '').strip()
-        usuario.gabinete = request.form.get('gabinete')
-        nova_senha = request.form.get('senha')
-        if nova_senha:
-            usuario.senha = generate_password_hash(nova_senha)
-        db.session.commit()
-        flash('Usuário atualizado!', 'success')
-        return redirect(url_for('gestao_usuarios'))
-    return render_template('editar_usuario.html', usuario=usuario, gabinetes=LISTA_GABINETES)
-
-@app.route('/alternar-status/<int:id>')
-@login_required
-def alternar_status(id):
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    usuario = db.session.get(Usuario, id)
-    if usuario and usuario.id != current_user.id:
-        usuario.ativo = not usuario.ativo
-        db.session.commit()
-    return redirect(url_for('gestao_usuarios'))
-
-@app.route('/excluir-usuario/<int:id>')
-@login_required
-def excluir_usuario(id):
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    usuario = db.session.get(Usuario, id)
-    if usuario and usuario.id != current_user.id:
-        db.session.delete(usuario)
-        db.session.commit()
-    return redirect(url_for('gestao_usuarios'))
-
-# --- GESTÃO DE VEÍCULOS ---
-@app.route('/gestao-veiculos', methods=['GET', 'POST'])
-@login_required
-def gestao_veiculos():
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    form = VeiculoForm()
-    if form.validate_on_submit():
-        novo_v = Veiculo(modelo=form.modelo.data, placa=form.placa.data.upper())
-        db.session.add(novo_v); db.session.commit()
-        flash('Veículo cadastrado!', 'success')
-        return redirect(url_for('gestao_veiculos'))
-    veiculos = Veiculo.query.all()
-    return render_template('gestao_veiculos.html', form=form, veiculos=veiculos)
-
-@app.route('/editar_veiculo/<int:id>', methods=['POST'])
-@login_required
-def editar_veiculo(id):
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    veiculo = db.session.get(Veiculo, id)
-    if veiculo:
-        veiculo.modelo = request.form.get('modelo')
-        veiculo.placa = request.form.get('placa').upper()
-        db.session.commit()
-        flash('Veículo atualizado!', 'success')
-    return redirect(url_for('gestao_veiculos'))
-
-@app.route('/excluir-veiculo/<int:id>')
-@login_required
-def excluir_veiculo(id):
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    v = db.session.get(Veiculo, id)
-    if v:
-        if v.registros:
-            flash('Não é possível excluir veículo com histórico!', 'danger')
-        else:
-            db.session.delete(v); db.session.commit()
-            flash('Veículo removido!', 'warning')
-    return redirect(url_for('gestao_veiculos'))
+    return redirect(url_for('principal.login'))
 
 # --- REGISTRO DE VIAGENS ---
 # app.py (trecho da rota registrar_saida)
-@app.route('/registrar-saida', methods=['GET', 'POST'])
+@principal.route('/registrar-saida', methods=['GET', 'POST'])
 @login_required
 def registrar_saida():
     form = RegistroSaidaForm()
-    veiculos = Veiculo.query.all()
-    
-    # Força o banco a ler os dados mais recentes antes de listar ocupados
-    db.session.expire_all()
-    ocupados = {r.veiculo_id for r in RegistroUso.query.filter_by(km_chegada=None).all()}
+    # Veículos e quais estão em uso vêm do índice em memória da frota
+    _, veiculos = status_frota()
+    ocupados = {e['id'] for e in veiculos if not e['disponivel']}
 
     form.veiculo_modelo.choices = [
-        (v.id, f"{v.modelo} {'(EM USO)' if v.id in ocupados else ''}") for v in veiculos
+        (v['id'], f"{v['modelo']} {'(EM USO)' if v['id'] in ocupados else ''}") for v in veiculos
     ]
 
     if form.validate_on_submit():
         selecionado_id = form.veiculo_modelo.data
         if selecionado_id in ocupados:
             flash('Veículo selecionado já está em uso.', 'danger')
-            return redirect(url_for('registrar_saida'))
+            return redirect(url_for('principal.registrar_saida'))
 
         v = db.session.get(Veiculo, selecionado_id)
         if not v:
             flash('Veículo inválido.', 'danger')
-            return redirect(url_for('registrar_saida'))
+            return redirect(url_for('principal.registrar_saida'))
+
+        # Odômetro conferido antes de processar a foto
+        erros, alertas = validar_odometro(v.id, form.km_saida.data)
+        if erros:
+            flash(f"{'; '.join(erros)}.", 'danger')
+            return redirect(url_for('principal.registrar_saida'))
+
+        foto_painel, motivo = salvar_fotos([(form.foto_km_saida.data, "S")])[0]
+        if not foto_painel:
+            flash(f'Foto do painel não aceita: {motivo}.', 'danger')
+            return redirect(url_for('principal.registrar_saida'))
 
         novo = RegistroUso(
             usuario_id=current_user.id,
@@ -326,39 +1871,49 @@ def registrar_saida():
             motorista_nome=current_user.nome,
             veiculo_id=v.id,
             km_saida=form.km_saida.data,
-            foto_km_saida=salvar_foto_compacta(form.foto_km_saida.data, "S"),
+            foto_km_saida=foto_painel,
             destino_finalidade=form.destino_finalidade.data,
             data_hora_saida=datetime.now()
         )
         
+        # A checagem de 'ocupados' acima é só para a tela; quem garante que dois
+        # motoristas não saem com o mesmo carro é o índice único parcial
+        # ux_registro_uso_aberto_veiculo (uma viagem aberta por veículo).
         try:
             db.session.add(novo)
             db.session.commit()
-            # AJUSTE 1: Limpa o cache da sessão para a próxima requisição ver o dado novo
-            db.session.expire_all() 
             flash('Saída registrada!', 'success')
+            for alerta in alertas:
+                flash(f'Confira o KM informado: {alerta}.', 'warning')
+        except IntegrityError:
+            db.session.rollback()
+            descartar_foto(novo.foto_km_saida)
+            flash('Veículo selecionado já está em uso.', 'danger')
+            return redirect(url_for('principal.registrar_saida'))
         except Exception as e:
             db.session.rollback()
             flash(f'Erro ao salvar: {e}', 'danger')
-            return redirect(url_for('registrar_saida'))
+            return redirect(url_for('principal.registrar_saida'))
 
         # AJUSTE 2: Redireciona com um parâmetro para evitar cache do navegador
-        return redirect(url_for('index', v=datetime.now().timestamp()))
+        return redirect(url_for('principal.index', v=datetime.now().timestamp()))
 
     return render_template('registrar_saida.html', form=form, veiculos=veiculos, ocupados=list(ocupados))
 
-@app.route('/registrar-chegada', methods=['GET', 'POST'])
+@principal.route('/registrar-chegada', methods=['GET', 'POST'])
 @login_required
 def registrar_chegada():
     form = RegistroChegadaForm()
 
-    # Busca registros em aberto (km_chegada is None)
-    registros_abertos = RegistroUso.query.filter_by(km_chegada=None).order_by(RegistroUso.data_hora_saida.desc()).all()
+    # Viagens em aberto, a partir do índice em memória da frota (mais recentes primeiro)
+    registros_abertos = sorted((e for e in status_frota()[1] if not e['disponivel']),
+                               key=lambda e: e['saida'] or '', reverse=True)
 
     # Popula choices do select (valor = id, label descritivo)
     form.registro_id.choices = [
-        (r.id, f"{r.veiculo.modelo} - {r.motorista_nome} - {r.data_hora_saida.strftime('%d/%m %H:%M')} - KM {r.km_saida}")
-        for r in registros_abertos
+        (e['viagem_id'], f"{e['modelo']} - {e['motorista']} - "
+                         f"{datetime.fromisoformat(e['saida']).strftime('%d/%m %H:%M') if e['saida'] else '--'} - KM {e['km_saida']}")
+        for e in registros_abertos
     ]
 
     # Envia lista para o template (o template verifica 'registros')
@@ -367,307 +1922,269 @@ def registrar_chegada():
     if form.validate_on_submit():
         reg = db.session.get(RegistroUso, form.registro_id.data)
         if reg:
+            erros, alertas = validar_odometro(reg.veiculo_id, reg.km_saida, form.km_chegada.data, viagem=reg)
+            if erros:
+                flash(f"{'; '.join(erros)}.", 'danger')
+                return redirect(url_for('principal.registrar_chegada'))
+
+            # Foto do painel e fotos de ocorrência (se houver) processadas juntas, em paralelo
+            ocorrencias = [f for f in request.files.getlist('foto_ocorrencia') if f and f.filename != '']
+            resultados = salvar_fotos([(form.foto_km_chegada.data, "C")] + [(f, "O") for f in ocorrencias])
+            foto_painel, motivo = resultados[0]
+            if not foto_painel:
+                db.session.rollback()
+                for nome, _ in resultados[1:]:
+                    descartar_foto(nome)
+                flash(f'Foto do painel não aceita: {motivo}.', 'danger')
+                return redirect(url_for('principal.registrar_chegada'))
+
             # Salva os dados básicos
             reg.km_chegada = form.km_chegada.data
             reg.data_hora_chegada = datetime.now()
-            reg.foto_km_chegada = salvar_foto_compacta(form.foto_km_chegada.data, "C")
+            reg.foto_km_chegada = foto_painel
             reg.observacoes = request.form.get('observacoes')
 
-            # Salva múltiplas fotos de ocorrência (se houver)
-            arquivos = request.files.getlist('foto_ocorrencia')
-            for f in arquivos:
-                if f and f.filename != '':
-                    nome_arquivo = salvar_foto_compacta(f, "O")
-                    if nome_arquivo:
-                        nova_foto = FotoOcorrencia(registro_id=reg.id, caminho_foto=nome_arquivo)
-                        db.session.add(nova_foto)
-                    else:
-                        print(f"[WARN] falha ao salvar foto de ocorrência: {getattr(f, 'filename', '<sem-nome>')}")
-
-            # Atualiza km_atual do veículo se necessário
-            try:
-                if reg.km_chegada is not None:
-                    v = reg.veiculo
-                    if v and (v.km_atual is None or reg.km_chegada > v.km_atual):
-                        v.km_atual = int(reg.km_chegada)
-            except Exception:
-                pass
+            # Fotos de ocorrência aceitas: um insert só; as recusadas são avisadas ao motorista
+            salvas = [nome for nome, _ in resultados[1:] if nome]
+            recusadas = [(f.filename, motivo) for f, (nome, motivo) in zip(ocorrencias, resultados[1:]) if not nome]
+            if salvas:
+                db.session.execute(FotoOcorrencia.__table__.insert(),
+                                   [{'registro_id': reg.id, 'caminho_foto': nome} for nome in salvas])
+
+            # Atualiza km_atual do veículo e o resumo diário na escrita (o painel só lê)
+            atualizar_km_veiculo(reg.veiculo_id)
+            atualizar_resumo_viagem(reg)
 
             db.session.commit()
             flash('Chegada registrada!', 'success')
-            return redirect(url_for('index'))
+            for alerta in alertas:
+                flash(f'Confira o KM informado: {alerta}.', 'warning')
+            if recusadas:
+                flash(f'{len(recusadas)} foto(s) de ocorrência não foram salvas: {resumo_falhas(recusadas)}.', 'warning')
+            return redirect(url_for('principal.index'))
 
     return render_template('registrar_chegada.html', form=form, registros=registros)
         
-# --- HISTÓRICO E RELATÓRIOS ---
-@app.route('/historico')
-@login_required
-def historico():
-    if current_user.cargo != 'Admin': 
-        return redirect(url_for('index'))
-    
-    # 1. Captura os filtros da URL
-    f_inicio = request.args.get('data_inicio')
-    f_fim = request.args.get('data_fim')
-    f_gabinete = request.args.get('gabinete')
-    f_veiculo = request.args.get('veiculo')
-
-    query = RegistroUso.query
-
-    # 2. Aplica filtros de data (SQL)
-    if f_inicio:
-        dt_ini = datetime.strptime(f_inicio, '%Y-%m-%d')
-        query = query.filter(RegistroUso.data_hora_saida >= dt_ini)
-    if f_fim:
-        dt_fim = datetime.strptime(f_fim, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
-        query = query.filter(RegistroUso.data_hora_saida <= dt_fim)
-    
-    if f_gabinete: 
-        query = query.filter(RegistroUso.gabinete_vereador == f_gabinete)
-    if f_veiculo:
-        query = query.filter(RegistroUso.veiculo_id == int(f_veiculo))
-
-    # 3. Executa a busca
-    registros = query.order_by(RegistroUso.data_hora_saida.desc()).all()
-    
-    # 4. CRIAÇÃO DA VARIÁVEL DADOS_GRAFICO (O que estava faltando)
-    dados_grafico = {}
-    for reg in registros:
-        if reg.km_chegada:
-            distancia = reg.km_chegada - reg.km_saida
-            # Soma a distância para o modelo do veículo
-            nome_veiculo = reg.veiculo.modelo
-            dados_grafico[nome_veiculo] = dados_grafico.get(nome_veiculo, 0) + distancia
-
-    # 5. Listas auxiliares para os filtros (Selects)
-    gabinetes_list = [g[0] for g in LISTA_GABINETES]
-    veiculos_list = Veiculo.query.all()
-
-    # 6. Renderiza a página enviando todas as variáveis necessárias
-    return render_template('historico.html', 
-                           registros=registros, 
-                           gabinetes=gabinetes_list, 
-                           veiculos=veiculos_list,
-                           labels_carros=list(dados_grafico.keys()), 
-                           valores_km=list(dados_grafico.values()))
-
-@app.route('/relatorio-ocorrencias')
-@login_required
-def relatorio_ocorrencias():
-    if current_user.cargo != 'Admin': 
-        return redirect(url_for('index'))
-    
-    # Buscamos todas as viagens finalizadas
-    viagens = RegistroUso.query.filter(RegistroUso.km_chegada != None).order_by(RegistroUso.data_hora_chegada.desc()).all()
-    
-    return render_template('relatorio_ocorrencias.html', ocorrencias=viagens)
-
-
-@app.route('/exportar-excel')
-@login_required
-def exportar_excel():
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    
-    # --- CAPTURA DOS NOVOS FILTROS DE PERÍODO ---
-    f_inicio = request.args.get('data_inicio')
-    f_fim = request.args.get('data_fim')
-    f_gabinete = request.args.get('gabinete')
-    f_veiculo = request.args.get('veiculo')
-
-    query = RegistroUso.query
-
-    # Filtro de Período (SQL)
-    if f_inicio:
-        dt_ini = datetime.strptime(f_inicio, '%Y-%m-%d')
-        query = query.filter(RegistroUso.data_hora_saida >= dt_ini)
-    if f_fim:
-        dt_fim = datetime.strptime(f_fim, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
-        query = query.filter(RegistroUso.data_hora_saida <= dt_fim)
-    
-    if f_gabinete: 
-        query = query.filter(RegistroUso.gabinete_vereador == f_gabinete)
-    if f_veiculo:
-        query = query.filter(RegistroUso.veiculo_id == int(f_veiculo))
-    
-    registros_filtrados = query.order_by(RegistroUso.data_hora_saida.desc()).all()
-
-    # --- MONTAGEM DOS DADOS (Com Data de Chegada) ---
-    dados = []
-    for r in registros_filtrados:
-        distancia = (r.km_chegada - r.km_saida) if r.km_chegada else 0
-        dados.append({
-            "DATA/HORA SAÍDA": r.data_hora_saida.strftime('%d/%m/%Y %H:%M'),
-            "DATA/HORA CHEGADA": r.data_hora_chegada.strftime('%d/%m/%Y %H:%M') if r.data_hora_chegada else "EM TRÂNSITO",
-            "MOTORISTA": r.motorista_nome.upper(),
-            "VEÍCULO": f"{r.veiculo.modelo} ({r.veiculo.placa})",
-            "GABINETE": r.gabinete_vereador,
-            "KM INICIAL": r.km_saida,
-            "KM FINAL": r.km_chegada if r.km_chegada else "---",
-            "TOTAL KM": distancia,
-            "DESTINO/FINALIDADE": r.destino_finalidade
-        })
-
-    df = pd.DataFrame(dados)
-    output = io.BytesIO()
-    
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Relatório')
-        workbook = writer.book
-        worksheet = writer.sheets['Relatório']
-
-        # Estilos Institucionais
-        header_fill = PatternFill(start_color='003366', end_color='003366', fill_type='solid')
-        header_font = Font(color='FFFFFF', bold=True)
-        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), 
-                             top=Side(style='thin'), bottom=Side(style='thin'))
-        signature_line = Border(top=Side(style='medium')) 
-        
-        # Formatação de Cabeçalho e Ajuste Automático de Colunas
-        for col in worksheet.columns:
-            max_length = 0
-            column_letter = col[0].column_letter
-            for cell in col:
-                cell.border = thin_border
-                if cell.row == 1:
-                    cell.fill = header_fill
-                    cell.font = header_font
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                else:
-                    cell.alignment = Alignment(horizontal='left', vertical='center')
-                
-                val_len = len(str(cell.value))
-                if val_len > max_length:
-                    max_length = val_len
-            worksheet.column_dimensions[column_letter].width = max_length + 5
-
-        # --- LINHAS DE ASSINATURA CORRIGIDAS ---
-        last_row = len(registros_filtrados) + 4
-        
-        # 1. Responsável (Lado Esquerdo)
-        worksheet.merge_cells(start_row=last_row, start_column=1, end_row=last_row, end_column=3)
-        for c in range(1, 4):
-            worksheet.cell(row=last_row, column=c).border = signature_line
-        
-        label_ass = worksheet.cell(row=last_row, column=1)
-        label_ass.value = "Assinatura do Responsável (Transportes)"
-        label_ass.alignment = Alignment(horizontal='center')
-
-        # 2. Administração (Lado Direito)
-        worksheet.merge_cells(start_row=last_row, start_column=7, end_row=last_row, end_column=9)
-        for c in range(7, 10):
-            worksheet.cell(row=last_row, column=c).border = signature_line
-            
-        label_adm = worksheet.cell(row=last_row, column=7)
-        label_adm.value = "Visto da Administração"
-        label_adm.alignment = Alignment(horizontal='center')
-
-        # Rodapé de Emissão
-        emissao_cell = worksheet.cell(row=last_row + 2, column=1)
-        emissao_cell.value = f"Relatório extraído em: {datetime.now().strftime('%d/%m/%Y %H:%M')}"
-        emissao_cell.font = Font(italic=True, size=9, color='777777')
-
-    output.seek(0)
-    nome_doc = f"Relatorio_Frota_{datetime.now().strftime('%d_%m_%Y')}.xlsx"
-    return send_file(output, download_name=nome_doc, as_attachment=True)
-
-@app.route('/editar_viagem/<int:id>', methods=['GET', 'POST'])
-@login_required
-def editar_viagem(id):
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    viagem = db.session.get(RegistroUso, id)
-    if request.method == 'POST':
-        viagem.km_saida = float(request.form.get('km_saida'))
-        viagem.km_chegada = float(request.form.get('km_chegada')) if request.form.get('km_chegada') else None
-        viagem.destino_finalidade = request.form.get('destino')
-        db.session.commit(); flash('Viagem atualizada!', 'success')
-        return redirect(url_for('historico'))
-    return render_template('editar_viagem.html', viagem=viagem)
-
-@app.route('/admin/dashboard')
-@login_required
-def painel_admin():
-    if current_user.cargo != 'Admin':
-        flash('Acesso negado!', 'danger')
-        return redirect(url_for('index'))
-
-    veiculos = Veiculo.query.all()
-    viagens_concluidas = RegistroUso.query.filter(RegistroUso.km_chegada != None).all()
-
-    # 1. Lógica do Ranking de Gabinetes (KM Total)
-    ranking = {}
-    for v in viagens_concluidas:
-        distancia = v.km_chegada - v.km_saida
-        ranking[v.gabinete_vereador] = ranking.get(v.gabinete_vereador, 0) + distancia
-    
-    # Ordenar ranking do maior para o menor
-    ranking_ordenado = dict(sorted(ranking.items(), key=lambda item: item[1], reverse=True))
-
-    # 2. Lógica de Atualização de KM Atual dos Veículos
-    # (Garante que o KM do veículo seja sempre o maior KM de chegada registrado para ele)
-    for v in veiculos:
-        ultimo_registro = RegistroUso.query.filter_by(veiculo_id=v.id).filter(RegistroUso.km_chegada != None).order_by(RegistroUso.km_chegada.desc()).first()
-        if ultimo_registro:
-            v.km_atual = ultimo_registro.km_chegada
-    db.session.commit()
-
-    return render_template('painel_admin.html', 
-                           veiculos=veiculos, 
-                           ranking=ranking_ordenado)
-
-@app.route('/admin/resetar-revisao/<int:id>')
-@login_required
-def resetar_revisao(id):
-    if current_user.cargo != 'Admin': return redirect(url_for('index'))
-    v = db.session.get(Veiculo, id)
-    if v:
-        # Define a próxima revisão para daqui a 10.000 KM a partir do KM atual
-        v.km_revisao_proxima = v.km_atual + 10000
-        db.session.commit()
-        flash(f'Revisão do {v.modelo} atualizada para {v.km_revisao_proxima} KM!', 'success')
-    return redirect(url_for('painel_admin'))
-
-@app.route('/download/<path:filename>')
-@login_required
-def download_file(filename):
+# --- MANUTENÇÃO DO BANCO ---
+def migrar_banco():
     """
-    Força o download de um arquivo armazenado no diretório de uploads,
-    protegendo contra path traversal.
+    Cria as tabelas e os índices que faltarem. O db.create_all() não mexe em
+    tabelas que já existem, então bancos antigos (instance/database.db)
+    recebem os índices novos aqui.
     """
-    upload_folder = current_app.config.get('UPLOAD_FOLDER')
-    if not upload_folder:
-        abort(404)
-
-    # Caminho absoluto do upload folder e do arquivo solicitado
-    upload_folder_abs = os.path.abspath(upload_folder)
-    requested_path = os.path.abspath(os.path.join(upload_folder_abs, filename))
-
-    # Protege contra path traversal: requested_path deve ficar dentro de upload_folder_abs
-    try:
-        common = os.path.commonpath([upload_folder_abs, requested_path])
-    except ValueError:
-        # caminhos em drives diferentes (Windows) -> bloqueia
-        abort(404)
-
-    if common != upload_folder_abs or not os.path.exists(requested_path):
-        abort(404)
+    resumo_novo = not db.inspect(db.engine).has_table(ResumoDiario.__tablename__)
+    db.create_all()
+    # Colunas novas em tabelas que já existiam (o create_all não as acrescenta)
+    colunas_pendente = {c['name'] for c in db.inspect(db.engine).get_columns(FotoPendente.__tablename__)}
+    with db.engine.begin() as conn:
+        if 'dono' not in colunas_pendente:
+            conn.execute(db.text('ALTER TABLE foto_pendente ADD COLUMN dono VARCHAR(100)'))
+        # Substituído pelo índice único ux_registro_uso_aberto_veiculo
+        conn.execute(db.text('DROP INDEX IF EXISTS ix_registro_uso_aberto_veiculo'))
+        # Substituído por ix_registro_uso_odometro (mesmas colunas iniciais, mais id e KMs)
+        conn.execute(db.text('DROP INDEX IF EXISTS ix_registro_uso_veiculo_saida'))
+        # Substituído por ix_registro_uso_fim (chegada ou saída, mais id)
+        conn.execute(db.text('DROP INDEX IF EXISTS ix_registro_uso_chegada'))
+
+    duplicados = (
+        db.session.query(RegistroUso.veiculo_id, func.count())
+        .filter(RegistroUso.km_chegada == None)
+        .group_by(RegistroUso.veiculo_id)
+        .having(func.count() > 1)
+        .all()
+    )
+    # IF NOT EXISTS em vez de checkfirst: a reflexão do SQLAlchemy não enxerga
+    # índices de expressão (ix_registro_uso_fim) e tentaria criá-los de novo
+    from sqlalchemy.schema import CreateIndex  # só usado na migração
+    with db.engine.begin() as conn:
+        for tabela in db.metadata.sorted_tables:
+            for indice in tabela.indexes:
+                if indice.name == 'ux_registro_uso_aberto_veiculo' and duplicados:
+                    print("[AVISO] Veículos com mais de uma viagem aberta (feche-as e rode de novo): "
+                          + ", ".join(f"veículo {vid} ({n} viagens)" for vid, n in duplicados))
+                    continue
+                conn.execute(CreateIndex(indice, if_not_exists=True))
+
+    # Tabela de resumo recém-criada num banco que já tem viagens
+    if resumo_novo:
+        reconstruir_resumo()
+
+@principal.cli.command('processar-fotos')
+def processar_fotos_cmd():
+    """Gera agora, no próprio processo, os JPEGs das fotos pendentes que nenhum worker vivo está processando."""
+    for nome in assumir_fotos_pendentes():
+        try:
+            resultado = processar_foto_bruta(os.path.join(pasta_brutos(), nome))
+        except Exception as e:
+            concluir_foto_pendente(nome, None, e)
+        else:
+            concluir_foto_pendente(nome, resultado)
 
-    # Nome seguro para o cabeçalho de download (mantém o nome original, sanitizado)
-    download_name = secure_filename(os.path.basename(requested_path)) or os.path.basename(requested_path)
+@principal.cli.command('reconstruir-resumo')
+def reconstruir_resumo_cmd():
+    """Recalcula do zero a tabela de resumo diário a partir das viagens."""
+    print(f"Resumo reconstruído: {reconstruir_resumo()} linhas.")
 
-    # Envia o arquivo forçando download. Compatibilidade com diferentes versões do Flask:
-    try:
-        return send_file(requested_path, as_attachment=True, download_name=download_name)
-    except TypeError:
-        return send_file(requested_path, as_attachment=True, attachment_filename=download_name)
-
-@app.route('/uploads/<filename>')
-def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+@principal.cli.command('auditar-odometro')
+@click.option('--veiculo', 'placa', help='Audita só o veículo com esta placa.')
+@click.option('--lote', default=1000, show_default=True, help='Viagens lidas do banco por vez.')
+def auditar_odometro_cmd(placa, lote):
+    """
+    Percorre todo o histórico numa passada só, veículo a veículo na ordem de
+    saída (a do índice ix_registro_uso_odometro), e lista leituras fora de
+    ordem e saltos suspeitos, inclusive de viagens importadas ou editadas
+    antes da conferência existir. Sai com erro se houver leitura fora de ordem.
+    """
+    viagens = db.session.query(RegistroUso.id, RegistroUso.veiculo_id, RegistroUso.data_hora_saida,
+                               RegistroUso.km_saida, RegistroUso.km_chegada)
+    if placa:
+        veiculo = Veiculo.query.filter_by(placa=placa.strip().upper()).first()
+        if not veiculo:
+            raise SystemExit(f"Veículo não encontrado: {placa}")
+        viagens = viagens.filter(RegistroUso.veiculo_id == veiculo.id)
+    placas = dict(db.session.query(Veiculo.id, Veiculo.placa))
+
+    contagem = {'erro': 0, 'alerta': 0}
+    total, veiculo_atual, anterior = 0, None, None
+    viagens = viagens.order_by(RegistroUso.veiculo_id, RegistroUso.data_hora_saida, RegistroUso.id) \
+                     .execution_options(yield_per=lote)
+    for viagem in viagens:
+        total += 1
+        if viagem.veiculo_id != veiculo_atual:
+            veiculo_atual, anterior = viagem.veiculo_id, None
+        for nivel, mensagem in anomalias_odometro(anterior, viagem.km_saida, viagem.km_chegada):
+            contagem[nivel] += 1
+            print(f"[{nivel.upper()}] {placas.get(viagem.veiculo_id, viagem.veiculo_id)} viagem #{viagem.id} "
+                  f"({viagem.data_hora_saida:%d/%m/%Y %H:%M}): {mensagem}")
+        anterior = ultima_leitura(viagem)
+
+    print(f"{total} viagens auditadas: {contagem['erro']} erro(s), {contagem['alerta']} alerta(s).")
+    if contagem['erro']:
+        raise SystemExit(1)
+
+@principal.cli.command('migrar-banco')
+def migrar_banco_cmd():
+    """Aplica tabelas e índices novos ao banco configurado."""
+    migrar_banco()
+    print("Banco atualizado.")
+
+def consultas_das_rotas():
+    """Consultas representativas de cada rota, montadas como nas próprias rotas."""
+    agora = datetime.now()
+    periodo = [RegistroUso.data_hora_saida >= agora.replace(year=agora.year - 1),
+               RegistroUso.data_hora_saida <= agora]
+    pagina = lambda *condicoes: (RegistroUso.query.filter(*condicoes)
+                                 .order_by(RegistroUso.data_hora_saida.desc(), RegistroUso.id.desc())
+                                 .limit(current_app.config['HISTORICO_POR_PAGINA'] + 1))
+    return {
+        # index, registrar_saida e registrar_chegada leem o índice em memória, montado com esta
+        'reconstruir_frota (viagens abertas)': RegistroUso.query.filter_by(km_chegada=None),
+        'historico': pagina(),
+        'historico (período)': pagina(*periodo),
+        'historico (gabinete)': pagina(RegistroUso.gabinete_vereador == LISTA_GABINETES[0][0], *periodo),
+        'historico (veículo)': pagina(RegistroUso.veiculo_id == 1, *periodo),
+        'historico (gráfico)': (db.session.query(ResumoDiario.veiculo_id, func.sum(ResumoDiario.km_total))
+                                .filter(ResumoDiario.dia >= agora.date().replace(year=agora.year - 1))
+                                .group_by(ResumoDiario.veiculo_id)),
+        'exportar_excel': RegistroUso.query.filter(RegistroUso.veiculo_id == 1, *periodo)
+                          .order_by(RegistroUso.data_hora_saida.desc(), RegistroUso.id.desc()),
+        'relatorio_ocorrencias': RegistroUso.query.filter(RegistroUso.km_chegada != None)
+                                 .order_by(FIM_VIAGEM.desc(), RegistroUso.id.desc())
+                                 .limit(current_app.config['OCORRENCIAS_POR_PAGINA'] + 1),
+        'agregados (por dia)': (db.session.query(ResumoDiario.dia, func.sum(ResumoDiario.viagens))
+                                .filter(ResumoDiario.dia >= agora.date().replace(year=agora.year - 1))
+                                .group_by(ResumoDiario.dia)),
+        'painel_admin (ranking)': (db.session.query(ResumoDiario.gabinete_vereador, func.sum(ResumoDiario.km_total))
+                                   .group_by(ResumoDiario.gabinete_vereador)),
+        'atualizar_resumo': RegistroUso.query.filter(RegistroUso.veiculo_id == 1, RegistroUso.gabinete_vereador == LISTA_GABINETES[0][0],
+                                                     *periodo, RegistroUso.km_chegada != None),
+        'painel_admin (km por veículo)': (db.session.query(RegistroUso.veiculo_id, func.max(RegistroUso.km_chegada))
+                                          .filter(RegistroUso.km_chegada != None)
+                                          .group_by(RegistroUso.veiculo_id)),
+        'atualizar_km_veiculo': db.session.query(func.max(RegistroUso.km_chegada)).filter(RegistroUso.veiculo_id == 1),
+        'validar_odometro (viagem anterior)': (db.session.query(RegistroUso.id, RegistroUso.km_saida, RegistroUso.km_chegada)
+                                              .filter(RegistroUso.veiculo_id == 1, RegistroUso.data_hora_saida <= agora,
+                                                      or_(RegistroUso.data_hora_saida < agora,
+                                                          and_(RegistroUso.data_hora_saida == agora, RegistroUso.id < 1)))
+                                              .order_by(RegistroUso.data_hora_saida.desc(), RegistroUso.id.desc()).limit(1)),
+        'fotos da viagem': FotoOcorrencia.query.filter_by(registro_id=1),
+        'processar-relatorios (próxima da fila)': (db.session.query(TarefaRelatorio.id).filter_by(status='pendente')
+                                                   .order_by(TarefaRelatorio.id).limit(1)),
+        'processar-relatorios (expirados)': TarefaRelatorio.query.filter(TarefaRelatorio.status == 'concluido',
+                                                                         TarefaRelatorio.expira_em < agora),
+    }
+
+@principal.cli.command('verificar-indices')
+def verificar_indices_cmd():
+    """
+    Roda EXPLAIN QUERY PLAN (SQLite) nas consultas das rotas e falha se alguma
+    fizer varredura completa da tabela em vez de usar um índice.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        print("Verificação disponível apenas para SQLite.")
+        return
+    falhas = []
+    for nome, consulta in consultas_das_rotas().items():
+        sql = str(consulta.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+        plano = [linha[-1] for linha in db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql))]
+        varreduras = [p for p in plano if p.startswith('SCAN') and 'INDEX' not in p]
+        print(f"[{'ERRO' if varreduras else 'OK'}] {nome}: {' | '.join(plano)}")
+        if varreduras:
+            falhas.append(nome)
+    if falhas:
+        raise SystemExit(f"Consultas sem índice: {', '.join(falhas)}")
 
 # --- INICIALIZAÇÃO ---
-if __name__ == '__main__':
+def create_app(config=None):
+    """
+    Monta um app: configuração do ambiente (com 'config' por cima), banco,
+    login, métricas e os blueprints. Os de administração, relatórios e
+    arquivos (rotas/) só são importados aqui, não no import deste módulo.
+    """
+    app = Flask(__name__)
+    carregar_config(app)
+    if config:
+        app.config.update(config)
+    if app.config['PROXY_SALTOS']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_SALTOS'], x_proto=app.config['PROXY_SALTOS'])
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    app.request_class = RequisicaoFrota
+    app.jinja_env.globals['fotos_em_processamento'] = fotos_em_processamento
+    # Vagas de verificação de senha deste processo (ver verificar_senha)
+    app.extensions['vagas_hash'] = threading.BoundedSemaphore(app.config['LOGIN_HASH_CONCORRENCIA'])
+
+    db.init_app(app)
+    login_manager.init_app(app)
     with app.app_context():
-        db.create_all()
-    app.run(debug=True)
+        if db.engine.dialect.name == 'sqlite' and app.config['SQLITE_PRAGMAS']:
+            event.listen(db.engine, 'connect', partial(configurar_sqlite, app.config))
+    if app.config['METRICAS_ATIVAS']:
+        ativar_metricas(app)
+
+    # Os módulos de rotas/ importam deste: o import fica aqui dentro
+    from rotas.admin import admin
+    from rotas.relatorios import relatorios
+    from rotas.uploads import uploads
+    for blueprint in (principal, admin, relatorios, uploads):
+        app.register_blueprint(blueprint)
+    return app
+
+def __getattr__(nome):
+    # `gunicorn app:app`, FLASK_APP=app.py e `from app import app` nos scripts:
+    # o app padrão só é montado no primeiro acesso a app.app
+    if nome == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
+
+if __name__ == '__main__':
+    # Como script este arquivo é o __main__, mas rotas/ importa o módulo 'app':
+    # o servidor sai de lá, para os blueprints e os modelos serem os mesmos
+    import app as modulo
+    servidor = modulo.create_app()
+    with servidor.app_context():
+        modulo.migrar_banco()
+    servidor.run(debug=True)
 
 
@@ -0,0 +1,140 @@
+"""
+Benchmark de leitura/escrita concorrente no SQLite: perfil padrão x perfil
+de produção (WAL, busy_timeout, synchronous=NORMAL, mmap, cache).
+
+Cada perfil roda num subprocesso com um banco novo. Threads leitoras repetem
+as consultas do histórico e do painel; threads escritoras abrem e fecham
+viagens, como registrar_saida/registrar_chegada.
+
+Uso:
+    python benchmark_banco.py [--segundos 10] [--leitores 8] [--escritores 4] [--viagens 20000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+PERFIS = {
+    # Como o app era antes: pragmas padrão e timeout padrão do pysqlite (5 s)
+    'padrao': {'SQLITE_PRAGMAS': '0', 'SQLITE_BUSY_TIMEOUT_MS': '5000'},
+    'producao': {'SQLITE_PRAGMAS': '1'},
+}
+
+
+def popular(app_mod, viagens):
+    from werkzeug.security import generate_password_hash
+    app, db = app_mod.app, app_mod.db
+    with app.app_context():
+        app_mod.migrar_banco()
+        usuario = app_mod.Usuario(nome='Bench', cpf='00000000000', senha=generate_password_hash('x'), cargo='Motorista')
+        db.session.add(usuario)
+        veiculos = [app_mod.Veiculo(modelo=f'Carro {i}', placa=f'BEN{i:04d}') for i in range(20)]
+        db.session.add_all(veiculos)
+        db.session.commit()
+        inicio = datetime(2022, 1, 1)
+        linhas = [{
+            'usuario_id': usuario.id, 'gabinete_vereador': app_mod.LISTA_GABINETES[i % 15][0],
+            'motorista_nome': 'Bench', 'veiculo_id': veiculos[i % 20].id,
+            'data_hora_saida': inicio + timedelta(hours=i), 'km_saida': i * 10.0, 'foto_km_saida': 'x.jpg',
+            'data_hora_chegada': inicio + timedelta(hours=i, minutes=40), 'km_chegada': i * 10.0 + 8,
+        } for i in range(viagens)]
+        db.session.execute(app_mod.RegistroUso.__table__.insert(), linhas)
+        db.session.commit()
+        return usuario.id, [v.id for v in veiculos]
+
+
+def executar(segundos, leitores, escritores, viagens):
+    import app as app_mod
+    from sqlalchemy import func
+    app, db, RegistroUso = app_mod.app, app_mod.db, app_mod.RegistroUso
+    usuario_id, veiculos = popular(app_mod, viagens)
+
+    contagem = {'leituras': 0, 'escritas': 0, 'erros': 0}
+    lock = threading.Lock()
+    fim = time.perf_counter() + segundos
+
+    def somar(chave):
+        with lock:
+            contagem[chave] += 1
+
+    def leitor():
+        with app.app_context():
+            while time.perf_counter() < fim:
+                try:
+                    RegistroUso.query.order_by(RegistroUso.data_hora_saida.desc(), RegistroUso.id.desc()).limit(51).all()
+                    db.session.query(RegistroUso.gabinete_vereador, func.sum(RegistroUso.km_chegada - RegistroUso.km_saida)) \
+                        .filter(RegistroUso.km_chegada != None).group_by(RegistroUso.gabinete_vereador).all()
+                    somar('leituras')
+                except Exception:
+                    db.session.rollback()
+                    somar('erros')
+                db.session.remove()
+
+    def escritor(veiculo_id):
+        with app.app_context():
+            km = 1_000_000.0
+            while time.perf_counter() < fim:
+                try:
+                    viagem = RegistroUso(usuario_id=usuario_id, gabinete_vereador='Bench', motorista_nome='Bench',
+                                         veiculo_id=veiculo_id, km_saida=km, foto_km_saida='x.jpg')
+                    db.session.add(viagem)
+                    db.session.commit()
+                    viagem.km_chegada = km + 5
+                    viagem.data_hora_chegada = datetime.now()
+                    app_mod.atualizar_km_veiculo(veiculo_id)
+                    db.session.commit()
+                    km += 10
+                    somar('escritas')
+                except Exception:
+                    db.session.rollback()
+                    somar('erros')
+                db.session.remove()
+
+    threads = [threading.Thread(target=leitor) for _ in range(leitores)]
+    threads += [threading.Thread(target=escritor, args=(veiculos[i % len(veiculos)],)) for i in range(escritores)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(json.dumps({
+        'leituras_por_s': round(contagem['leituras'] / segundos, 1),
+        'escritas_por_s': round(contagem['escritas'] / segundos, 1),
+        'erros': contagem['erros'],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--leitores', type=int, default=8)
+    parser.add_argument('--escritores', type=int, default=4)
+    parser.add_argument('--viagens', type=int, default=20000)
+    parser.add_argument('--executar', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar:
+        executar(args.segundos, args.leitores, args.escritores, args.viagens)
+        return
+
+    print(f"{args.leitores} leitores, {args.escritores} escritores, {args.viagens} viagens, {args.segundos:g} s por perfil")
+    for nome, ambiente in PERFIS.items():
+        with tempfile.TemporaryDirectory() as pasta:
+            env = dict(os.environ, **ambiente, DATABASE_URL=f"sqlite:///{os.path.join(pasta, 'bench.db')}",
+                       FOTOS_EM_SEGUNDO_PLANO='0', METRICAS_ATIVAS='0')
+            comando = [sys.executable, os.path.abspath(__file__), '--executar',
+                       '--segundos', str(args.segundos), '--leitores', str(args.leitores),
+                       '--escritores', str(args.escritores), '--viagens', str(args.viagens)]
+            saida = subprocess.run(comando, capture_output=True, text=True, check=True, env=env,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+            r = json.loads(saida.stdout.strip().splitlines()[-1])
+            print(f"{nome:>9}: {r['leituras_por_s']:8.1f} leituras/s  {r['escritas_por_s']:8.1f} escritas/s  erros {r['erros']}")
+
+
+if __name__ == '__main__':
+    main()
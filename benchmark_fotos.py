@@ -0,0 +1,100 @@
+"""
+Benchmark da compactação de fotos: implementação antiga x compactar_imagem().
+
+Cada implementação roda num subprocesso separado, para medir o pico de
+memória (RSS) de forma isolada. Usa as imagens de uploads/ e, com
+--sintetico, acrescenta uma foto de celular de 12 MP gerada na hora.
+
+Uso:
+    python benchmark_fotos.py [pasta] [--repeticoes N] [--sintetico]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+EXTENSOES = ('.jpg', '.jpeg', '.png')
+
+
+def compactar_original(origem, destino):
+    """Implementação anterior de salvar_foto_compacta (decodifica tudo antes de reduzir)."""
+    from PIL import Image
+    img = Image.open(origem)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((800, 800))
+    img.save(destino, "JPEG", quality=50)
+
+
+def listar_imagens(pasta, sintetico):
+    arquivos = sorted(
+        os.path.join(pasta, f) for f in os.listdir(pasta)
+        if f.lower().endswith(EXTENSOES)
+    )
+    if sintetico:
+        from PIL import Image
+        caminho = os.path.join(tempfile.gettempdir(), 'benchmark_12mp.jpg')
+        if not os.path.exists(caminho):
+            Image.effect_noise((4000, 3000), 64).convert('RGB').save(caminho, 'JPEG', quality=90)
+        arquivos.append(caminho)
+    return arquivos
+
+
+def executar(implementacao, arquivos, repeticoes):
+    """Roda dentro do subprocesso e imprime o resultado em JSON."""
+    # Importa o app nos dois casos, para o pico de RSS comparar só o algoritmo
+    from app import compactar_imagem, create_app
+    funcao = compactar_imagem if implementacao == 'atual' else compactar_original
+
+    destino = os.path.join(tempfile.gettempdir(), 'benchmark_saida.jpg')
+    # compactar_imagem lê o limite de pixels de current_app.config
+    with create_app().app_context():
+        inicio = time.perf_counter()
+        for _ in range(repeticoes):
+            for arquivo in arquivos:
+                funcao(arquivo, destino)
+        tempo = time.perf_counter() - inicio
+
+    # ru_maxrss: KB no Linux, bytes no macOS
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    pico_mb = pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+    print(json.dumps({
+        'implementacao': implementacao,
+        'imagens': len(arquivos) * repeticoes,
+        'tempo_total_s': round(tempo, 3),
+        'ms_por_imagem': round(tempo * 1000 / (len(arquivos) * repeticoes), 2),
+        'pico_rss_mb': round(pico_mb, 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pasta', nargs='?', default='uploads')
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--sintetico', action='store_true', help='inclui uma foto JPEG de 12 MP')
+    parser.add_argument('--executar', choices=['original', 'atual'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    arquivos = listar_imagens(args.pasta, args.sintetico)
+    if args.executar:
+        executar(args.executar, arquivos, args.repeticoes)
+        return
+
+    print(f"{len(arquivos)} imagens x {args.repeticoes} repetições")
+    for implementacao in ('original', 'atual'):
+        comando = [sys.executable, __file__, args.pasta, '--repeticoes', str(args.repeticoes), '--executar', implementacao]
+        if args.sintetico:
+            comando.append('--sintetico')
+        saida = subprocess.run(comando, capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        r = json.loads(saida.stdout.strip().splitlines()[-1])
+        print(f"{r['implementacao']:>9}: {r['tempo_total_s']:8.3f} s  "
+              f"{r['ms_por_imagem']:8.2f} ms/imagem  pico RSS {r['pico_rss_mb']:7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Benchmark da inicialização: tempo de import do app.py mais create_app() e
+memória (RSS) por worker, com as dependências pesadas carregadas sob demanda x carregadas no
+import (como era antes: openpyxl/numpy, Pillow, dialeto do PostgreSQL e
+ProcessPoolExecutor no topo do arquivo).
+
+Cada medida roda num processo novo, como um worker do gunicorn subindo.
+Depois do import, mede a primeira requisição (GET /login) e o custo do
+primeiro uso das partes carregadas sob demanda (exportar Excel).
+
+Com --gunicorn N, sobe também um gunicorn de verdade com N workers e mede o
+tempo até a primeira resposta e o RSS de cada worker.
+
+Uso:
+    python benchmark_inicializacao.py [--repeticoes 5] [--gunicorn 3]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# O que o app.py importava no topo antes de virar importação sob demanda
+IMPORTS_ANTECIPADOS = [
+    'openpyxl', 'openpyxl.styles', 'openpyxl.cell', 'openpyxl.utils', 'openpyxl.worksheet.cell_range',
+    'PIL.Image', 'PIL.ExifTags', 'sqlalchemy.dialects.postgresql', 'concurrent.futures.process',
+]
+MODULOS_PESADOS = ['openpyxl', 'numpy', 'PIL', 'pandas', 'boto3']
+
+
+def rss_mb(pid='self'):
+    """RSS atual (Linux, /proc); se não houver /proc, o pico do processo."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for linha in f:
+                if linha.startswith('VmRSS:'):
+                    return int(linha.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    import resource
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+
+
+def executar(modo):
+    """Roda dentro do subprocesso e imprime o resultado em JSON."""
+    import importlib
+    inicio = time.perf_counter()
+    if modo == 'antecipado':
+        for nome in IMPORTS_ANTECIPADOS:
+            importlib.import_module(nome)
+    import app as app_mod
+    app = app_mod.create_app()
+    tempo_import = time.perf_counter() - inicio
+    rss_import = rss_mb()
+    carregados = [m for m in MODULOS_PESADOS if m in sys.modules]
+
+    with app.app_context():
+        app_mod.migrar_banco()
+    cliente = app.test_client()
+    inicio = time.perf_counter()
+    cliente.get('/login')
+    primeira = time.perf_counter() - inicio
+    rss_requisicao = rss_mb()
+
+    # Primeiro uso do Excel: aqui o openpyxl é carregado (no modo sob demanda)
+    inicio = time.perf_counter()
+    from rotas.relatorios import gerar_excel_relatorio
+    with app.app_context(), tempfile.TemporaryFile() as destino:
+        gerar_excel_relatorio([], destino)
+    primeiro_excel = time.perf_counter() - inicio
+
+    print(json.dumps({
+        'import_ms': round(tempo_import * 1000, 1),
+        'primeira_requisicao_ms': round(primeira * 1000, 1),
+        'primeiro_excel_ms': round(primeiro_excel * 1000, 1),
+        'rss_import_mb': round(rss_import, 1),
+        'rss_primeira_requisicao_mb': round(rss_requisicao, 1),
+        'rss_depois_excel_mb': round(rss_mb(), 1),
+        'modulos_no_import': carregados,
+    }))
+
+
+def ambiente(pasta):
+    return dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(pasta, 'bench.db')}",
+                FOTOS_EM_SEGUNDO_PLANO='0', METRICAS_ATIVAS='0')
+
+
+def medir_gunicorn(workers):
+    """Sobe um gunicorn com N workers; devolve (s até a 1ª resposta, [RSS de cada worker])."""
+    pasta_app = os.path.dirname(os.path.abspath(__file__))
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        porta = s.getsockname()[1]
+    with tempfile.TemporaryDirectory() as pasta:
+        env = ambiente(pasta)
+        subprocess.run([sys.executable, '-c', 'import app\nwith app.app.app_context(): app.migrar_banco()'],
+                       check=True, env=env, cwd=pasta_app, capture_output=True)
+        inicio = time.perf_counter()
+        processo = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{porta}', 'app:app'],
+                                    env=env, cwd=pasta_app, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{porta}/login', timeout=1).read()
+                    break
+                except OSError:
+                    if processo.poll() is not None or time.perf_counter() - inicio > 60:
+                        raise SystemExit('gunicorn não respondeu')
+                    time.sleep(0.02)
+            primeira = time.perf_counter() - inicio
+            # Espera todos os workers terminarem de importar o app
+            time.sleep(2)
+            with open(f'/proc/{processo.pid}/task/{processo.pid}/children') as f:
+                filhos = f.read().split()
+            return primeira, [rss_mb(pid) for pid in filhos]
+        finally:
+            processo.terminate()
+            processo.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--gunicorn', type=int, default=0, metavar='WORKERS',
+                        help='mede também um gunicorn com esse número de workers (Linux)')
+    parser.add_argument('--executar', choices=['sob_demanda', 'antecipado'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar:
+        executar(args.executar)
+        return
+
+    print(f"{args.repeticoes} processos novos por modo (medianas)")
+    for modo in ('antecipado', 'sob_demanda'):
+        resultados = []
+        for _ in range(args.repeticoes):
+            with tempfile.TemporaryDirectory() as pasta:
+                saida = subprocess.run([sys.executable, os.path.abspath(__file__), '--executar', modo],
+                                       capture_output=True, text=True, check=True, env=ambiente(pasta),
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+                resultados.append(json.loads(saida.stdout.strip().splitlines()[-1]))
+        mediana = lambda chave: statistics.median(r[chave] for r in resultados)
+        print(f"{modo:>12}: import+create_app {mediana('import_ms'):7.1f} ms  1ª requisição {mediana('primeira_requisicao_ms'):6.1f} ms  "
+              f"1º excel {mediana('primeiro_excel_ms'):6.1f} ms  RSS {mediana('rss_import_mb'):6.1f} MB no import, "
+              f"{mediana('rss_primeira_requisicao_mb'):6.1f} MB na 1ª requisição, {mediana('rss_depois_excel_mb'):6.1f} MB depois do excel"
+              f"  ({', '.join(resultados[0]['modulos_no_import']) or 'nenhum pesado no import'})")
+
+    if args.gunicorn:
+        primeira, rss = medir_gunicorn(args.gunicorn)
+        print(f"gunicorn -w {args.gunicorn}: 1ª resposta em {primeira * 1000:.0f} ms, "
+              f"RSS por worker {', '.join(f'{r:.1f}' for r in rss)} MB (total {sum(rss):.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""
+Benchmark das jornadas principais do sistema, para comparar commits.
+
+Cria num diretório temporário um banco sintético (veículos, usuários,
+viagens e fotos de ocorrência) e percorre com o test client do Flask:
+login, registrar_saida com foto, registrar_chegada com várias fotos de
+ocorrência, historico com filtros, painel_admin, relatorio_ocorrencias e
+exportar_excel. Para cada cenário mede latência (p50/p95/p99), número de
+comandos SQL por requisição e pico de memória Python (tracemalloc, numa
+rodada extra fora da medição de tempo), e imprime tudo em JSON.
+
+Uso:
+    python benchmark_jornadas.py [--veiculos 20] [--usuarios 50] [--viagens 20000]
+                                 [--fotos 300] [--repeticoes 30] [--saida resultado.json]
+
+Para comparar dois commits, rode o script em cada um com os mesmos
+parâmetros e compare os arquivos gerados com --saida.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+PASTA_APP = os.path.dirname(os.path.abspath(__file__))
+SENHA = 'bench123'
+
+
+def jpeg(largura, altura, semente):
+    """Foto sintética em memória (ruído comprime mal, como uma foto real)."""
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.effect_noise((largura, altura), 32 + semente % 32).convert('RGB').save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def popular(app_mod, args):
+    from sqlalchemy import func
+    app, db = app_mod.app, app_mod.db
+    aleatorio = random.Random(42)
+    gabinetes = [g for g, _ in app_mod.LISTA_GABINETES]
+    with app.app_context():
+        app_mod.migrar_banco()
+        # Mesmo hash para todos: o login mede a verificação, não o cadastro
+        hash_senha = app_mod.gerar_hash_senha(SENHA)
+        usuarios = [{'nome': 'Admin Bench', 'cpf': f'{0:011d}', 'senha': hash_senha, 'cargo': 'Admin',
+                     'ativo': True, 'gabinete': gabinetes[0]}]
+        usuarios += [{'nome': f'Motorista {i}', 'cpf': f'{i:011d}', 'senha': hash_senha, 'cargo': 'Motorista',
+                      'ativo': True, 'gabinete': gabinetes[i % len(gabinetes)]} for i in range(1, args.usuarios + 1)]
+        db.session.execute(app_mod.Usuario.__table__.insert(), usuarios)
+        db.session.execute(app_mod.Veiculo.__table__.insert(), [
+            {'modelo': f'Carro {i}', 'placa': f'BEN{i:04d}', 'km_atual': 0, 'km_revisao_proxima': 10000}
+            for i in range(args.veiculos)])
+        db.session.commit()
+        ids_usuarios = [u for (u,) in db.session.query(app_mod.Usuario.id).filter(app_mod.Usuario.cargo == 'Motorista')]
+        ids_veiculos = [v for (v,) in db.session.query(app_mod.Veiculo.id)]
+
+        # Fotos: poucos arquivos reais reaproveitados por muitos registros
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        arquivos = []
+        for i in range(min(args.fotos, 20)):
+            nome = f'bench_{i}.jpg'
+            with open(os.path.join(app.config['UPLOAD_FOLDER'], nome), 'wb') as f:
+                f.write(jpeg(800, 600, i))
+            arquivos.append(nome)
+
+        inicio = datetime.now() - timedelta(days=3 * 365)
+        passo = (3 * 365 * 24 * 3600) / max(args.viagens, 1)
+        km = {v: 10000.0 for v in ids_veiculos}
+        lote = []
+        for i in range(args.viagens):
+            veiculo = ids_veiculos[i % len(ids_veiculos)]
+            usuario = ids_usuarios[i % len(ids_usuarios)]
+            saida = inicio + timedelta(seconds=i * passo)
+            distancia = aleatorio.uniform(2, 80)
+            lote.append({
+                'usuario_id': usuario, 'gabinete_vereador': gabinetes[usuario % len(gabinetes)],
+                'motorista_nome': f'Motorista {usuario}', 'veiculo_id': veiculo,
+                'data_hora_saida': saida, 'km_saida': km[veiculo], 'foto_km_saida': arquivos[i % len(arquivos)],
+                'data_hora_chegada': saida + timedelta(minutes=aleatorio.randint(15, 240)),
+                'km_chegada': km[veiculo] + distancia, 'foto_km_chegada': arquivos[(i + 1) % len(arquivos)],
+                'destino_finalidade': f'Destino {i % 97}',
+                'observacoes': 'Pneu furado' if i % 50 == 0 else None,
+            })
+            km[veiculo] += distancia
+            if len(lote) == 5000:
+                db.session.execute(app_mod.RegistroUso.__table__.insert(), lote)
+                lote = []
+        if lote:
+            db.session.execute(app_mod.RegistroUso.__table__.insert(), lote)
+        db.session.commit()
+
+        ultimo_id = db.session.query(func.max(app_mod.RegistroUso.id)).scalar() or 0
+        if ultimo_id:
+            db.session.execute(app_mod.FotoOcorrencia.__table__.insert(), [
+                {'registro_id': aleatorio.randint(1, ultimo_id), 'caminho_foto': arquivos[i % len(arquivos)]}
+                for i in range(args.fotos)])
+        for veiculo, valor in km.items():
+            db.session.get(app_mod.Veiculo, veiculo).km_atual = int(valor)
+        db.session.commit()
+        app_mod.reconstruir_resumo()
+        return ids_veiculos
+
+
+def executar(args):
+    import app as app_mod
+    from sqlalchemy import event
+    app, db = app_mod.app, app_mod.db
+    app.config['WTF_CSRF_ENABLED'] = False
+    from rotas.relatorios import processar_fila_relatorios
+    veiculos = popular(app_mod, args)
+
+    contador = {'sql': 0}
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: contador.__setitem__('sql', contador['sql'] + 1))
+
+    admin = app.test_client()
+    admin.post('/login', data={'cpf': f'{0:011d}', 'senha': SENHA})
+    motorista = app.test_client()
+    motorista.post('/login', data={'cpf': f'{1:011d}', 'senha': SENHA})
+
+    hoje = datetime.now()
+    filtros = [
+        {},
+        {'data_inicio': (hoje - timedelta(days=30)).strftime('%Y-%m-%d'), 'data_fim': hoje.strftime('%Y-%m-%d')},
+        {'data_inicio': (hoje - timedelta(days=365)).strftime('%Y-%m-%d'), 'gabinete': app_mod.LISTA_GABINETES[1][0]},
+        {'veiculo': str(veiculos[0])},
+    ]
+    foto_painel = jpeg(1600, 1200, 1)
+    foto_ocorrencia = jpeg(1600, 1200, 2)
+    estado = {'viagem': None, 'km': 10_000_000.0}
+    carro = veiculos[-1]
+
+    def login(i):
+        cliente = app.test_client()
+        return cliente.post('/login', data={'cpf': f'{1 + i % args.usuarios:011d}', 'senha': SENHA})
+
+    def saida(i):
+        return motorista.post('/registrar-saida', content_type='multipart/form-data', data={
+            'veiculo_modelo': str(carro), 'km_saida': str(estado['km']), 'destino_finalidade': 'Benchmark',
+            'foto_km_saida': (io.BytesIO(foto_painel), 'painel.jpg')})
+
+    def localizar_viagem():
+        """Id da viagem aberta pela última saída (fora da medição)."""
+        with app.app_context():
+            estado['viagem'] = db.session.query(app_mod.RegistroUso.id).filter_by(veiculo_id=carro, km_chegada=None).scalar()
+
+    def chegada(i):
+        estado['km'] += 12
+        return motorista.post('/registrar-chegada', content_type='multipart/form-data', data={
+            'registro_id': str(estado['viagem']), 'km_chegada': str(estado['km']),
+            'foto_km_chegada': (io.BytesIO(foto_painel), 'painel.jpg'), 'observacoes': 'Benchmark',
+            'foto_ocorrencia': [(io.BytesIO(foto_ocorrencia), f'ocorrencia{n}.jpg') for n in range(args.fotos_por_chegada)]})
+
+    def exportar(i):
+        """Pedido na fila, worker (aqui no mesmo processo) e download: o tempo até ter a planilha."""
+        pedido = admin.get('/exportar-excel', query_string=filtros[1 + i % 2])
+        with app.app_context():
+            processar_fila_relatorios()
+        return admin.get(pedido.location + '/download')
+
+    # (nome, etapas, repetições); cada etapa = (nome, função, status esperado).
+    # Saída e chegada se alternam no mesmo carro, para ele estar livre a cada saída.
+    cenarios = [
+        ('login', [('login', login, 302)], args.repeticoes),
+        ('viagem', [('registrar_saida', saida, 302), ('registrar_chegada', chegada, 302)], args.repeticoes),
+        ('historico', [('historico', lambda i: admin.get('/historico', query_string=filtros[i % len(filtros)]), 200)],
+         args.repeticoes),
+        ('painel_admin', [('painel_admin', lambda i: admin.get('/admin/dashboard'), 200)], args.repeticoes),
+        ('relatorio_ocorrencias', [('relatorio_ocorrencias', lambda i: admin.get('/relatorio-ocorrencias'), 200)],
+         args.repeticoes),
+        ('exportar_excel', [('exportar_excel', exportar, 200)],
+         args.repeticoes_excel),
+    ]
+
+    resultados = {}
+    for _, etapas, repeticoes in cenarios:
+        for i in range(repeticoes):
+            for nome, funcao, esperado in etapas:
+                r = resultados.setdefault(nome, {'tempos': [], 'sqls': [], 'erros': 0})
+                contador['sql'] = 0
+                inicio = time.perf_counter()
+                resposta = funcao(i)
+                resposta.get_data()
+                r['tempos'].append(time.perf_counter() - inicio)
+                r['sqls'].append(contador['sql'])
+                r['erros'] += resposta.status_code != esperado
+                if nome == 'registrar_saida':
+                    localizar_viagem()
+
+    # Pico de memória numa rodada à parte (o tracemalloc deixa tudo mais lento)
+    for _, etapas, _ in cenarios:
+        for nome, funcao, _ in etapas:
+            tracemalloc.start()
+            funcao(0).get_data()
+            resultados[nome]['pico_python_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+            tracemalloc.stop()
+            if nome == 'registrar_saida':
+                localizar_viagem()
+
+    pool = app_mod._fila_fotos['pool']
+    if pool:
+        pool.shutdown(wait=True)
+
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    saida_json = {
+        'parametros': {k: v for k, v in vars(args).items() if k not in ('executar', 'saida')},
+        'cenarios': {
+            nome: {
+                'requisicoes': len(r['tempos']),
+                'p50_ms': round(app_mod.percentil(r['tempos'], 50) * 1000, 2),
+                'p95_ms': round(app_mod.percentil(r['tempos'], 95) * 1000, 2),
+                'p99_ms': round(app_mod.percentil(r['tempos'], 99) * 1000, 2),
+                'max_ms': round(max(r['tempos']) * 1000, 2),
+                'sql_por_requisicao': round(sum(r['sqls']) / len(r['sqls']), 1),
+                'sql_max': max(r['sqls']),
+                'pico_python_mb': r.get('pico_python_mb'),
+                'erros': r['erros'],
+            }
+            for nome, r in resultados.items()
+        },
+        'pico_rss_mb': round(pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024, 1),
+    }
+    print(json.dumps(saida_json))
+
+
+def commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=PASTA_APP, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--veiculos', type=int, default=20)
+    parser.add_argument('--usuarios', type=int, default=50)
+    parser.add_argument('--viagens', type=int, default=20000)
+    parser.add_argument('--fotos', type=int, default=300, help='fotos de ocorrência já existentes no banco')
+    parser.add_argument('--fotos-por-chegada', type=int, default=3)
+    parser.add_argument('--repeticoes', type=int, default=30)
+    parser.add_argument('--repeticoes-excel', type=int, default=5)
+    parser.add_argument('--saida', help='grava o JSON também neste arquivo')
+    parser.add_argument('--executar', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar:
+        executar(args)
+        return
+
+    # Banco, uploads e relatórios num diretório temporário: o processo filho roda com ele como cwd
+    with tempfile.TemporaryDirectory() as pasta:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(pasta, 'bench.db')}", METRICAS_ATIVAS='0',
+                   RELATORIOS_NO_PROCESSO='0', RELATORIOS_PASTA=os.path.join(pasta, 'relatorios'))
+        comando = [sys.executable, os.path.abspath(__file__), '--executar']
+        for opcao in ('veiculos', 'usuarios', 'viagens', 'fotos', 'fotos_por_chegada', 'repeticoes', 'repeticoes_excel'):
+            comando += ['--' + opcao.replace('_', '-'), str(getattr(args, opcao))]
+        saida = subprocess.run(comando, capture_output=True, text=True, env=env, cwd=pasta)
+        if saida.returncode != 0:
+            sys.stderr.write(saida.stderr)
+            raise SystemExit(saida.returncode)
+    resultado = json.loads(saida.stdout.strip().splitlines()[-1])
+    resultado = {'commit': commit_atual(), 'data': datetime.now().isoformat(timespec='seconds'), **resultado}
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            f.write(texto + '\n')
+
+    # Requisição com status inesperado invalida a medida: o tempo de um erro não é o da jornada
+    com_erro = {nome: r['erros'] for nome, r in resultado['cenarios'].items() if r['erros']}
+    if com_erro:
+        sys.stderr.write(f"ERRO: requisições com status inesperado: {com_erro}\n")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
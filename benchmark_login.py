@@ -0,0 +1,110 @@
+"""
+Benchmark do login: logins por segundo com diferentes métodos de hash.
+
+Cada método roda num subprocesso com um banco novo e SENHA_METODO
+configurado. Várias threads fazem POST em /login ao mesmo tempo, como na
+chegada dos motoristas no início do expediente. Os usuários são criados
+com o hash "antigo" (padrão do werkzeug), então a primeira rodada também
+exercita a regravação do hash no login.
+
+Uso:
+    python benchmark_login.py [--usuarios 50] [--threads 8] [--logins 400]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+METODOS = ['scrypt', 'scrypt:16384:8:1', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:100000']
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def executar(usuarios, threads, logins):
+    import app as app_mod
+    from werkzeug.security import generate_password_hash
+    app, db = app_mod.app, app_mod.db
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        app_mod.migrar_banco()
+        hash_antigo = generate_password_hash('senha')
+        db.session.add_all([app_mod.Usuario(nome=f'Bench {i}', cpf=f'{i:011d}', senha=hash_antigo, cargo='Motorista')
+                            for i in range(usuarios)])
+        db.session.commit()
+
+    tempos, falhas = [], []
+    lock = threading.Lock()
+    fila = iter(range(logins))
+
+    def trabalhador():
+        cliente = app.test_client()
+        while True:
+            with lock:
+                n = next(fila, None)
+            if n is None:
+                return
+            # Cada requisição vem de um "IP" diferente para não cair no limite por IP
+            inicio = time.perf_counter()
+            resposta = cliente.post('/login', data={'cpf': f'{n % usuarios:011d}', 'senha': 'senha'},
+                                    environ_base={'REMOTE_ADDR': f'10.0.{n // 250 % 250}.{n % 250}'})
+            duracao = time.perf_counter() - inicio
+            with lock:
+                tempos.append(duracao)
+                if resposta.status_code != 302:
+                    falhas.append(resposta.status_code)
+            cliente.get('/logout')
+
+    inicio = time.perf_counter()
+    lista = [threading.Thread(target=trabalhador) for _ in range(threads)]
+    for t in lista:
+        t.start()
+    for t in lista:
+        t.join()
+    total = time.perf_counter() - inicio
+
+    print(json.dumps({
+        'logins_por_s': round(logins / total, 1),
+        'p50_ms': round(percentil(tempos, 50) * 1000, 1),
+        'p95_ms': round(percentil(tempos, 95) * 1000, 1),
+        'falhas': len(falhas),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--usuarios', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=400)
+    parser.add_argument('--metodos', nargs='+', default=METODOS)
+    parser.add_argument('--executar', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar:
+        executar(args.usuarios, args.threads, args.logins)
+        return
+
+    print(f"{args.usuarios} usuários, {args.threads} threads, {args.logins} logins por método")
+    for metodo in args.metodos:
+        with tempfile.TemporaryDirectory() as pasta:
+            env = dict(os.environ, SENHA_METODO=metodo, DATABASE_URL=f"sqlite:///{os.path.join(pasta, 'bench.db')}",
+                       FOTOS_EM_SEGUNDO_PLANO='0', METRICAS_ATIVAS='0')
+            comando = [sys.executable, os.path.abspath(__file__), '--executar', '--usuarios', str(args.usuarios),
+                       '--threads', str(args.threads), '--logins', str(args.logins)]
+            saida = subprocess.run(comando, capture_output=True, text=True, check=True, env=env,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+            r = json.loads(saida.stdout.strip().splitlines()[-1])
+            print(f"{metodo:>22}: {r['logins_por_s']:8.1f} logins/s  p50 {r['p50_ms']:7.1f} ms  "
+                  f"p95 {r['p95_ms']:7.1f} ms  falhas {r['falhas']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Blueprints de administração, relatórios e arquivos, registrados por app.create_app."""
@@ -0,0 +1,553 @@
+"""
+Administração: usuários, veículos, edição de viagens, painel, métricas e
+importação em lote. Só Admin usa estas rotas; o blueprint é registrado por
+create_app e o openpyxl da importação só é carregado quando há planilha.
+"""
+import csv
+import io
+import unicodedata
+from datetime import datetime
+import click
+from flask import Blueprint, abort, current_app, flash, redirect, render_template, request, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from app import (LISTA_GABINETES, CadastroUsuarioForm, ImportacaoForm, RegistroUso, ResumoDiario, Usuario, Veiculo,
+                 VeiculoForm, atualizar_km_veiculo, atualizar_resumo_viagem, db, gerar_hash_senha,
+                 invalidar_cache_usuarios, invalidar_frota, reconstruir_resumo, resumo_metricas, validar_odometro)
+
+admin = Blueprint('admin', __name__, cli_group=None)
+
+# --- GESTÃO DE USUÁRIOS ---
+@admin.route('/gestao-usuarios', methods=['GET', 'POST'])
+@login_required
+def gestao_usuarios():
+    if current_user.cargo != 'Admin':
+        flash('Acesso negado!', 'danger')
+        return redirect(url_for('principal.index'))
+    form = CadastroUsuarioForm()
+    if form.validate_on_submit():
+        cpf_limpo = form.cpf.data.replace('.', '').replace('-', '').strip()
+        existente = Usuario.query.filter_by(cpf=cpf_limpo).first()
+        if existente:
+            flash('CPF já cadastrado!', 'danger')
+        else:
+            novo_u = Usuario(
+                nome=form.nome.data, cpf=cpf_limpo,
+                senha=gerar_hash_senha(form.senha.data),
+                cargo=form.cargo.data, gabinete=form.gabinete.data, ativo=True
+            )
+            db.session.add(novo_u); db.session.commit()
+            flash('Usuário cadastrado!', 'success')
+            return redirect(url_for('admin.gestao_usuarios'))
+    usuarios = Usuario.query.all()
+    return render_template('gestao_usuarios.html', form=form, usuarios=usuarios)
+
+@admin.route('/editar-usuario/<int:id>', methods=['GET', 'POST'])
+@login_required
+def editar_usuario(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    usuario = db.session.get(Usuario, id)
+    if request.method == 'POST':
+        usuario.nome = request.form.get('nome')
+        usuario.cpf = request.form.get('cpf').replace('.', '').replace('-', '').strip()
+        usuario.gabinete = request.form.get('gabinete')
+        nova_senha = request.form.get('senha')
+        if nova_senha:
+            usuario.senha = gerar_hash_senha(nova_senha)
+        db.session.commit()
+        invalidar_cache_usuarios()
+        flash('Usuário atualizado!', 'success')
+        return redirect(url_for('admin.gestao_usuarios'))
+    return render_template('editar_usuario.html', usuario=usuario, gabinetes=LISTA_GABINETES)
+
+@admin.route('/alternar-status/<int:id>')
+@login_required
+def alternar_status(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    usuario = db.session.get(Usuario, id)
+    if usuario and usuario.id != current_user.id:
+        usuario.ativo = not usuario.ativo
+        db.session.commit()
+        invalidar_cache_usuarios()
+    return redirect(url_for('admin.gestao_usuarios'))
+
+@admin.route('/excluir-usuario/<int:id>')
+@login_required
+def excluir_usuario(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    usuario = db.session.get(Usuario, id)
+    if usuario and usuario.id != current_user.id:
+        db.session.delete(usuario)
+        db.session.commit()
+        invalidar_cache_usuarios()
+    return redirect(url_for('admin.gestao_usuarios'))
+
+# --- GESTÃO DE VEÍCULOS ---
+@admin.route('/gestao-veiculos', methods=['GET', 'POST'])
+@login_required
+def gestao_veiculos():
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    form = VeiculoForm()
+    if form.validate_on_submit():
+        novo_v = Veiculo(modelo=form.modelo.data, placa=form.placa.data.upper())
+        db.session.add(novo_v); db.session.commit()
+        flash('Veículo cadastrado!', 'success')
+        return redirect(url_for('admin.gestao_veiculos'))
+    veiculos = Veiculo.query.all()
+    return render_template('gestao_veiculos.html', form=form, veiculos=veiculos)
+
+@admin.route('/editar_veiculo/<int:id>', methods=['POST'])
+@login_required
+def editar_veiculo(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    veiculo = db.session.get(Veiculo, id)
+    if veiculo:
+        veiculo.modelo = request.form.get('modelo')
+        veiculo.placa = request.form.get('placa').upper()
+        db.session.commit()
+        flash('Veículo atualizado!', 'success')
+    return redirect(url_for('admin.gestao_veiculos'))
+
+@admin.route('/excluir-veiculo/<int:id>')
+@login_required
+def excluir_veiculo(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    v = db.session.get(Veiculo, id)
+    if v:
+        if v.registros:
+            flash('Não é possível excluir veículo com histórico!', 'danger')
+        else:
+            db.session.delete(v); db.session.commit()
+            flash('Veículo removido!', 'warning')
+    return redirect(url_for('admin.gestao_veiculos'))
+
+# --- VIAGENS E PAINEL ---
+@admin.route('/editar_viagem/<int:id>', methods=['GET', 'POST'])
+@login_required
+def editar_viagem(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    viagem = db.session.get(RegistroUso, id)
+    if request.method == 'POST':
+        km_saida = float(request.form.get('km_saida'))
+        km_chegada = float(request.form.get('km_chegada')) if request.form.get('km_chegada') else None
+        erros, alertas = validar_odometro(viagem.veiculo_id, km_saida, km_chegada, viagem=viagem)
+        if erros:
+            flash(f"{'; '.join(erros)}.", 'danger')
+            return redirect(url_for('admin.editar_viagem', id=id))
+        viagem.km_saida = km_saida
+        viagem.km_chegada = km_chegada
+        viagem.destino_finalidade = request.form.get('destino')
+        try:
+            atualizar_km_veiculo(viagem.veiculo_id)
+            atualizar_resumo_viagem(viagem)
+            db.session.commit(); flash('Viagem atualizada!', 'success')
+            for alerta in alertas:
+                flash(f'Confira: {alerta}.', 'warning')
+        except IntegrityError:
+            # Reabrir a viagem (sem KM de chegada) esbarra em outra viagem aberta do mesmo veículo
+            db.session.rollback()
+            flash('Este veículo já tem outra viagem em aberto.', 'danger')
+            return redirect(url_for('admin.editar_viagem', id=id))
+        return redirect(url_for('relatorios.historico'))
+    return render_template('editar_viagem.html', viagem=viagem)
+
+@admin.route('/admin/dashboard')
+@login_required
+def painel_admin():
+    if current_user.cargo != 'Admin':
+        flash('Acesso negado!', 'danger')
+        return redirect(url_for('principal.index'))
+
+    veiculos = Veiculo.query.all()
+
+    # 1. Ranking de Gabinetes (KM Total), somado a partir do resumo diário
+    distancia = func.sum(ResumoDiario.km_total)
+    ranking = (
+        db.session.query(ResumoDiario.gabinete_vereador, distancia)
+        .group_by(ResumoDiario.gabinete_vereador)
+        .order_by(distancia.desc())
+        .all()
+    )
+    ranking_ordenado = dict(ranking)
+
+    # 2. KM atual de cada veículo = maior KM de chegada registrado para ele.
+    # Só leitura: o valor gravado em Veiculo.km_atual é mantido em
+    # registrar_chegada/editar_viagem, então o GET nunca escreve no banco.
+    km_maximo = dict(
+        db.session.query(RegistroUso.veiculo_id, func.max(RegistroUso.km_chegada))
+        .filter(RegistroUso.km_chegada != None)
+        .group_by(RegistroUso.veiculo_id)
+        .all()
+    )
+    km_atual = {v.id: int(km_maximo.get(v.id, v.km_atual or 0)) for v in veiculos}
+
+    return render_template('painel_admin.html', 
+                           veiculos=veiculos, 
+                           km_atual=km_atual,
+                           ranking=ranking_ordenado)
+
+@admin.route('/admin/resetar-revisao/<int:id>')
+@login_required
+def resetar_revisao(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    v = db.session.get(Veiculo, id)
+    if v:
+        # Define a próxima revisão para daqui a 10.000 KM a partir do KM atual
+        v.km_revisao_proxima = v.km_atual + 10000
+        db.session.commit()
+        flash(f'Revisão do {v.modelo} atualizada para {v.km_revisao_proxima} KM!', 'success')
+    return redirect(url_for('admin.painel_admin'))
+
+# --- MÉTRICAS (coletadas em app.py com METRICAS_ATIVAS=1) ---
+@admin.route('/admin/metrics')
+@login_required
+def admin_metricas():
+    if current_user.cargo != 'Admin':
+        flash('Acesso negado!', 'danger')
+        return redirect(url_for('principal.index'))
+    return render_template('admin_metricas.html', ativas=current_app.config['METRICAS_ATIVAS'], resumo=resumo_metricas())
+
+@admin.route('/metrics')
+def metricas_prometheus():
+    """Formato texto do Prometheus. Com METRICAS_TOKEN, exige 'Authorization: Bearer <token>'; sem ele, login de Admin."""
+    token = current_app.config['METRICAS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f"Bearer {token}":
+            abort(401)
+    elif not (current_user.is_authenticated and current_user.cargo == 'Admin'):
+        abort(403)
+
+    linhas = []
+    def serie(nome, tipo, ajuda, valores):
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+        linhas.extend(f"{nome}{rotulos} {valor}" for rotulos, valor in valores)
+
+    resumo = resumo_metricas()
+    rotulo = lambda e, **extra: '{' + ','.join([f'endpoint="{e}"'] + [f'{k}="{v}"' for k, v in extra.items()]) + '}'
+    serie('frota_requisicao_segundos', 'summary', 'Tempo total da requisição (janela recente).',
+          [(rotulo(e, quantile=q), r[chave]) for e, r in resumo.items()
+           for q, chave in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99'))])
+    serie('frota_requisicoes_total', 'counter', 'Requisições atendidas desde o início do processo.',
+          [(rotulo(e), r['total']) for e, r in resumo.items()])
+    serie('frota_sql_consultas_media', 'gauge', 'Média de SQLs por requisição (janela recente).',
+          [(rotulo(e), r['sql_media']) for e, r in resumo.items()])
+    serie('frota_sql_segundos_media', 'gauge', 'Tempo médio em SQL por requisição (janela recente).',
+          [(rotulo(e), r['sql_tempo_medio']) for e, r in resumo.items()])
+    serie('frota_pillow_segundos_media', 'gauge', 'Tempo médio no Pillow por requisição (janela recente).',
+          [(rotulo(e), r['pillow_medio']) for e, r in resumo.items()])
+    return current_app.response_class('\n'.join(linhas) + '\n', mimetype='text/plain; version=0.0.4')
+
+# --- IMPORTAÇÃO EM LOTE ---
+# Nome da coluna (já normalizado) -> campo. Aceita também os cabeçalhos da planilha oficial.
+COLUNAS_IMPORTACAO = {
+    'veiculos': {
+        'modelo': 'modelo', 'veiculo': 'modelo', 'placa': 'placa',
+        'km_atual': 'km_atual', 'km_revisao_proxima': 'km_revisao_proxima', 'proxima_revisao': 'km_revisao_proxima',
+    },
+    'viagens': {
+        'placa': 'placa', 'cpf_motorista': 'cpf_motorista', 'motorista': 'motorista_nome', 'motorista_nome': 'motorista_nome',
+        'gabinete': 'gabinete_vereador', 'gabinete_vereador': 'gabinete_vereador',
+        'data_saida': 'data_hora_saida', 'data_hora_saida': 'data_hora_saida', 'saida': 'data_hora_saida',
+        'data_chegada': 'data_hora_chegada', 'data_hora_chegada': 'data_hora_chegada', 'chegada': 'data_hora_chegada',
+        'km_saida': 'km_saida', 'km_inicial': 'km_saida', 'km_chegada': 'km_chegada', 'km_final': 'km_chegada',
+        'destino': 'destino_finalidade', 'destino_finalidade': 'destino_finalidade', 'observacoes': 'observacoes',
+    },
+}
+CAMPOS_OBRIGATORIOS_IMPORTACAO = {
+    'veiculos': ('modelo', 'placa'),
+    'viagens': ('placa', 'data_hora_saida', 'km_saida', 'destino_finalidade', 'data_hora_chegada', 'km_chegada'),
+}
+GABINETE_PADRAO = "Administrativo/Geral"
+GABINETES_VALIDOS = {g for g, _ in LISTA_GABINETES} | {GABINETE_PADRAO}
+
+def _normalizar_cabecalho(nome):
+    """'DATA/HORA SAÍDA' -> 'data_hora_saida'."""
+    texto = unicodedata.normalize('NFKD', str(nome or '')).encode('ascii', 'ignore').decode()
+    return ''.join(c if c.isalnum() else '_' for c in texto.lower()).strip('_')
+
+def ler_planilha(arquivo, nome_arquivo, tipo):
+    """
+    Abre um CSV (',' ou ';') ou XLSX e devolve um gerador de (número da linha,
+    dict campo -> valor). As linhas são lidas uma a uma, sem carregar o
+    arquivo inteiro; linhas vazias são ignoradas. Falta de coluna
+    obrigatória gera ValueError antes da primeira linha.
+    """
+    livro = None
+    if nome_arquivo.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+        livro = load_workbook(arquivo, read_only=True, data_only=True)
+        linhas = livro.active.iter_rows(values_only=True)
+        cabecalho = next(linhas, ())
+    else:
+        texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')
+        primeira = texto.readline()
+        delimitador = ';' if primeira.count(';') > primeira.count(',') else ','
+        cabecalho = next(csv.reader([primeira], delimiter=delimitador), [])
+        linhas = csv.reader(texto, delimiter=delimitador)
+
+    mapa = COLUNAS_IMPORTACAO[tipo]
+    campos = [mapa.get(_normalizar_cabecalho(c)) for c in cabecalho]
+    faltando = [c for c in CAMPOS_OBRIGATORIOS_IMPORTACAO[tipo] if c not in campos]
+    if faltando:
+        if livro:
+            livro.close()
+        raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(faltando)}")
+
+    def gerar():
+        try:
+            for numero, valores in enumerate(linhas, start=2):
+                if all(v is None or str(v).strip() == '' for v in valores):
+                    continue
+                yield numero, {c: v for c, v in zip(campos, valores) if c}
+        finally:
+            if livro:
+                livro.close()
+    return gerar()
+
+def _texto(valor):
+    return str(valor).strip() if valor is not None else ''
+
+def _numero(valor, campo, obrigatorio=True):
+    """Aceita número do XLSX, '1234.5' ou '1.234,5'. Zero conta como vazio, como no FloatField com DataRequired."""
+    if isinstance(valor, (int, float)):
+        numero = float(valor)
+    else:
+        texto = _texto(valor)
+        if not texto:
+            numero = 0.0
+        else:
+            if ',' in texto:
+                texto = texto.replace('.', '').replace(',', '.')
+            try:
+                numero = float(texto)
+            except ValueError:
+                raise ValueError(f"{campo} inválido: {valor}")
+    if obrigatorio and not numero:
+        raise ValueError(f"{campo} obrigatório")
+    if numero < 0:
+        raise ValueError(f"{campo} negativo")
+    return numero
+
+def _data_hora(valor, campo):
+    if isinstance(valor, datetime):
+        return valor
+    texto = _texto(valor)
+    if not texto:
+        raise ValueError(f"{campo} obrigatório")
+    for formato in ('%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(texto)
+    except ValueError:
+        raise ValueError(f"{campo} inválida: {texto} (use dd/mm/aaaa hh:mm)")
+
+def validar_veiculo_importado(linha, contexto):
+    """Mesmas regras do VeiculoForm; placa repetida (no banco ou no arquivo) é erro."""
+    modelo = _texto(linha.get('modelo'))
+    placa = _texto(linha.get('placa')).upper()
+    if not modelo:
+        raise ValueError("modelo obrigatório")
+    if not 7 <= len(placa) <= 8:
+        raise ValueError(f"placa deve ter 7 ou 8 caracteres: {placa or '(vazia)'}")
+    if placa in contexto['placas']:
+        raise ValueError(f"placa {placa} já cadastrada")
+    contexto['placas'].add(placa)
+    return {
+        'modelo': modelo[:50],
+        'placa': placa,
+        'km_atual': int(_numero(linha.get('km_atual'), 'km_atual', obrigatorio=False)),
+        'km_revisao_proxima': int(_numero(linha.get('km_revisao_proxima'), 'km_revisao_proxima', obrigatorio=False) or 10000),
+    }
+
+def validar_viagem_importada(linha, contexto):
+    """
+    Regras de RegistroSaidaForm + RegistroChegadaForm (veículo existente, KM e
+    destino obrigatórios), mais as que a tela garante pelo fluxo: a viagem
+    importada já vem finalizada e a chegada não é anterior à saída.
+    """
+    placa = _texto(linha.get('placa')).upper()
+    if placa not in contexto['veiculos']:
+        raise ValueError(f"veículo com placa {placa or '(vazia)'} não cadastrado")
+    veiculo_id = contexto['veiculos'][placa]
+    if veiculo_id is None:
+        raise ValueError(f"placa {placa} pertence a mais de um veículo")
+
+    saida = _data_hora(linha.get('data_hora_saida'), 'data de saída')
+    chegada = _data_hora(linha.get('data_hora_chegada'), 'data de chegada')
+    km_saida = _numero(linha.get('km_saida'), 'KM de saída')
+    km_chegada = _numero(linha.get('km_chegada'), 'KM de chegada')
+    if chegada < saida:
+        raise ValueError("chegada anterior à saída")
+    if km_chegada < km_saida:
+        raise ValueError("KM de chegada menor que o de saída")
+
+    destino = _texto(linha.get('destino_finalidade'))
+    observacoes = _texto(linha.get('observacoes')) or None
+    if not destino:
+        raise ValueError("destino obrigatório")
+    if len(destino) > 255 or (observacoes and len(observacoes) > 500):
+        raise ValueError("destino/observações longos demais")
+
+    cpf = ''.join(c for c in _texto(linha.get('cpf_motorista')) if c.isdigit())
+    if cpf:
+        if cpf not in contexto['motoristas']:
+            raise ValueError(f"motorista com CPF {cpf} não cadastrado")
+        usuario_id, nome_usuario, gabinete_usuario = contexto['motoristas'][cpf]
+    else:
+        usuario_id, nome_usuario, gabinete_usuario = contexto['responsavel']
+
+    gabinete = _texto(linha.get('gabinete_vereador')) or gabinete_usuario or GABINETE_PADRAO
+    if gabinete not in GABINETES_VALIDOS:
+        raise ValueError(f"gabinete desconhecido: {gabinete}")
+
+    contexto['veiculos_importados'].add(veiculo_id)
+    return {
+        'usuario_id': usuario_id,
+        'gabinete_vereador': gabinete,
+        'motorista_nome': (_texto(linha.get('motorista_nome')) or nome_usuario)[:100],
+        'veiculo_id': veiculo_id,
+        'data_hora_saida': saida,
+        'km_saida': km_saida,
+        # Registros em papel não têm foto do painel
+        'foto_km_saida': '',
+        'data_hora_chegada': chegada,
+        'km_chegada': km_chegada,
+        'foto_km_chegada': None,
+        'destino_finalidade': destino,
+        'observacoes': observacoes,
+        'foto_ocorrencia': None,
+    }
+
+def importar_planilha(arquivo, nome_arquivo, tipo, responsavel, simular=False, lote=1000, max_erros=500):
+    """
+    Importa veículos ou viagens de um CSV/XLSX. Cada linha é validada; as
+    válidas são gravadas em lotes (um executemany e um commit por lote) e as
+    inválidas entram na lista de erros com o número da linha (até max_erros;
+    o total fica em 'total_erros'). Lote recusado pelo banco é regravado
+    linha a linha. Com simular=True só valida.
+
+    Na importação de viagens, Veiculo.km_atual e o resumo diário são
+    atualizados uma única vez, no fim. responsavel = (id, nome, gabinete) do
+    usuário que recebe as viagens sem cpf_motorista.
+    """
+    linhas = ler_planilha(arquivo, nome_arquivo, tipo)
+    contexto = {'responsavel': responsavel, 'veiculos_importados': set()}
+    if tipo == 'veiculos':
+        tabela, validar = Veiculo.__table__, validar_veiculo_importado
+        contexto['placas'] = {(p or '').upper() for (p,) in db.session.query(Veiculo.placa)}
+    else:
+        tabela, validar = RegistroUso.__table__, validar_viagem_importada
+        contexto['veiculos'] = {}
+        for vid, placa in db.session.query(Veiculo.id, Veiculo.placa):
+            placa = (placa or '').upper()
+            # Placa repetida fica ambígua (None) e a linha que a usar é recusada
+            contexto['veiculos'][placa] = None if placa in contexto['veiculos'] else vid
+        contexto['motoristas'] = {cpf: (uid, nome, gab) for uid, cpf, nome, gab in
+                                  db.session.query(Usuario.id, Usuario.cpf, Usuario.nome, Usuario.gabinete)}
+
+    resultado = {'lidas': 0, 'validas': 0, 'importadas': 0, 'total_erros': 0, 'erros': [], 'simulacao': simular}
+
+    def erro(numero, mensagem):
+        resultado['total_erros'] += 1
+        if len(resultado['erros']) < max_erros:
+            resultado['erros'].append((numero, mensagem))
+
+    pendentes, numeros = [], []
+
+    def gravar():
+        if pendentes and not simular:
+            try:
+                db.session.execute(tabela.insert(), pendentes)
+                db.session.commit()
+                resultado['importadas'] += len(pendentes)
+            except IntegrityError:
+                # Lote recusado: regrava linha a linha para apontar cada linha
+                # ruim e ainda importar as boas
+                db.session.rollback()
+                for numero, valores in zip(numeros, pendentes):
+                    try:
+                        db.session.execute(tabela.insert(), [valores])
+                        db.session.commit()
+                        resultado['importadas'] += 1
+                    except IntegrityError as e:
+                        db.session.rollback()
+                        erro(numero, f"recusada pelo banco: {e.orig}")
+        pendentes.clear()
+        numeros.clear()
+
+    for numero, linha in linhas:
+        resultado['lidas'] += 1
+        try:
+            valores = validar(linha, contexto)
+        except ValueError as e:
+            erro(numero, str(e))
+            continue
+        resultado['validas'] += 1
+        pendentes.append(valores)
+        numeros.append(numero)
+        if len(pendentes) >= lote:
+            gravar()
+    gravar()
+
+    if tipo == 'viagens' and resultado['importadas']:
+        for veiculo_id in contexto['veiculos_importados']:
+            atualizar_km_veiculo(veiculo_id)
+        db.session.commit()
+        reconstruir_resumo()
+    if resultado['importadas']:
+        invalidar_frota()  # os inserts em lote não passam pelo ORM
+    return resultado
+
+@admin.route('/admin/importar', methods=['GET', 'POST'])
+@login_required
+def importar():
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    form = ImportacaoForm()
+    resultado = None
+    if form.validate_on_submit():
+        arquivo = form.arquivo.data
+        try:
+            resultado = importar_planilha(arquivo.stream, arquivo.filename, form.tipo.data,
+                                          (current_user.id, current_user.nome, current_user.gabinete),
+                                          simular=form.simular.data)
+        except ValueError as e:
+            flash(str(e), 'danger')
+    return render_template('importar.html', form=form, resultado=resultado)
+
+@admin.cli.command('importar')
+@click.argument('tipo', type=click.Choice(['viagens', 'veiculos']))
+@click.argument('caminho', type=click.Path(exists=True, dir_okay=False))
+@click.option('--responsavel', 'cpf', help='CPF do usuário que recebe as viagens sem cpf_motorista.')
+@click.option('--simular', is_flag=True, help='Só valida, sem gravar nada.')
+@click.option('--lote', default=1000, show_default=True, help='Linhas por INSERT/commit.')
+def importar_cmd(tipo, caminho, cpf, simular, lote):
+    """
+    Importa veículos ou viagens finalizadas de um CSV/XLSX.
+
+    Veículos: modelo, placa [, km_atual, km_revisao_proxima].
+    Viagens: placa, data_saida, km_saida, destino, data_chegada, km_chegada
+    [, gabinete, motorista, cpf_motorista, observacoes].
+    """
+    responsavel = (None, '', None)
+    if tipo == 'viagens':
+        usuario = Usuario.query.filter_by(cpf=cpf).first() if cpf else None
+        if not usuario:
+            raise click.UsageError('Informe --responsavel com o CPF de um usuário cadastrado.')
+        responsavel = (usuario.id, usuario.nome, usuario.gabinete)
+    with open(caminho, 'rb') as arquivo:
+        try:
+            r = importar_planilha(arquivo, caminho, tipo, responsavel, simular=simular, lote=lote)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    for numero, mensagem in r['erros']:
+        print(f"[ERRO] linha {numero}: {mensagem}")
+    if r['total_erros'] > len(r['erros']):
+        print(f"... e mais {r['total_erros'] - len(r['erros'])} erros")
+    acao = 'válidas (simulação, nada gravado)' if simular else 'importadas'
+    print(f"{r['lidas']} linhas lidas, {r['validas'] if simular else r['importadas']} {acao}, {r['total_erros']} com erro.")
@@ -0,0 +1,526 @@
+"""
+Relatórios: histórico (tabela e gráficos), ocorrências, exportação para
+Excel e a fila que gera as planilhas fora da requisição, com o worker
+`flask processar-relatorios`.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import click
+from flask import (Blueprint, abort, current_app, flash, make_response, redirect, render_template, request, send_file,
+                   url_for)
+from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import (FIM_VIAGEM, LISTA_GABINETES, RegistroUso, TarefaRelatorio, Veiculo, agregados_em_cache, db,
+                 filtros_registros, paginar_keyset)
+
+relatorios = Blueprint('relatorios', __name__, cli_group=None)
+
+# --- HISTÓRICO E RELATÓRIOS ---
+@relatorios.route('/historico')
+@login_required
+def historico():
+    if current_user.cargo != 'Admin': 
+        return redirect(url_for('principal.index'))
+    
+    # 1. Filtros da URL (período, gabinete, veículo)
+    condicoes = filtros_registros(request.args)
+
+    # 2. Página atual via keyset (cursor em data_hora_saida, id)
+    query = RegistroUso.query.options(joinedload(RegistroUso.veiculo)).filter(*condicoes)
+    registros, proximo_cursor, tem_cursor = paginar_keyset(
+        query, RegistroUso.data_hora_saida, request.args.get('apos'), current_app.config['HISTORICO_POR_PAGINA'])
+
+    # 3. Listas auxiliares para os filtros (Selects)
+    gabinetes_list = [g[0] for g in LISTA_GABINETES]
+    veiculos_list = Veiculo.query.all()
+
+    # 4. Renderiza a tabela; os gráficos são carregados à parte (api_agregados_historico)
+    filtros_url = {k: v for k, v in request.args.items() if k != 'apos' and v}
+    return render_template('historico.html', 
+                           registros=registros, 
+                           gabinetes=gabinetes_list, 
+                           veiculos=veiculos_list,
+                           filtros_url=filtros_url,
+                           proximo_cursor=proximo_cursor,
+                           pagina_inicial=not tem_cursor)
+
+@relatorios.route('/api/historico/agregados')
+@login_required
+def api_agregados_historico():
+    if current_user.cargo != 'Admin':
+        abort(403)
+    try:
+        corpo, corpo_gzip, etag = agregados_em_cache(request.args)
+    except ValueError:
+        abort(400)
+
+    resposta = make_response(corpo)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        resposta.set_data(corpo_gzip)
+        resposta.headers['Content-Encoding'] = 'gzip'
+        # ETag forte é por representação: o corpo comprimido tem o seu
+        etag += '-gzip'
+    resposta.headers['Vary'] = 'Accept-Encoding'
+    resposta.mimetype = 'application/json'
+    # O navegador sempre revalida; sem mudança, a resposta é um 304 vazio
+    resposta.set_etag(etag)
+    resposta.cache_control.private = True
+    resposta.cache_control.no_cache = True
+    return resposta.make_conditional(request)
+
+@relatorios.route('/relatorio-ocorrencias')
+@login_required
+def relatorio_ocorrencias():
+    if current_user.cargo != 'Admin': 
+        return redirect(url_for('principal.index'))
+    
+    # Viagens finalizadas do período, uma página por vez (keyset no fim da viagem e id).
+    # Viagem fechada pela edição pode não ter hora de chegada: o fim é a saída.
+    # Veículo e fotos vêm junto (joinedload/selectinload): número fixo de SELECTs por página.
+    query = (
+        RegistroUso.query
+        .options(joinedload(RegistroUso.veiculo), selectinload(RegistroUso.fotos_ocorrencia_multiplas))
+        .filter(RegistroUso.km_chegada != None, *filtros_registros(request.args))
+    )
+    viagens, proximo_cursor, tem_cursor = paginar_keyset(
+        query, FIM_VIAGEM, request.args.get('apos'), current_app.config['OCORRENCIAS_POR_PAGINA'],
+        valor_data=lambda v: v.data_hora_chegada or v.data_hora_saida)
+
+    filtros_url = {k: v for k, v in request.args.items() if k != 'apos' and v}
+    return render_template('relatorio_ocorrencias.html', ocorrencias=viagens,
+                           filtros_url=filtros_url,
+                           proximo_cursor=proximo_cursor,
+                           pagina_inicial=not tem_cursor)
+
+
+COLUNAS_RELATORIO = [
+    "DATA/HORA SAÍDA", "DATA/HORA CHEGADA", "MOTORISTA", "VEÍCULO", "GABINETE",
+    "KM INICIAL", "KM FINAL", "TOTAL KM", "DESTINO/FINALIDADE",
+]
+
+def linhas_relatorio(condicoes, lote=1000):
+    """
+    Lê as viagens filtradas direto do cursor do banco (yield_per), já com o
+    veículo no mesmo SELECT, e devolve uma linha da planilha por vez.
+    """
+    consulta = (
+        db.select(
+            RegistroUso.data_hora_saida, RegistroUso.data_hora_chegada,
+            RegistroUso.motorista_nome, Veiculo.modelo, Veiculo.placa,
+            RegistroUso.gabinete_vereador, RegistroUso.km_saida,
+            RegistroUso.km_chegada, RegistroUso.destino_finalidade,
+        )
+        .join(Veiculo, RegistroUso.veiculo_id == Veiculo.id)
+        .where(*condicoes)
+        .order_by(RegistroUso.data_hora_saida.desc(), RegistroUso.id.desc())
+        .execution_options(yield_per=lote)
+    )
+    for saida, chegada, motorista, modelo, placa, gabinete, km_saida, km_chegada, destino in db.session.execute(consulta):
+        yield (
+            saida.strftime('%d/%m/%Y %H:%M'),
+            chegada.strftime('%d/%m/%Y %H:%M') if chegada else "EM TRÂNSITO",
+            motorista.upper(),
+            f"{modelo} ({placa})",
+            gabinete,
+            km_saida,
+            km_chegada if km_chegada else "---",
+            (km_chegada - km_saida) if km_chegada else 0,
+            destino,
+        )
+
+def gerar_excel_relatorio(condicoes, destino):
+    """
+    Gera a planilha oficial em modo streaming (openpyxl write_only).
+
+    No write_only a largura das colunas precisa ser definida antes da primeira
+    linha, então as linhas passam primeiro por um arquivo temporário enquanto
+    medimos o maior texto de cada coluna. A memória fica constante, seja qual
+    for o período exportado.
+    """
+    # openpyxl (e o numpy que ele puxa) só é carregado por quem exporta
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+    from openpyxl.utils import get_column_letter
+    from openpyxl.worksheet.cell_range import CellRange
+
+    larguras = [len(str(c)) for c in COLUNAS_RELATORIO]
+    total = 0
+    with tempfile.TemporaryFile() as spool:
+        for linha in linhas_relatorio(condicoes):
+            for i, valor in enumerate(linha):
+                larguras[i] = max(larguras[i], len(str(valor)))
+            pickle.dump(linha, spool, pickle.HIGHEST_PROTOCOL)
+            total += 1
+        spool.seek(0)
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Relatório')
+        for i, largura in enumerate(larguras, 1):
+            ws.column_dimensions[get_column_letter(i)].width = largura + 5
+
+        # Estilos Institucionais
+        header_fill = PatternFill(start_color='003366', end_color='003366', fill_type='solid')
+        header_font = Font(color='FFFFFF', bold=True)
+        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), 
+                             top=Side(style='thin'), bottom=Side(style='thin'))
+        signature_line = Border(top=Side(style='medium')) 
+        alinhado_centro = Alignment(horizontal='center', vertical='center')
+        alinhado_esquerda = Alignment(horizontal='left', vertical='center')
+
+        def celula(valor, **estilo):
+            c = WriteOnlyCell(ws, value=valor)
+            for nome, v in estilo.items():
+                setattr(c, nome, v)
+            return c
+
+        # Cabeçalho
+        ws.append([celula(nome, border=thin_border, fill=header_fill, font=header_font, alignment=alinhado_centro)
+                   for nome in COLUNAS_RELATORIO])
+
+        # Dados (um registro por vez, lido do arquivo temporário)
+        for _ in range(total):
+            linha = pickle.load(spool)
+            ws.append([celula(valor, border=thin_border, alignment=alinhado_esquerda) for valor in linha])
+
+        # --- LINHAS DE ASSINATURA (duas linhas em branco após os dados) ---
+        last_row = total + 4
+        ws.append([])
+        ws.append([])
+
+        def bloco_assinatura(texto):
+            return [celula(texto, border=signature_line, alignment=Alignment(horizontal='center')),
+                    celula(None, border=signature_line),
+                    celula(None, border=signature_line)]
+
+        # 1. Responsável (Lado Esquerdo) / 2. Administração (Lado Direito)
+        ws.append(bloco_assinatura("Assinatura do Responsável (Transportes)")
+                  + [None, None, None]
+                  + bloco_assinatura("Visto da Administração"))
+        ws.merged_cells.add(CellRange(min_row=last_row, min_col=1, max_row=last_row, max_col=3))
+        ws.merged_cells.add(CellRange(min_row=last_row, min_col=7, max_row=last_row, max_col=9))
+
+        # Rodapé de Emissão
+        ws.append([])
+        ws.append([celula(f"Relatório extraído em: {datetime.now().strftime('%d/%m/%Y %H:%M')}",
+                          font=Font(italic=True, size=9, color='777777'))])
+
+        wb.save(destino)
+    return total
+
+@relatorios.route('/exportar-excel')
+@login_required
+def exportar_excel():
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    
+    # Períodos longos passam do tempo limite do proxy: a planilha é gerada pelo
+    # worker da fila e o admin acompanha (e baixa) na página da tarefa
+    filtros = {campo: request.args[campo] for campo in CAMPOS_FILTRO if request.args.get(campo)}
+    try:
+        filtros_registros(filtros)
+    except ValueError:
+        flash('Filtros inválidos.', 'danger')
+        return redirect(url_for('relatorios.historico'))
+    tarefa, nova = enfileirar_relatorio('excel', filtros, current_user.id)
+    if not nova:
+        flash('Este relatório já está sendo gerado; o arquivo será o mesmo para todos que pediram.', 'info')
+    return redirect(url_for('relatorios.relatorio_tarefa', id=tarefa.id))
+
+# --- FILA DE RELATÓRIOS ---
+# Relatórios pesados não são gerados dentro da requisição: o pedido vira uma
+# TarefaRelatorio e um worker (`flask processar-relatorios`, ao lado do
+# gunicorn) pega as pendentes por ordem de chegada. Pedidos iguais (mesmo
+# tipo e filtros) enquanto um deles ainda está na fila ou rodando
+# compartilham a mesma tarefa e o mesmo arquivo.
+CAMPOS_FILTRO = ('data_inicio', 'data_fim', 'gabinete', 'veiculo')
+STATUS_ATIVOS = ('pendente', 'executando')
+
+# tipo -> como gerar. Um novo formato (ex.: PDF) é uma entrada nova aqui.
+TIPOS_RELATORIO = {
+    'excel': {
+        'gerar': gerar_excel_relatorio,
+        'extensao': '.xlsx',
+        'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'nome': 'Relatorio_Frota',
+    },
+}
+
+_fila_relatorios = {'thread': None, 'pendente': False, 'lock': threading.Lock()}
+
+def enfileirar_relatorio(tipo, filtros, solicitante_id):
+    """
+    Coloca o pedido na fila. Devolve (tarefa, nova): se já houver tarefa
+    igual pendente ou executando, devolve essa, com nova=False.
+    """
+    filtros_json = json.dumps(filtros, sort_keys=True, ensure_ascii=False)
+    chave = hashlib.sha256(f"{tipo}:{filtros_json}".encode()).hexdigest()
+    ativa = lambda: TarefaRelatorio.query.filter(TarefaRelatorio.chave == chave,
+                                                 TarefaRelatorio.status.in_(STATUS_ATIVOS)).first()
+    existente = ativa()
+    if existente:
+        return existente, False
+
+    tarefa = TarefaRelatorio(tipo=tipo, filtros=filtros_json, chave=chave, solicitante_id=solicitante_id)
+    db.session.add(tarefa)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Outro admin pediu o mesmo relatório ao mesmo tempo: o índice único
+        # ux_tarefa_relatorio_ativa deixa só uma tarefa ativa
+        db.session.rollback()
+        existente = ativa()
+        if existente:
+            return existente, False
+        raise
+    if current_app.config['RELATORIOS_NO_PROCESSO']:
+        _acordar_thread_relatorios()
+    return tarefa, True
+
+def proxima_tarefa_relatorio():
+    """Reserva para este processo a tarefa pendente mais antiga. None se a fila estiver vazia."""
+    agora = datetime.now()
+    # Executando sem batimento: o worker morreu no meio; volta para a fila ou,
+    # esgotadas as tentativas, fica com erro. Geração demorada, mas viva, continua batendo.
+    presas = TarefaRelatorio.query.filter(TarefaRelatorio.status == 'executando',
+                                          TarefaRelatorio.atualizado_em < agora - timedelta(seconds=current_app.config['RELATORIOS_SEM_BATIMENTO']))
+    for tarefa in presas:
+        if tarefa.tentativas >= current_app.config['RELATORIOS_TENTATIVAS']:
+            tarefa.status, tarefa.erro, tarefa.concluido_em = 'erro', 'Tempo esgotado.', agora
+        else:
+            tarefa.status = 'pendente'
+    db.session.commit()
+
+    while True:
+        tarefa_id = (db.session.query(TarefaRelatorio.id).filter_by(status='pendente')
+                     .order_by(TarefaRelatorio.id).limit(1).scalar())
+        if tarefa_id is None:
+            return None
+        # UPDATE condicional: se outro worker reservou antes, nada muda e tenta a próxima
+        reservou = (TarefaRelatorio.query.filter_by(id=tarefa_id, status='pendente')
+                    .update({'status': 'executando', 'iniciado_em': datetime.now(), 'atualizado_em': datetime.now(),
+                             'tentativas': TarefaRelatorio.tentativas + 1}, synchronize_session=False))
+        db.session.commit()
+        if reservou:
+            return db.session.get(TarefaRelatorio, tarefa_id)
+
+@contextmanager
+def batimento_relatorio(tarefa_id, tentativa):
+    """
+    Enquanto o bloco roda, uma thread renova atualizado_em da tarefa a cada
+    RELATORIOS_BATIMENTO segundos, numa conexão própria (a da sessão está
+    ocupada lendo as viagens).
+    """
+    engine, parar = db.engine, threading.Event()
+    intervalo = current_app.config['RELATORIOS_BATIMENTO']
+
+    def bater():
+        while not parar.wait(intervalo):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(TarefaRelatorio.__table__.update()
+                                 .where(TarefaRelatorio.id == tarefa_id, TarefaRelatorio.tentativas == tentativa)
+                                 .values(atualizado_em=datetime.now()))
+            except Exception as e:
+                print(f"[AVISO] Batimento do relatório #{tarefa_id}: {e}")
+
+    thread = threading.Thread(target=bater, daemon=True, name=f'relatorio-{tarefa_id}')
+    thread.start()
+    try:
+        yield
+    finally:
+        parar.set()
+        thread.join()
+
+def _finalizar_tarefa_relatorio(tarefa_id, tentativa, **valores):
+    """Grava o resultado só se a tarefa ainda é desta execução. Devolve True se gravou."""
+    gravou = (TarefaRelatorio.query.filter_by(id=tarefa_id, status='executando', tentativas=tentativa)
+              .update(valores, synchronize_session=False))
+    db.session.commit()
+    if not gravou:
+        print(f"[AVISO] Relatório #{tarefa_id}: a tarefa foi reservada por outra execução; resultado descartado.")
+    return bool(gravou)
+
+def executar_tarefa_relatorio(tarefa):
+    """Gera o arquivo de uma tarefa reservada e grava o resultado (concluido ou erro)."""
+    tarefa_id, tentativa = tarefa.id, tarefa.tentativas
+    tipo = TIPOS_RELATORIO[tarefa.tipo]
+    pasta = current_app.config['RELATORIOS_PASTA']
+    os.makedirs(pasta, exist_ok=True)
+    nome = f"relatorio_{tarefa_id}{tipo['extensao']}"
+    destino = os.path.join(pasta, nome)
+    # Gera num arquivo ao lado (um por tentativa) e só troca pelo definitivo no fim
+    parcial = f"{destino}.{tentativa}.parcial"
+    inicio = time.perf_counter()
+    try:
+        with batimento_relatorio(tarefa_id, tentativa), open(parcial, 'wb') as arquivo:
+            tipo['gerar'](filtros_registros(json.loads(tarefa.filtros)), arquivo)
+    except BaseException as e:
+        if os.path.exists(parcial):
+            os.remove(parcial)
+        db.session.rollback()
+        if not isinstance(e, Exception):
+            # Worker sendo encerrado (SIGTERM/Ctrl+C): a tarefa volta para a fila
+            _finalizar_tarefa_relatorio(tarefa_id, tentativa, status='pendente', iniciado_em=None)
+            raise
+        if _finalizar_tarefa_relatorio(tarefa_id, tentativa, status='erro', erro=str(e)[:255],
+                                       concluido_em=datetime.now()):
+            print(f"[ERRO] Relatório #{tarefa_id}: {e}")
+        return
+
+    # Se outra execução assumiu a tarefa, o arquivo desta não substitui o dela
+    tamanho = os.path.getsize(parcial)
+    if TarefaRelatorio.query.filter_by(id=tarefa_id, tentativas=tentativa).count() == 0:
+        os.remove(parcial)
+        db.session.rollback()
+        print(f"[AVISO] Relatório #{tarefa_id}: a tarefa foi reservada por outra execução; resultado descartado.")
+        return
+    os.replace(parcial, destino)
+    agora = datetime.now()
+    if _finalizar_tarefa_relatorio(tarefa_id, tentativa, status='concluido', arquivo=nome, tamanho=tamanho,
+                                   concluido_em=agora, atualizado_em=agora,
+                                   expira_em=agora + timedelta(hours=current_app.config['RELATORIOS_VALIDADE_HORAS'])):
+        print(f"Relatório #{tarefa_id} gerado em {time.perf_counter() - inicio:.1f} s ({tamanho / 1024:.0f} KB).")
+
+def limpar_relatorios_expirados():
+    """Apaga os arquivos dos relatórios vencidos; as tarefas ficam como 'expirado'. Devolve quantos."""
+    vencidas = TarefaRelatorio.query.filter(TarefaRelatorio.status == 'concluido',
+                                            TarefaRelatorio.expira_em < datetime.now()).all()
+    for tarefa in vencidas:
+        try:
+            os.remove(os.path.join(current_app.config['RELATORIOS_PASTA'], tarefa.arquivo))
+        except FileNotFoundError:
+            pass
+        tarefa.status, tarefa.arquivo = 'expirado', None
+    db.session.commit()
+    return len(vencidas)
+
+def processar_fila_relatorios():
+    """Gera tudo o que estiver pendente. Devolve quantas tarefas foram executadas."""
+    limpar_relatorios_expirados()
+    executadas = 0
+    while (tarefa := proxima_tarefa_relatorio()) is not None:
+        executar_tarefa_relatorio(tarefa)
+        executadas += 1
+    return executadas
+
+def _thread_relatorios(app):
+    with app.app_context():
+        while True:
+            try:
+                processar_fila_relatorios()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[ERRO] Fila de relatórios: {e}")
+            # Só encerra se nenhum pedido chegou enquanto processava
+            with _fila_relatorios['lock']:
+                if not _fila_relatorios['pendente']:
+                    _fila_relatorios['thread'] = None
+                    db.session.remove()
+                    return
+                _fila_relatorios['pendente'] = False
+
+def _acordar_thread_relatorios():
+    """RELATORIOS_NO_PROCESSO=1: uma thread por processo esvazia a fila e termina."""
+    with _fila_relatorios['lock']:
+        _fila_relatorios['pendente'] = True
+        if _fila_relatorios['thread'] is None:
+            _fila_relatorios['pendente'] = False
+            _fila_relatorios['thread'] = threading.Thread(target=_thread_relatorios, daemon=True, name='relatorios',
+                                                          args=(current_app._get_current_object(),))
+            _fila_relatorios['thread'].start()
+
+def tarefa_relatorio_json(tarefa):
+    dados = {
+        'id': tarefa.id,
+        'tipo': tarefa.tipo,
+        'status': tarefa.status,
+        'criado_em': tarefa.criado_em.isoformat(),
+        'concluido_em': tarefa.concluido_em.isoformat() if tarefa.concluido_em else None,
+        'expira_em': tarefa.expira_em.isoformat() if tarefa.expira_em else None,
+        'tamanho': tarefa.tamanho,
+        'erro': tarefa.erro,
+    }
+    if tarefa.status == 'pendente':
+        dados['posicao'] = (TarefaRelatorio.query.filter(TarefaRelatorio.status == 'pendente',
+                                                         TarefaRelatorio.id <= tarefa.id).count())
+        limite = datetime.now() - timedelta(seconds=current_app.config['RELATORIOS_AVISO_FILA'])
+        dados['sem_worker'] = tarefa.criado_em < limite
+    if tarefa.status == 'concluido':
+        dados['download'] = url_for('relatorios.baixar_relatorio', id=tarefa.id)
+    return dados
+
+@relatorios.route('/relatorios/<int:id>')
+@login_required
+def relatorio_tarefa(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    tarefa = db.session.get(TarefaRelatorio, id)
+    if not tarefa:
+        abort(404)
+    recentes = (TarefaRelatorio.query.options(joinedload(TarefaRelatorio.solicitante))
+                .order_by(TarefaRelatorio.id.desc()).limit(10).all())
+    return render_template('relatorio_tarefa.html', tarefa=tarefa, filtros=json.loads(tarefa.filtros),
+                           dados=tarefa_relatorio_json(tarefa), recentes=recentes)
+
+@relatorios.route('/api/relatorios/<int:id>')
+@login_required
+def api_relatorio_tarefa(id):
+    """Status da tarefa para a página acompanhar (polling)."""
+    if current_user.cargo != 'Admin':
+        abort(403)
+    tarefa = db.session.get(TarefaRelatorio, id)
+    if not tarefa:
+        abort(404)
+    if tarefa.status == 'pendente' and current_app.config['RELATORIOS_NO_PROCESSO']:
+        # Pendentes de antes de um reinício do servidor: quem acompanha a tarefa reacende a thread
+        _acordar_thread_relatorios()
+    resposta = make_response(json.dumps(tarefa_relatorio_json(tarefa)))
+    resposta.mimetype = 'application/json'
+    resposta.cache_control.no_store = True
+    return resposta
+
+@relatorios.route('/relatorios/<int:id>/download')
+@login_required
+def baixar_relatorio(id):
+    if current_user.cargo != 'Admin': return redirect(url_for('principal.index'))
+    tarefa = db.session.get(TarefaRelatorio, id)
+    if not tarefa:
+        abort(404)
+    if tarefa.status != 'concluido' or tarefa.expira_em < datetime.now():
+        flash('Este relatório não está disponível para download. Peça de novo pelo histórico.', 'warning')
+        return redirect(url_for('relatorios.relatorio_tarefa', id=id))
+    caminho = os.path.join(current_app.config['RELATORIOS_PASTA'], tarefa.arquivo)
+    if not os.path.exists(caminho):
+        flash('O arquivo deste relatório não foi encontrado. Peça de novo pelo histórico.', 'warning')
+        return redirect(url_for('relatorios.relatorio_tarefa', id=id))
+    tipo = TIPOS_RELATORIO[tarefa.tipo]
+    return send_file(caminho, as_attachment=True,
+                     download_name=f"{tipo['nome']}_{tarefa.concluido_em.strftime('%d_%m_%Y')}{tipo['extensao']}",
+                     mimetype=tipo['mimetype'])
+
+@relatorios.cli.command('processar-relatorios')
+@click.option('--uma-vez', is_flag=True, help='Processa a fila atual e sai (ex.: cron).')
+def processar_relatorios_cmd(uma_vez):
+    """
+    Worker da fila de relatórios. Rode ao lado do gunicorn (ex.: serviço do
+    systemd); várias instâncias podem rodar juntas, cada tarefa é reservada
+    por uma só. SIGTERM devolve a tarefa em andamento para a fila.
+    """
+    import signal
+    import sys
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if uma_vez:
+        print(f"{processar_fila_relatorios()} relatório(s) gerado(s).")
+        return
+    print(f"Worker de relatórios aguardando pedidos (a cada {current_app.config['RELATORIOS_INTERVALO']:g} s).")
+    while True:
+        if not processar_fila_relatorios():
+            time.sleep(current_app.config['RELATORIOS_INTERVALO'])
@@ -0,0 +1,269 @@
+"""
+Arquivos enviados: fotos (/uploads), downloads, miniaturas com cache em
+disco e o comando `flask migrar-uploads` para o armazenamento por conteúdo.
+"""
+import os
+import threading
+import time
+from functools import lru_cache
+import click
+from flask import Blueprint, abort, current_app
+from flask_login import login_required
+from sqlalchemy import func
+from werkzeug.utils import secure_filename
+
+from app import (CHAVE_OBJETO_RE, ArmazenamentoS3, ArquivoFoto, ConteudoFoto, _conteudo_da_foto, armazenamento,
+                 caminho_da_foto, chave_da_foto, chave_objeto, db, enviar_arquivo, guardar_conteudo, medir_pillow,
+                 pasta_brutos, registrar_foto, sha256_arquivo)
+
+uploads = Blueprint('uploads', __name__, cli_group=None)
+
+@uploads.route('/download/<path:filename>')
+@login_required
+def download_file(filename):
+    """
+    Força o download de um arquivo armazenado no diretório de uploads,
+    protegendo contra path traversal.
+    """
+    # Fotos guardadas pelo conteúdo baixam com o nome original
+    chave = chave_da_foto(filename)
+    if chave:
+        return armazenamento().resposta(chave, as_attachment=True, download_name=secure_filename(filename) or filename)
+
+    upload_folder = current_app.config.get('UPLOAD_FOLDER')
+    if not upload_folder:
+        abort(404)
+
+    # Caminho absoluto do upload folder e do arquivo solicitado
+    upload_folder_abs = os.path.abspath(upload_folder)
+    requested_path = os.path.abspath(os.path.join(upload_folder_abs, filename))
+
+    # Protege contra path traversal: requested_path deve ficar dentro de upload_folder_abs
+    try:
+        common = os.path.commonpath([upload_folder_abs, requested_path])
+    except ValueError:
+        # caminhos em drives diferentes (Windows) -> bloqueia
+        abort(404)
+
+    if common != upload_folder_abs or not os.path.exists(requested_path):
+        abort(404)
+
+    # Relatórios só saem por baixar_relatorio (restrito a Admin), mesmo se
+    # RELATORIOS_PASTA tiver sido configurada dentro de UPLOAD_FOLDER
+    pasta_relatorios = os.path.abspath(current_app.config['RELATORIOS_PASTA'])
+    if requested_path == pasta_relatorios or requested_path.startswith(pasta_relatorios + os.sep):
+        abort(404)
+
+    # Nome seguro para o cabeçalho de download (mantém o nome original, sanitizado)
+    download_name = secure_filename(os.path.basename(requested_path)) or os.path.basename(requested_path)
+
+    # Envia o arquivo forçando download
+    return enviar_arquivo(requested_path, as_attachment=True, download_name=download_name)
+
+@uploads.route('/uploads/<filename>')
+@login_required
+def uploaded_file(filename):
+    chave = chave_da_foto(filename)
+    if chave:
+        # Local: o próprio arquivo; S3: redireciona para uma URL pré-assinada
+        return armazenamento().resposta(chave)
+    caminho = caminho_da_foto(filename)
+    if not caminho:
+        abort(404)
+    # Enquanto o JPEG reduzido não fica pronto, serve o original sem cache longo
+    pendente = os.path.dirname(caminho) == pasta_brutos()
+    return enviar_arquivo(caminho, imutavel=not pendente)
+
+@uploads.route('/miniaturas/<filename>')
+@login_required
+def miniatura(filename):
+    """Miniatura (~160px) de uma foto enviada, gerada na primeira vez e guardada em cache."""
+    try:
+        digest, extensao = _conteudo_da_foto(filename)
+    except KeyError:
+        digest = extensao = None
+    origem = None if digest else caminho_da_foto(filename)
+    if not digest and not origem:
+        abort(404)
+    try:
+        if digest:
+            # O cache é pelo hash: só busca o objeto no armazenamento se a miniatura ainda não existe
+            caminho = miniatura_em_cache(digest)
+            if not caminho:
+                with armazenamento().arquivo_local(chave_objeto(digest, extensao)) as local:
+                    caminho = gerar_miniatura(local, digest)
+        else:
+            caminho = obter_miniatura(origem)
+    except Exception as e:
+        print(f"[ERRO] miniatura de {filename}: {e}")
+        return uploaded_file(filename)
+    pendente = bool(origem) and os.path.dirname(origem) == pasta_brutos()
+    return enviar_arquivo(caminho, imutavel=not pendente, mimetype='image/jpeg')
+
+_cache_miniaturas = {'bytes': None, 'lock': threading.Lock()}
+
+def hash_conteudo(caminho):
+    """SHA-256 do arquivo, memorizado enquanto mtime e tamanho não mudarem."""
+    info = os.stat(caminho)
+    return _hash_arquivo(caminho, info.st_mtime_ns, info.st_size)
+
+@lru_cache(maxsize=4096)
+def _hash_arquivo(caminho, mtime_ns, tamanho):
+    return sha256_arquivo(caminho)
+
+def obter_miniatura(origem):
+    """
+    Devolve o caminho da miniatura de 'origem' no cache, gerando se preciso.
+
+    O cache fica em MINIATURAS_PASTA/<aa>/<sha256>_<lado>.jpg (caminho pelo
+    conteúdo, então fotos iguais compartilham a miniatura). Cada acesso
+    atualiza o mtime do arquivo; quando o cache passa de MINIATURAS_CACHE_MB,
+    os arquivos usados há mais tempo são apagados (LRU).
+    """
+    digest = hash_conteudo(origem)
+    return miniatura_em_cache(digest) or gerar_miniatura(origem, digest)
+
+def _caminho_miniatura(digest):
+    return os.path.join(current_app.config['MINIATURAS_PASTA'], digest[:2], f"{digest}_{current_app.config['MINIATURAS_LADO']}.jpg")
+
+def miniatura_em_cache(digest):
+    """Caminho da miniatura já gerada (e marca o uso para o LRU), ou None."""
+    caminho = _caminho_miniatura(digest)
+    if os.path.exists(caminho):
+        os.utime(caminho)
+        return caminho
+    return None
+
+def gerar_miniatura(origem, digest):
+    lado = current_app.config['MINIATURAS_LADO']
+    caminho = _caminho_miniatura(digest)
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    with medir_pillow():
+        from PIL import Image
+        img = Image.open(origem)
+        if img.format == 'JPEG':
+            img.draft('RGB', (lado, lado))
+        img.thumbnail((lado, lado))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(temporario, 'JPEG', quality=70)
+    os.replace(temporario, caminho)
+    _registrar_no_cache(caminho)
+    return caminho
+
+def _registrar_no_cache(novo):
+    """Soma o arquivo novo ao tamanho do cache e, se passou do limite, remove os menos usados."""
+    limite = current_app.config['MINIATURAS_CACHE_MB'] * 1024 * 1024
+    cache = _cache_miniaturas
+    with cache['lock']:
+        if cache['bytes'] is None:
+            cache['bytes'] = sum(a.stat().st_size for a in _arquivos_do_cache())
+        else:
+            cache['bytes'] += os.path.getsize(novo)
+        if cache['bytes'] <= limite:
+            return
+        arquivos = sorted((a for a in _arquivos_do_cache() if a.path != novo), key=lambda a: a.stat().st_mtime)
+        # Libera até 90% do limite, para não varrer a pasta a cada miniatura nova
+        while arquivos and cache['bytes'] > limite * 0.9:
+            arquivo = arquivos.pop(0)
+            try:
+                tamanho_arquivo = arquivo.stat().st_size
+                os.remove(arquivo.path)
+                cache['bytes'] -= tamanho_arquivo
+            except FileNotFoundError:
+                pass
+
+def _arquivos_do_cache():
+    raiz = current_app.config['MINIATURAS_PASTA']
+    if not os.path.isdir(raiz):
+        return
+    for sub in os.scandir(raiz):
+        if sub.is_dir():
+            yield from (a for a in os.scandir(sub.path) if a.is_file() and a.name.endswith('.jpg'))
+
+@uploads.cli.command('migrar-uploads')
+@click.option('--simular', is_flag=True, help='Só calcula quanto espaço seria liberado.')
+@click.option('--lote', default=200, show_default=True, help='Arquivos por commit.')
+@click.option('--carencia', default=60, show_default=True,
+              help='Minutos: objetos mais novos que isso nunca são apagados na limpeza final.')
+def migrar_uploads_cmd(simular, lote, carencia):
+    """
+    Move as fotos soltas de uploads/ para o armazenamento por conteúdo
+    (uploads/objetos/ ou o bucket S3), ligando cada nome antigo ao seu conteúdo. Arquivos iguais
+    passam a ocupar um único arquivo. Também recalcula as referências e
+    apaga conteúdos que nenhum nome usa. Pode ser interrompido e rodado de novo.
+
+    Cada lote é ligado no banco antes de os arquivos soltos serem apagados,
+    então uma interrupção nunca deixa nome sem arquivo.
+
+    Pare os workers web (e o de relatórios) antes de rodar: o recálculo das
+    referências e a limpeza final não enxergam uploads em andamento. Por
+    segurança a limpeza ainda pula objetos mais novos que --carencia, só
+    apaga chaves no formato do armazenamento (aa/bb/<sha256>.ext) e se
+    recusa a rodar no S3 com S3_PREFIXO vazio (seria o bucket inteiro).
+    """
+    pasta = current_app.config['UPLOAD_FOLDER']
+    ligados = {nome: digest for nome, digest in db.session.query(ArquivoFoto.nome, ArquivoFoto.sha256)}
+    conhecidos = {digest for (digest,) in db.session.query(ConteudoFoto.sha256)}
+    total = {'arquivos': 0, 'bytes_antes': 0, 'bytes_novos': 0}
+    vistos = set()
+
+    def concluir(soltos):
+        if not simular:
+            db.session.commit()
+            for caminho in soltos:
+                os.remove(caminho)
+        soltos.clear()
+
+    soltos = []
+    for entrada in sorted(os.scandir(pasta), key=lambda e: e.name):
+        if not entrada.is_file() or entrada.name.endswith('.tmp'):
+            continue
+        total['arquivos'] += 1
+        total['bytes_antes'] += entrada.stat().st_size
+        extensao = os.path.splitext(entrada.name)[1].lower() or '.jpg'
+        if entrada.name in ligados:
+            # Já migrado numa execução interrompida antes de apagar o solto
+            soltos.append(entrada.path)
+            continue
+        if simular:
+            digest, tamanho = sha256_arquivo(entrada.path), entrada.stat().st_size
+        else:
+            digest, tamanho = guardar_conteudo(entrada.path, extensao, mover=False)
+            registrar_foto(entrada.name, digest, tamanho, extensao)
+        if digest not in conhecidos and digest not in vistos:
+            total['bytes_novos'] += tamanho
+        vistos.add(digest)
+        soltos.append(entrada.path)
+        if len(soltos) >= lote:
+            concluir(soltos)
+    concluir(soltos)
+
+    # Referências = quantos nomes apontam para o conteúdo; conteúdo sem nome é apagado
+    removidos = 0
+    if not simular:
+        contagem = dict(db.session.query(ArquivoFoto.sha256, func.count()).group_by(ArquivoFoto.sha256))
+        for conteudo in ConteudoFoto.query.all():
+            conteudo.referencias = contagem.get(conteudo.sha256, 0)
+            if not conteudo.referencias:
+                db.session.delete(conteudo)
+        db.session.commit()
+        _conteudo_da_foto.cache_clear()
+        if isinstance(armazenamento(), ArmazenamentoS3) and not current_app.config['S3_PREFIXO'].strip('/'):
+            print("[AVISO] S3_PREFIXO vazio: limpeza de objetos sem uso recusada (varreria o bucket inteiro).")
+        else:
+            validos = {chave_objeto(d, e) for d, e in db.session.query(ConteudoFoto.sha256, ConteudoFoto.extensao)}
+            limite = time.time() - carencia * 60
+            for chave, tamanho, modificado in list(armazenamento().listar()):
+                # Objeto recente pode ser de um upload ainda não confirmado no banco
+                if chave in validos or modificado > limite or not CHAVE_OBJETO_RE.match(chave):
+                    continue
+                removidos += tamanho
+                armazenamento().remover(chave)
+
+    liberado = total['bytes_antes'] - total['bytes_novos'] + removidos
+    print(f"{total['arquivos']} arquivos soltos, {len(vistos)} conteúdos distintos.")
+    print(f"{'Seriam liberados' if simular else 'Liberados'}: {liberado / 1024 / 1024:.1f} MB "
+          f"({total['bytes_antes'] / 1024 / 1024:.1f} MB soltos -> {total['bytes_novos'] / 1024 / 1024:.1f} MB novos no armazenamento"
+          + (f", {removidos / 1024 / 1024:.1f} MB de conteúdos sem uso" if removidos else "") + ").")
@@ -0,0 +1,106 @@
+"""
+Teste do painel admin com o banco travado para escrita.
+
+Cria num diretório temporário um banco SQLite com algumas viagens, abre
+uma conexão sqlite3 à parte e segura o lock de escrita com BEGIN IMMEDIATE
+(como um import ou relatório longo). Com o lock preso, GET /admin/dashboard
+tem de responder 200 sem esperar o busy_timeout: a página só lê. Sai com
+código 1 se não for assim.
+
+Uso:
+    python testar_bloqueio_dashboard.py [--limite-s 2]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+SENHA = 'teste123'
+
+
+def executar(args, caminho_banco):
+    """Roda dentro do subprocesso e imprime o resultado em JSON."""
+    import app as app_mod
+    from sqlalchemy import event
+    app, db = app_mod.app, app_mod.db
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        app_mod.migrar_banco()
+        admin = app_mod.Usuario(nome='Admin Teste', cpf='11111111111', cargo='Admin',
+                                senha=app_mod.gerar_hash_senha(SENHA), ativo=True)
+        db.session.add(admin)
+        carro = app_mod.Veiculo(modelo='Carro Teste', placa='TST0001', km_atual=0, km_revisao_proxima=10000)
+        db.session.add(carro)
+        db.session.flush()
+        inicio = datetime.now() - timedelta(days=10)
+        for i in range(20):
+            saida = inicio + timedelta(hours=i)
+            db.session.add(app_mod.RegistroUso(
+                usuario_id=admin.id, gabinete_vereador='Administrativo/Geral', motorista_nome=admin.nome,
+                veiculo_id=carro.id, km_saida=1000 + i * 10, km_chegada=1000 + i * 10 + 8,
+                data_hora_saida=saida, data_hora_chegada=saida + timedelta(minutes=40),
+                foto_km_saida='teste.jpg', foto_km_chegada='teste.jpg', destino_finalidade=f'Destino {i}'))
+        db.session.commit()
+        app_mod.reconstruir_resumo()
+
+    contador = {'sql': 0}
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: contador.__setitem__('sql', contador['sql'] + 1))
+
+    admin = app.test_client()
+    admin.post('/login', data={'cpf': '11111111111', 'senha': SENHA})
+    # Sem o lock, para os caches de usuário e agregados não entrarem na medida
+    admin.get('/admin/dashboard')
+
+    # Conexão própria, fora do pool do app, segurando o lock de escrita
+    trava = sqlite3.connect(caminho_banco, isolation_level=None)
+    trava.execute('BEGIN IMMEDIATE')
+    try:
+        contador['sql'] = 0
+        inicio = time.perf_counter()
+        resposta = admin.get('/admin/dashboard')
+        tempo = time.perf_counter() - inicio
+    finally:
+        trava.execute('ROLLBACK')
+        trava.close()
+
+    print(json.dumps({'status': resposta.status_code, 'tempo_s': round(tempo, 3), 'comandos_sql': contador['sql']}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--limite-s', type=float, default=2, help='tempo máximo da resposta com o lock preso')
+    parser.add_argument('--executar', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar:
+        executar(args, args.executar)
+        return
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho_banco = os.path.join(pasta, 'teste.db')
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{caminho_banco}", METRICAS_ATIVAS='0',
+                   RELATORIOS_NO_PROCESSO='0')
+        comando = [sys.executable, os.path.abspath(__file__), '--executar', caminho_banco]
+        saida = subprocess.run(comando, capture_output=True, text=True, env=env, cwd=pasta)
+        if saida.returncode != 0:
+            sys.stderr.write(saida.stderr)
+            raise SystemExit(saida.returncode)
+
+    r = json.loads(saida.stdout.strip().splitlines()[-1])
+    print(f"/admin/dashboard com BEGIN IMMEDIATE em outra conexão: {r['status']} em {r['tempo_s']} s "
+          f"({r['comandos_sql']} comandos SQL)")
+    if r['status'] != 200 or r['tempo_s'] > args.limite_s:
+        print("FALHOU: o painel esperou pelo lock de escrita ou não respondeu 200")
+        raise SystemExit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
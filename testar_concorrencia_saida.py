@@ -0,0 +1,143 @@
+"""
+Teste de concorrência de registrar_saida: vários motoristas, mesmo carro.
+
+Cria num diretório temporário um banco com um veículo e um motorista e
+dispara N threads (cada uma com seu test client) que esperam numa
+threading.Barrier e postam /registrar-saida para o mesmo carro ao mesmo
+tempo. Exatamente uma saída deve ser aceita e o banco deve terminar com
+uma única viagem aberta para o carro (índice ux_registro_uso_aberto_veiculo).
+Todas as outras têm de ser recusadas do jeito normal: redirect para o
+formulário com o aviso de veículo em uso (um 500 ou outro status conta como
+falha). Sai com código 1 se não for assim.
+
+Uso:
+    python testar_concorrencia_saida.py [--threads 200] [--rodadas 3]
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+SENHA = 'teste123'
+AVISO_EM_USO = 'Veículo selecionado já está em uso.'
+
+
+def jpeg():
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.effect_noise((320, 240), 40).convert('RGB').save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def executar(args):
+    """Roda dentro do subprocesso e imprime o resultado de cada rodada em JSON."""
+    import app as app_mod
+    app, db = app_mod.app, app_mod.db
+    app.config['WTF_CSRF_ENABLED'] = False
+    RegistroUso = app_mod.RegistroUso
+
+    with app.app_context():
+        app_mod.migrar_banco()
+        db.session.add(app_mod.Usuario(nome='Motorista Teste', cpf='22222222222', cargo='Motorista',
+                                       senha=app_mod.gerar_hash_senha(SENHA), ativo=True))
+        carro = app_mod.Veiculo(modelo='Carro Teste', placa='TST0001', km_atual=0, km_revisao_proxima=10000)
+        db.session.add(carro)
+        db.session.commit()
+        carro_id = carro.id
+
+    # Um login só; as outras threads reaproveitam o cookie de sessão
+    primeiro = app.test_client()
+    primeiro.post('/login', data={'cpf': '22222222222', 'senha': SENHA})
+    sessao = primeiro.get_cookie('session').value
+
+    foto = jpeg()
+    resultados = []
+    for rodada in range(args.rodadas):
+        clientes = []
+        for _ in range(args.threads):
+            cliente = app.test_client()
+            cliente.set_cookie('session', sessao)
+            clientes.append(cliente)
+
+        barreira = threading.Barrier(args.threads)
+        respostas = [None] * args.threads
+
+        def disparar(i):
+            barreira.wait()
+            try:
+                r = clientes[i].post('/registrar-saida', content_type='multipart/form-data', data={
+                    'veiculo_modelo': str(carro_id), 'km_saida': str(1000 * (rodada + 1)),
+                    'destino_finalidade': 'Concorrência',
+                    'foto_km_saida': (io.BytesIO(foto), 'painel.jpg')})
+                with clientes[i].session_transaction() as sessao_cliente:
+                    avisos = [texto for _, texto in sessao_cliente.get('_flashes', [])]
+                # Saída aceita volta para o index; recusada, para o próprio formulário com o aviso
+                if r.status_code == 302 and '/registrar-saida' not in r.location:
+                    respostas[i] = 'aceita'
+                elif r.status_code == 302 and r.location.endswith('/registrar-saida') and AVISO_EM_USO in avisos:
+                    respostas[i] = 'recusada'
+                else:
+                    respostas[i] = f"inesperada: {r.status_code} {r.location or ''} {avisos}".strip()
+            except Exception as e:
+                respostas[i] = f'erro: {type(e).__name__}'
+
+        threads = [threading.Thread(target=disparar, args=(i,)) for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        with app.app_context():
+            abertas = RegistroUso.query.filter_by(veiculo_id=carro_id, km_chegada=None).all()
+            contagem = Counter(respostas)
+            resultados.append({'rodada': rodada + 1, 'respostas': dict(contagem), 'viagens_abertas': len(abertas)})
+            # Fecha a viagem para a próxima rodada começar com o carro livre
+            for viagem in abertas:
+                viagem.km_chegada = viagem.km_saida + 10
+                viagem.data_hora_chegada = viagem.data_hora_saida
+            db.session.commit()
+
+    print(json.dumps(resultados))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=200)
+    parser.add_argument('--rodadas', type=int, default=3)
+    parser.add_argument('--executar', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar:
+        executar(args)
+        return
+
+    # Fotos processadas na própria requisição: a corrida fica só no commit
+    with tempfile.TemporaryDirectory() as pasta:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(pasta, 'teste.db')}", METRICAS_ATIVAS='0',
+                   FOTOS_EM_SEGUNDO_PLANO='0', RELATORIOS_NO_PROCESSO='0')
+        comando = [sys.executable, os.path.abspath(__file__), '--executar',
+                   '--threads', str(args.threads), '--rodadas', str(args.rodadas)]
+        saida = subprocess.run(comando, capture_output=True, text=True, env=env, cwd=pasta)
+        if saida.returncode != 0:
+            sys.stderr.write(saida.stderr)
+            raise SystemExit(saida.returncode)
+
+    falhou = False
+    for r in json.loads(saida.stdout.strip().splitlines()[-1]):
+        ok = (r['respostas'].get('aceita', 0) == 1 and r['viagens_abertas'] == 1
+              and set(r['respostas']) <= {'aceita', 'recusada'})
+        falhou |= not ok
+        print(f"rodada {r['rodada']}: {r['respostas']}  viagens abertas: {r['viagens_abertas']}  "
+              f"{'OK' if ok else 'FALHOU'}")
+    if falhou:
+        raise SystemExit(1)
+    print(f"OK: {args.threads} saídas simultâneas, uma aceita e uma viagem aberta por rodada")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Teste do número de comandos SQL de /relatorio-ocorrencias.
+
+Cria num diretório temporário um banco com 5, depois 20 e depois 100
+viagens finalizadas (cada uma com fotos de ocorrência) e conta, com um
+listener before_cursor_execute no engine, quantos comandos SQL a página
+do relatório executa em cada caso. A contagem tem de ser a mesma nos três:
+se crescer com o número de viagens, voltou um N+1. Sai com código 1.
+
+Uso:
+    python testar_sql_ocorrencias.py [--viagens 5 20 100] [--fotos-por-viagem 2]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+SENHA = 'teste123'
+
+
+def semear(app_mod, ate, fotos_por_viagem):
+    """Completa o banco até 'ate' viagens finalizadas, espalhadas entre os veículos."""
+    db, RegistroUso = app_mod.db, app_mod.RegistroUso
+    existentes = RegistroUso.query.count()
+    veiculos = [v for (v,) in db.session.query(app_mod.Veiculo.id)]
+    motorista = app_mod.Usuario.query.filter_by(cargo='Motorista').first()
+    inicio = datetime.now() - timedelta(days=30)
+    for i in range(existentes, ate):
+        saida = inicio + timedelta(hours=i)
+        viagem = RegistroUso(
+            usuario_id=motorista.id, gabinete_vereador='Administrativo/Geral', motorista_nome=motorista.nome,
+            veiculo_id=veiculos[i % len(veiculos)], km_saida=1000 + i * 10, km_chegada=1000 + i * 10 + 8,
+            data_hora_saida=saida, data_hora_chegada=saida + timedelta(minutes=40),
+            foto_km_saida='teste.jpg', foto_km_chegada='teste.jpg', destino_finalidade=f'Destino {i}',
+            observacoes='Ocorrência de teste')
+        db.session.add(viagem)
+        db.session.flush()
+        db.session.add_all([app_mod.FotoOcorrencia(registro_id=viagem.id, caminho_foto=f'ocorrencia_{i}_{n}.jpg')
+                            for n in range(fotos_por_viagem)])
+    db.session.commit()
+
+
+def executar(args):
+    """Roda dentro do subprocesso e imprime as contagens em JSON."""
+    import app as app_mod
+    from sqlalchemy import event
+    app, db = app_mod.app, app_mod.db
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        app_mod.migrar_banco()
+        hash_senha = app_mod.gerar_hash_senha(SENHA)
+        db.session.add_all([
+            app_mod.Usuario(nome='Admin Teste', cpf='11111111111', senha=hash_senha, cargo='Admin', ativo=True),
+            app_mod.Usuario(nome='Motorista Teste', cpf='22222222222', senha=hash_senha, cargo='Motorista', ativo=True),
+        ] + [app_mod.Veiculo(modelo=f'Carro {i}', placa=f'TST{i:04d}', km_atual=0, km_revisao_proxima=10000)
+             for i in range(3)])
+        db.session.commit()
+
+    contador = {'sql': 0}
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: contador.__setitem__('sql', contador['sql'] + 1))
+
+    admin = app.test_client()
+    admin.post('/login', data={'cpf': '11111111111', 'senha': SENHA})
+
+    contagens = {}
+    for total in args.viagens:
+        with app.app_context():
+            semear(app_mod, total, args.fotos_por_viagem)
+        # Uma requisição de aquecimento (caches de usuário e de frota), depois a medida
+        admin.get('/relatorio-ocorrencias')
+        contador['sql'] = 0
+        resposta = admin.get('/relatorio-ocorrencias')
+        if resposta.status_code != 200:
+            raise SystemExit(f'/relatorio-ocorrencias respondeu {resposta.status_code} com {total} viagens')
+        contagens[total] = contador['sql']
+
+    print(json.dumps(contagens))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--viagens', type=int, nargs='+', default=[5, 20, 100])
+    parser.add_argument('--fotos-por-viagem', type=int, default=2)
+    parser.add_argument('--executar', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar:
+        executar(args)
+        return
+
+    with tempfile.TemporaryDirectory() as pasta:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(pasta, 'teste.db')}", METRICAS_ATIVAS='0',
+                   RELATORIOS_NO_PROCESSO='0')
+        comando = [sys.executable, os.path.abspath(__file__), '--executar',
+                   '--viagens', *map(str, sorted(args.viagens)), '--fotos-por-viagem', str(args.fotos_por_viagem)]
+        saida = subprocess.run(comando, capture_output=True, text=True, env=env, cwd=pasta)
+        if saida.returncode != 0:
+            sys.stderr.write(saida.stderr)
+            raise SystemExit(saida.returncode)
+
+    contagens = json.loads(saida.stdout.strip().splitlines()[-1])
+    for total, comandos in contagens.items():
+        print(f"{int(total):>6} viagens: {comandos} comandos SQL")
+    if len(set(contagens.values())) != 1:
+        print("FALHOU: o número de comandos SQL mudou com o número de viagens")
+        raise SystemExit(1)
+    print("OK: número de comandos SQL constante")
+
+
+if __name__ == '__main__':
+    main()